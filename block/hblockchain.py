@@ -4,10 +4,14 @@ hbockchain.py: This module creates and maintains the Helium blockchain
 import rcrypt
 import hconfig
 import hchaindb
+import hpow
+import hsubsidy
 import tx
 import blk_index as blockindex
+import concurrent.futures
 import json
 import pickle
+import time
 import pdb
 import logging
 import os
@@ -41,9 +45,62 @@ blockchain   = []
 
 
 """
-secondary block used by mining nodes
+the block tree used by mining nodes. Every block on the blockchain or on a
+competing branch is a node keyed by its block header hash:
+
+               {
+                  "block":   <block>
+                  "parent":  <header hash of the parent block>
+                  "height":  <integer>
+                  "work":    <cumulative proof of work of the branch>
+                  "changes": <the chainstate changes of the block, see 
+                              hchaindb.view_changes. Only present when the
+                              block has been added with add_block>
+               }
+
+The blockchain list holds the branch with the most cumulative work and 
+best_tip is the header hash of its last block. A fork adds a single node and
+a reorganization only disconnects and connects the blocks that differ.
+"""
+block_tree = {}
+best_tip   = None
+
+
+"""
+the header index used for headers-first validation. Every block header which
+has been validated is a node keyed by its block header hash:
+
+               {
+                  "header":  <block header, see block_header>
+                  "parent":  <header hash of the parent block>
+                  "height":  <integer>
+                  "work":    <cumulative proof of work of the header chain>
+                  "target":  <the expected target of the header or None>
+                  "block":   <the unvalidated block body or None>
+                  "invalid": <True if the body of the block or of one of
+                              its ancestors failed validation>
+               }
+
+best_header is the header hash of the valid header chain with the most 
+cumulative work. The bodies of blocks are validated only if they are on this 
+chain.
+"""
+header_index = {}
+best_header  = None
+
+
 """
-secondary_blockchain = []
+the header hashes of the header chain of the assume valid checkpoint, keyed
+by height. It is built from the header index once the header chain from the
+checkpoint down to the genesis block is known. See assume_valid
+"""
+checkpoint_chain = {}
+
+
+"""
+pool of worker threads which validate the independent transactions of a block
+"""
+validation_pool = None
 
 
 def add_block(block: "dictionary") -> "bool":
@@ -55,37 +112,58 @@ def add_block(block: "dictionary") -> "bool":
     The chainstate database and the blk_index databases are updated.
     returns True if the block is added to the blockchain and False otherwise
     """
+    global best_tip
+
     try:
         # validate the received block parameters
         if validate_block(block) == False:
             raise(ValueError("block validation error"))
 
-        # validate the transactions in the block
-        # update the chainstate database
-     
-        for trx in block['tx']:
-            # first transaction in the block is a coinbase transaction
-            if block["height"] == 0 or block['tx'][0] == trx: zero_inputs = True
-            else: zero_inputs = False
-
-            if tx.validate_transaction(trx, zero_inputs) == False: 
+        # reject duplicate transactions and double spends within the block
+        # before any signature verification or chainstate write
+        if validate_block_conflicts(block) == False:
+            raise(ValueError("block transaction conflict error"))
+
+        # prefetch the fragments spent by the block in one sorted pass of
+        # the chainstate database. The transactions are validated and
+        # connected against this view and the chainstate database is only
+        # written if every transaction is valid. The fragments created by
+        # the block are stamped with its height.
+        hchaindb.open_view(hchaindb.fragment_keys(block["tx"]), block["height"])
+
+        # validate the transactions in the block level by level. The
+        # transactions in a level do not spend outputs created by each other
+        # and are validated concurrently against the chainstate view. Then
+        # the level is applied to the view in block order.
+        for level in dependency_levels(block["tx"]):
+            if validate_transactions(block, level) == False:
                 raise(ValueError("transaction validation error"))
-                    
-            if hchaindb.transaction_update(trx) == False:
-                raise(ValueError("chainstate update transaction error"))
+
+            for index in level:
+                if hchaindb.transaction_update(block["tx"][index]) == False:
+                    raise(ValueError("chainstate update transaction error"))
+
+        # the changes are kept to rewind the block in a reorganization
+        changes = hchaindb.view_changes()
+        if hchaindb.commit_view() == False:
+            raise(ValueError("chainstate write error"))
 
         # serialize the block to a file
         if (serialize_block(block) == False):
                 raise(ValueError("serialize block error"))
 
-        # add the block to the blockchain in memory
+        # add the block to the blockchain in memory and to the block tree
         blockchain.append(block)
+        best_tip = blockheader_hash(block)
+        insert_node(block, best_tip)["changes"] = changes
+        insert_header(block_header(block), best_tip)
 
         #  update the blk_index
         for transaction in block['tx']:
             blockindex.put_index(transaction["transactionid"], block["height"])
 
     except Exception as err:
+        hchaindb.discard_view()
         print(str(err))
         logging.debug('add_block: exception: ' + str(err))
         return False
@@ -93,6 +171,523 @@ def add_block(block: "dictionary") -> "bool":
     return True
 
 
+def block_work(block: "dictionary", target: "integer" = None) -> "integer":
+    """
+    returns the proof of work of a block: the expected number of hashes
+    needed to mine a block with an expected target, 2**256 // (target + 1).
+    If the expected target is not known the target of the block's difficulty
+    bits is used.
+    """
+    if target == None: target = hpow.difficulty_target(block["difficulty_bits"])
+    return 2 ** 256 // (target + 1)
+
+
+def header_target(block: "dictionary", blkhash: "string" = None) -> "integer or None":
+    """
+    returns the expected target of a block: the target stored for its header
+    in the header index, or else the expected target of a child of its parent.
+    Returns None if the expected target is not known
+    """
+    if blkhash == None: blkhash = blockheader_hash(block)
+
+    node = header_index.get(blkhash)
+    if node != None: return node["target"]
+    if block["height"] == 0: return hpow.difficulty_target(hconfig.conf["DIFFICULTY_BITS"])
+    return child_target(block["prevblockhash"])
+
+
+def insert_node(block: "dictionary", blkhash: "string" = None) -> "dictionary":
+    """
+    inserts a block into the block tree under its parent and returns its node.
+    A block whose parent is not in the tree is inserted as a root.
+    """
+    if blkhash == None: blkhash = blockheader_hash(block)
+
+    node = block_tree.get(blkhash)
+    if node != None: return node
+
+    parent = block_tree.get(block["prevblockhash"])
+    work = block_work(block, header_target(block, blkhash))
+    if parent != None: work += parent["work"]
+
+    node = {"block": block, "parent": block["prevblockhash"], 
+            "height": block["height"], "work": work}
+    block_tree[blkhash] = node
+    return node
+
+
+def tip_work() -> "integer":
+    """
+    returns the cumulative work of the blockchain
+    """
+    node = block_tree.get(best_tip)
+    if node == None: return 0
+    return node["work"]
+
+
+def on_blockchain(blkhash: "string") -> "bool":
+    """
+    tests whether a node of the block tree is on the blockchain, in O(1)
+    """
+    node = block_tree.get(blkhash)
+    if node == None or len(blockchain) == 0: return False
+
+    position = node["height"] - blockchain[0]["height"]
+    return 0 <= position < len(blockchain) and blockchain[position] is node["block"]
+
+
+def reorganize(blkhash: "string") -> "list or bool":
+    """
+    makes the branch of the block tree which ends at blkhash the blockchain.
+    The parent pointers are followed back to the fork point on the
+    blockchain. The blocks after the fork point are disconnected and the
+    blocks of the branch are added with add_block. The chainstate and the
+    blk_index are rewound for each disconnected block. If a branch block is
+    invalid, the connected branch blocks are rewound and the disconnected
+    blocks are restored. A blockchain block whose chainstate changes are not
+    known cannot be disconnected and the blockchain is then left unchanged.
+    Only the differing segments are visited. 
+    Returns the list of connected blocks or False
+    """
+    global best_tip
+
+    # the branch blocks, from the fork point to blkhash
+    branch = []
+    fork   = blkhash
+    while not on_blockchain(fork):
+        node = block_tree.get(fork)
+        if node == None: return False
+        branch.append(node["block"])
+        fork = node["parent"]
+    branch.reverse()
+
+    position     = block_tree[fork]["height"] - blockchain[0]["height"] + 1
+    disconnected = blockchain[position:]
+
+    for block in disconnected:
+        if "changes" not in block_tree.get(blockheader_hash(block), {}):
+            logging.debug('reorganize: cannot rewind a block, the blockchain is not changed')
+            return False
+
+    if rewind_blocks(disconnected) == False: 
+        replay_blocks(disconnected)
+        return False
+    del blockchain[position:]
+
+    connected = []
+    for block in branch:
+        if add_block(block) == False:
+            logging.debug('reorganize: invalid branch block, restoring the blockchain')
+            rewind_blocks(connected)
+            replay_blocks(disconnected)
+            del blockchain[position:]
+            blockchain.extend(disconnected)
+            best_tip = blockheader_hash(blockchain[-1])
+            return False
+        connected.append(block)
+
+    logging.debug('reorganize: disconnected %d blocks, connected %d blocks', 
+                  len(disconnected), len(branch))
+    return branch
+
+
+def rewind_blocks(blocks: "list") -> "bool":
+    """
+    undoes the chainstate changes of a list of blockchain blocks, last block
+    first, and removes their transactions from the blk_index.
+    Returns False if the chainstate cannot be written
+    """
+    for block in reversed(blocks):
+        changes = block_tree[blockheader_hash(block)]["changes"]
+        if hchaindb.apply_fragments(changes["undo"]) == False: return False
+        for transaction in block["tx"]:
+            blockindex.delete_index(transaction["transactionid"])
+
+    return True
+
+
+def replay_blocks(blocks: "list") -> "bool":
+    """
+    makes the chainstate changes of a list of rewound blocks again, first
+    block first, and adds their transactions to the blk_index.
+    Returns False if the chainstate cannot be written
+    """
+    for block in blocks:
+        changes = block_tree[blockheader_hash(block)]["changes"]
+        if hchaindb.apply_fragments(changes["redo"]) == False: return False
+        for transaction in block["tx"]:
+            blockindex.put_index(transaction["transactionid"], block["height"])
+
+    return True
+
+
+def block_header(block: "dictionary") -> "dictionary":
+    """
+    returns the header of a block: the fields hashed by blockheader_hash and
+    the block height
+    """
+    return {"version": block["version"], "prevblockhash": block["prevblockhash"],
+            "merkle_root": block["merkle_root"], "timestamp": block["timestamp"],
+            "difficulty_bits": block["difficulty_bits"], "nonce": block["nonce"],
+            "height": block["height"]}
+
+
+def header_parent(header: "dictionary") -> "dictionary or None":
+    """
+    returns the header index node or the block tree node of the parent of a
+    block header, or None if the parent is not known
+    """
+    parent = header_index.get(header["prevblockhash"])
+    if parent == None: parent = block_tree.get(header["prevblockhash"])
+    return parent
+
+
+def validate_header(header: "dictionary", now: "integer" = None) -> "bool":
+    """
+    validate_header: receives a block header and verifies its attributes and
+    its linkage to its parent. No transaction is examined. The proof of work
+    is verified by the caller. A header whose parent is not known is only 
+    checked in isolation.
+    Returns True if the header is valid and False otherwise.
+    """
+    try:
+        if now == None: now = int(time.time())
+
+        if type(header["version"]) != str:
+            raise(ValueError("header version type error"))
+
+        if header["version"] != hconfig.conf["VERSION_NO"]: 
+            raise(ValueError("header wrong version"))
+
+        if type(header["timestamp"]) != int or header["timestamp"] < 0: 
+            raise(ValueError("header invalid timestamp"))
+
+        if header["timestamp"] > now + hconfig.conf["MAX_FUTURE_TIME"]: 
+            raise(ValueError("header timestamp is too far in the future"))
+
+        if type(header["difficulty_bits"]) != int or header["difficulty_bits"] <= 0: 
+            raise(ValueError("header invalid difficulty_bits"))
+
+        if type(header["nonce"]) != int or header["nonce"] < 0 or header["nonce"] >= hpow.MAX_NONCE: 
+            raise(ValueError("header nonce is out of range"))
+
+        if type(header["height"]) != int or header["height"] < 0:
+            raise(ValueError("header invalid height"))
+
+        if header["height"] == 0:
+            if header["prevblockhash"] != "":
+                raise(ValueError("genesis header has prevblockhash"))
+            return True
+
+        parent = header_parent(header)
+        if parent != None and header["height"] != parent["height"] + 1:
+            raise(ValueError("header height is not in order"))
+
+    except Exception as error:
+        logging.debug("exception: %s: %s", "validate_header", error)
+        return False
+
+    return True
+
+
+def insert_header(header: "dictionary", blkhash: "string" = None) -> "dictionary":
+    """
+    inserts a validated block header into the header index and returns its
+    node. best_header is moved to the header if its header chain has more 
+    cumulative work than the best header chain. A header whose parent is 
+    invalid is invalid.
+    """
+    global best_header
+
+    if blkhash == None: blkhash = blockheader_hash(header)
+
+    node = header_index.get(blkhash)
+    if node != None: return node
+
+    target = child_target(header["prevblockhash"])
+    if header["height"] == 0: target = hpow.difficulty_target(hconfig.conf["DIFFICULTY_BITS"])
+
+    parent = header_parent(header)
+    work = block_work(header, target)
+    if parent != None: work += parent["work"]
+
+    # a parent in the block tree is a connected, and so valid, block
+    invalid = parent != None and parent.get("invalid") == True
+
+    node = {"header": header, "parent": header["prevblockhash"], "height": header["height"],
+            "work": work, "target": target, "block": None, "invalid": invalid}
+    header_index[blkhash] = node
+    if invalid == True: return node
+
+    best = header_index.get(best_header)
+    if best == None or work > best["work"]: best_header = blkhash
+    return node
+
+
+def invalidate_header(blkhash: "string") -> "bool":
+    """
+    marks a header whose block body failed validation, and the headers which
+    descend from it, as invalid and drops their held block bodies. best_header
+    is moved to the valid header with the most cumulative work.
+    Returns False if the header is not in the header index.
+    """
+    global best_header
+
+    if blkhash not in header_index: return False
+    header_index[blkhash]["invalid"] = True
+
+    # the validity of a header is decided once, by following its parents up
+    # to a header whose validity is already decided
+    valid = {}
+    for start in header_index:
+        path = []
+        ancestor = start
+        while ancestor in header_index and ancestor not in valid:
+            if header_index[ancestor]["invalid"] == True:
+                valid[ancestor] = False
+                break
+            path.append(ancestor)
+            ancestor = header_index[ancestor]["parent"]
+
+        state = valid.get(ancestor, True)
+        for header_hash in path: valid[header_hash] = state
+
+    best_header = None
+    for header_hash, node in header_index.items():
+        if valid[header_hash] == False:
+            node["invalid"] = True
+            node["block"]   = None
+        elif best_header == None or node["work"] > header_index[best_header]["work"]:
+            best_header = header_hash
+
+    return True
+
+
+def child_target(blkhash: "string") -> "integer or None":
+    """
+    returns the expected target of a block whose parent has the header hash
+    blkhash. The target of the parent is retargeted if the parent height is
+    a non-zero multiple of RETARGET_INTERVAL; see hpow.retarget. Returns None
+    if the target of the parent or the header RETARGET_INTERVAL blocks
+    before it is not in the header index.
+    """
+    node = header_index.get(blkhash)
+    if node == None or node["target"] == None: return None
+
+    interval = hconfig.conf["RETARGET_INTERVAL"]
+    if node["height"] == 0 or node["height"] % interval != 0: return node["target"]
+
+    ancestor = node
+    for __ctr in range(interval):
+        ancestor = header_index.get(ancestor["parent"])
+        if ancestor == None: return None
+
+    elapsed = node["header"]["timestamp"] - ancestor["header"]["timestamp"]
+    return hpow.retarget(node["target"], elapsed, interval)
+
+
+def on_best_header_chain(blkhash: "string") -> "bool":
+    """
+    tests whether a header is on the best header chain. Only the headers 
+    between the best header and the height of the header are visited.
+    """
+    node = header_index.get(blkhash)
+    if node == None: return False
+
+    ancestor = best_header
+    best = header_index.get(ancestor)
+    while best != None and best["height"] > node["height"]:
+        ancestor = best["parent"]
+        best = header_index.get(ancestor)
+
+    return ancestor == blkhash
+
+
+def best_chain_blocks(blkhash: "string") -> "list or bool":
+    """
+    returns the blocks on the header chain which ends at blkhash and which
+    are not yet in the block tree, parents first. Returns False if the body
+    of one of these blocks has not been received.
+    """
+    blocks = []
+    while blkhash not in block_tree:
+        node = header_index.get(blkhash)
+        if node == None: break
+        if node["block"] == None: return False
+        blocks.append(node["block"])
+        blkhash = node["parent"]
+
+    blocks.reverse()
+    return blocks
+
+
+def build_checkpoint_chain() -> "bool":
+    """
+    fills checkpoint_chain with the header chain of the assume valid checkpoint
+    by following the parents of the checkpoint header in the header index.
+    Returns True if the chain reaches the genesis block and False otherwise,
+    in which case checkpoint_chain is left empty.
+    """
+    blkhash = hconfig.conf["ASSUME_VALID_HASH"]
+    node = header_index.get(blkhash)
+    if node == None or node["height"] != hconfig.conf["ASSUME_VALID_HEIGHT"]: return False
+
+    chain = {}
+    while node != None:
+        chain[node["height"]] = blkhash
+        if node["height"] == 0:
+            checkpoint_chain.update(chain)
+            return True
+        blkhash = node["parent"]
+        node = header_index.get(blkhash)
+
+    return False
+
+
+def assume_valid(block: "dictionary") -> "bool":
+    """
+    tests whether the signatures of the transactions in a block need not be
+    verified. This is the case if the block is at or below the assume valid 
+    checkpoint height and is on the header chain of the checkpoint.
+    Setting hconfig.conf["ASSUME_VALID_HEIGHT"] to -1 turns this off.
+    """
+    height = hconfig.conf["ASSUME_VALID_HEIGHT"]
+    if height < 0 or block["height"] > height: return False
+
+    if checkpoint_chain.get(height) != hconfig.conf["ASSUME_VALID_HASH"]:
+        checkpoint_chain.clear()
+        if build_checkpoint_chain() == False: return False
+
+    if checkpoint_chain.get(block["height"]) != blockheader_hash(block): return False
+
+    logging.info("assume_valid: not verifying the signatures of block %d below the checkpoint %d",
+                 block["height"], height)
+    return True
+
+
+def validate_block_conflicts(block: "dictionary") -> "bool":
+    """
+    validate_block_conflicts: tests the transactions of a block for conflicts
+    in O(n) in the number of transaction inputs and outputs. Does not access
+    the chainstate database. Returns False if:
+        (1) two transactions in the block have the same transaction id
+        (2) a transaction fragment is spent more than once in the block
+        (3) a transaction spends a fragment created by a transaction that
+            appears at the same position or later in the block
+        (4) a transaction spends a vout index that does not exist in a
+            transaction created earlier in the block
+    A transaction may spend a fragment created by an earlier transaction in
+    the same block. Returns True otherwise.
+    """
+    try:
+        # the number of vout elements of each transaction in the block
+        created = {}
+        for trx in block["tx"]:
+            if trx["transactionid"] in created:
+                raise(ValueError("duplicate transaction id in block: " + trx["transactionid"]))
+            created[trx["transactionid"]] = len(trx["vout"])
+
+        spent   = set()
+        preceding = set()
+        for trx in block["tx"]:
+            for vin in trx["vin"]:
+                txkey = vin["txid"] + "_" + str(vin["vout_index"])
+                if txkey in spent:
+                    raise(ValueError("fragment spent twice in block: " + txkey))
+                spent.add(txkey)
+
+                if vin["txid"] in created:
+                    if vin["txid"] not in preceding:
+                        raise(ValueError("fragment spent before it is created: " + txkey))
+                    if vin["vout_index"] >= created[vin["txid"]]:
+                        raise(ValueError("fragment does not exist in block: " + txkey))
+
+            preceding.add(trx["transactionid"])
+
+    except Exception as error:
+        logging.error("exception: %s: %s", "validate_block_conflicts", error)
+        return False
+
+    return True
+
+
+def dependency_levels(transactions: "list") -> "list":
+    """
+    dependency_levels: builds the dependency graph of the transactions in a
+    block. A transaction depends on an earlier transaction in the block if
+    it spends an output of that transaction. 
+    Returns a list of levels, each level is a list of transaction indexes in
+    block order. The transactions in level 0 do not depend on any transaction
+    in the block and a transaction in level n depends on at least one
+    transaction in level n - 1. 
+    Assumes that the block has passed validate_block_conflicts.
+    """
+    level_of = {}
+    levels   = []
+
+    for index, trx in enumerate(transactions):
+        level = 0
+        for vin in trx["vin"]:
+            if vin["txid"] in level_of:
+                level = max(level, level_of[vin["txid"]] + 1)
+
+        level_of[trx["transactionid"]] = level
+        if level == len(levels): levels.append([])
+        levels[level].append(index)
+
+    return levels
+
+
+def validate_transactions(block: "dictionary", indexes: "list") -> "bool":
+    """
+    validate_transactions: validates the transactions of a block at the 
+    given indexes. The transactions must not depend on each other. If there
+    is more than one transaction and hconfig.conf["VALIDATION_WORKERS"] is 
+    greater than one, the transactions are validated concurrently on a pool 
+    of worker threads. The chainstate is only read during validation.
+    The worker threads attach the chainstate view of the calling thread.
+    The first transaction in the block is a coinbase transaction.
+    Returns True if every transaction is valid and False otherwise.
+    """
+    global validation_pool
+
+    verify_scripts = not assume_valid(block)
+
+    def validate(index):
+        zero_inputs = (block["height"] == 0 or index == 0)
+        if verify_scripts == False:
+            return tx.validate_transaction(block["tx"][index], zero_inputs, verify_scripts=False)
+        return tx.validate_transaction(block["tx"][index], zero_inputs)
+
+    # the workers read the chainstate view of the connecting thread
+    view = hchaindb.current_view()
+
+    def validate_in_view(index):
+        hchaindb.attach_view(view)
+        try:
+            return validate(index)
+        finally:
+            hchaindb.attach_view(None)
+
+    workers = hconfig.conf["VALIDATION_WORKERS"]
+
+    if len(indexes) < 2 or workers < 2:
+        for index in indexes:
+            if validate(index) == False: return False
+        return True
+
+    if validation_pool == None:
+        validation_pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    futures = [validation_pool.submit(validate_in_view, index) for index in indexes]
+    for future in concurrent.futures.as_completed(futures):
+        if future.result() == False:
+            for pending in futures: pending.cancel()
+            return False
+
+    return True
+
+
 def serialize_block(block: "dictionary") -> "bool":
     """
     serialize_block: serializes a block to a file using pickle.
@@ -188,8 +783,8 @@ def validate_block(block: "dictionary") -> "bool":
         if type(block["nonce"]) != int: 
             raise(ValueError("block nonce type error"))
 
-        if block["nonce"] != hconfig.conf["NONCE"]: 
-            raise(ValueError("block nonce is invalid"))
+        if block["nonce"] < 0 or block["nonce"] >= hpow.MAX_NONCE: 
+            raise(ValueError("block nonce is out of range"))
 
         if type(block["height"]) != int:
             raise(ValueError("block height type error"))
@@ -233,6 +828,13 @@ def validate_block(block: "dictionary") -> "bool":
         if block["height"] > 0 and len(block["tx"]) < 2:
             raise(ValueError("block only has one transaction"))
 
+        # the coinbase transaction cannot create more than the block subsidy.
+        # Transaction fees are paid to the miner by the fee transactions.
+        if block["height"] > 0:
+            if sum(vout["value"] for vout in block["tx"][0]["vout"]) > \
+               hsubsidy.block_subsidy(block["height"]):
+                raise(ValueError("coinbase value exceeds the block subsidy"))
+
       
     except Exception as error:
         logging.error("exception: %s: %s", "validate_block",error)
@@ -7,6 +7,7 @@ import rcrypt
 import plyvel
 import logging
 import json
+import threading
 import pdb
 
 """
@@ -18,6 +19,31 @@ logging.basicConfig(filename="debug.log",filemode="w", \
 # handle to the Helium Chainstate Database
 hDB = None
 
+"""
+an in-memory view of the chainstate database. When the view is open,
+get_transaction reads prefetched fragments from the view and put_transaction
+writes fragments into the view instead of the database. The fragments that
+are written are applied to the database in a single write batch when the
+view is committed. A view is a dictionary:
+
+    "fragments": maps the prefetched and written keys to their fragments.
+                 A key which is prefetched but does not exist in the 
+                 database has the value None.
+    "writes":    the set of keys which have been written
+    "undo":      maps each written key to its fragment before the first 
+                 write, or to None if the key did not exist
+    "height":    the height of the block which is connected through the 
+                 view. The fragments created through the view are stamped
+                 with this height.
+
+The view is held per thread, so only the thread which connects a block
+sees the uncommitted fragments of the block. Other threads, for example
+the RPC threads which admit transactions into the mempool, read the
+database. A worker thread which validates the transactions of the block
+attaches the view of the connecting thread, see attach_view.
+"""
+view_state = threading.local()
+
 def open_hchainstate(filepath: "string") -> "db handle or False":
     """
     opens the Helium Chainstate key-value store and returns a handle to
@@ -65,11 +91,26 @@ def put_transaction(txkey: "string", tx_fragment: "dictionary") -> "bool":
                  “value”:                   <int
                  “spent”:                   <bool>
                  "tx_chain"                 <string>
+                 "height"                   <int or None>
+                 "coinbase"                 <bool>
     }
 
+    height is the height of the block which created the fragment and
+    coinbase is True if the fragment is an output of a coinbase transaction.
+    Fragments created outside of a chainstate view have the height None.
+
     Returns True if the key-value pair is created and False otherwise
     """
     try:
+        # write the fragment to the chainstate view if it is open
+        view = current_view()
+        if view != None:
+            if txkey not in view["undo"]:
+                view["undo"][txkey] = view["fragments"].get(txkey)
+            view["fragments"][txkey] = dict(tx_fragment)
+            view["writes"].add(txkey)
+            return True
+
         # if transaction key already exists delete because
         # the transaction fragment is going to be updated
         encoded_key = str.encode(txkey)
@@ -98,10 +139,19 @@ def get_transaction(key: "string") -> "False or dictionary":
                  “value”:                   <string>
                  “spent”:                   <string>
                  "tx_chain"                 <string>
+                 "height"                   <int or None>
+                 "coinbase"                 <bool>
     }
     """
     
     try:
+        # read the fragment from the chainstate view if it is open
+        view = current_view()
+        if view != None and key in view["fragments"]:
+            if view["fragments"][key] == None:
+                raise(ValueError("transaction fragment not found"))
+            return dict(view["fragments"][key])
+
         # get the transaction fragment corresponding to the transaction
         # key, return False if the key does not exist
         fragment = hDB.get(str.encode(key))
@@ -124,10 +174,15 @@ def transaction_update(trx: "transaction")-> "bool":
         reflect the transaction. Sets previous transaction fragments
         to indicate that they have been spent. Updates these fragments
         to indicate the transaction id of the consuming transaction.
+        The new fragments record the height of the block in the open
+        chainstate view and whether they are coinbase outputs.
         returns True or False if there is an error
     """  
 
     try:
+        view = current_view()
+        height = view["height"] if view != None else None
+
         # collect all of the outputs of previous transactions and set them to spent
         # specify the transaction key consuming the previous transaction inputs
         for vin in trx["vin"]:
@@ -167,6 +222,8 @@ def transaction_update(trx: "transaction")-> "bool":
             tx_fragment["value"] = vout["value"] 
             tx_fragment["spent"] = False
             tx_fragment["tx_chain"] = ""
+            tx_fragment["height"] = height
+            tx_fragment["coinbase"] = is_coinbase(trx, height)
 
             if put_transaction(txkey, tx_fragment) == False:
                 raise(ValueError("failed to insert consuming transaction fragment"))
@@ -181,3 +238,164 @@ def transaction_update(trx: "transaction")-> "bool":
     return True
 
 
+
+
+def is_coinbase(trx: "transaction", height: "integer") -> "bool":
+    """
+    tests whether a transaction is the coinbase transaction of a block at a
+    height. A coinbase transaction does not have any inputs. The
+    transactions of the genesis block also do not have any inputs but they
+    are not coinbase transactions.
+    """
+    if height == None or height == 0: return False
+    return len(trx["vin"]) == 0
+
+
+def fragment_keys(transactions: "list") -> "list":
+    """
+    receives a list of transactions, for example the transactions in a block
+    or a batch of mempool transactions. Returns the sorted list of the unique
+    keys of the transaction fragments consumed by these transactions.
+    """
+    keys = set()
+    for trx in transactions:
+        for vin in trx["vin"]:
+            keys.add(vin["txid"] + "_" + str(vin["vout_index"]))
+
+    return sorted(keys)
+
+
+def prefetch_transactions(keys: "list") -> "dictionary":
+    """
+    reads the transaction fragments for a list of keys in a single sorted
+    pass of a database iterator. Returns a dictionary which maps each key to
+    its transaction fragment, or to None if the key is not in the database.
+    """
+    fragments = {}
+
+    try:
+        iterator = hDB.iterator()
+        for key in sorted(keys):
+            encoded_key = str.encode(key)
+            iterator.seek(encoded_key)
+            fragments[key] = None
+
+            for dbkey, value in iterator:
+                if dbkey == encoded_key:
+                    fragments[key] = json.loads(value.decode())
+                break
+
+        iterator.close()
+
+    except Exception as err:
+        logging.debug('prefetch_transactions: exception: ' + str(err))
+        return {}
+
+    return fragments
+
+
+def current_view() -> "dictionary or None":
+    """
+    returns the chainstate view of the calling thread or None if the
+    thread does not have an open view
+    """
+    return getattr(view_state, "view", None)
+
+
+def attach_view(view: "dictionary or None"):
+    """
+    makes view the chainstate view of the calling thread. A validation
+    worker attaches the view of the thread which connects a block and
+    detaches it with attach_view(None) when it is done.
+    """
+    view_state.view = view
+
+
+def open_view(keys: "list", height: "integer" = None) -> "bool":
+    """
+    opens a chainstate view for the calling thread and prefetches the 
+    fragments for keys into it. height is the height of the block which
+    is connected through the view.
+    Returns True
+    """
+    attach_view({"fragments": prefetch_transactions(keys), "writes": set(),
+                 "undo": {}, "height": height})
+    return True
+
+
+def discard_view() -> "bool":
+    """
+    closes the chainstate view of the calling thread without writing it
+    to the database
+    """
+    attach_view(None)
+    return True
+
+
+def view_changes() -> "dictionary or None":
+    """
+    returns the changes which the chainstate view of the calling thread 
+    makes to the database:
+
+        "undo": maps each written key to its previous fragment, or to None
+                if the key did not exist
+        "redo": maps each written key to its new fragment
+
+    apply_fragments(changes["undo"]) rewinds the changes after the view is
+    committed and apply_fragments(changes["redo"]) makes them again.
+    Returns None if the thread does not have an open view.
+    """
+    view = current_view()
+    if view == None: return None
+
+    return {"undo": dict(view["undo"]),
+            "redo": {txkey: view["fragments"][txkey] for txkey in view["writes"]}}
+
+
+def apply_fragments(fragments: "dictionary") -> "bool":
+    """
+    writes a dictionary of transaction keys and fragments to the database in
+    a single write batch. A key whose fragment is None is deleted.
+    Returns True if the fragments are written and False otherwise
+    """
+    if len(fragments) == 0: return True
+
+    try:
+        with hDB.write_batch() as batch:
+            for txkey in sorted(fragments):
+                if fragments[txkey] == None:
+                    batch.delete(str.encode(txkey))
+                else:
+                    batch.put(str.encode(txkey), str.encode(json.dumps(fragments[txkey])))
+
+    except Exception as err:
+        logging.debug('apply_fragments: exception: ' + str(err))
+        return False
+
+    return True
+
+
+def commit_view() -> "bool":
+    """
+    writes the fragments that were put into the chainstate view to the
+    database in a single write batch and closes the view.
+    Returns True if the view is committed and False otherwise
+    """
+    try:
+        view = current_view()
+        if view == None:
+            raise(ValueError("chainstate view is not open"))
+
+        if len(view["writes"]) > 0:
+            with hDB.write_batch() as batch:
+                for txkey in sorted(view["writes"]):
+                    keyvalue = json.dumps(view["fragments"][txkey])
+                    batch.put(str.encode(txkey), str.encode(keyvalue))
+
+    except Exception as err:
+        logging.debug('commit_view: exception: ' + str(err))
+        discard_view()
+        return False
+
+    discard_view()
+    return True
@@ -26,6 +26,63 @@ conf = {
     'MAX_OUTPUTS': 10,
 
     
+    # The maximum total size in bytes of the transactions in the mempool
+    'MEMPOOL_MAX_SIZE': 300_000_000,
+
+    # The number of seconds after which a transaction expires from the mempool
+    'MEMPOOL_EXPIRY': 14*1440*60,
+
+    # The file which holds the mempool when the node is not running and the 
+    # interval in seconds at which the mempool is saved
+    'MEMPOOL_FILE': "mempool.dat",
+    'MEMPOOL_SAVE_INTERVAL': 600,
+
+    # The maximum number of orphan blocks held by a mining node and the
+    # number of seconds after which an orphan block is dropped
+    'MAX_ORPHAN_BLOCKS': 100,
+    'ORPHAN_EXPIRY': 20*60,
+
+    # The number of block header hashes of received blocks and of rejected 
+    # blocks that a mining node remembers
+    'MAX_SEEN_BLOCKS': 10000,
+    'MAX_REJECTED_BLOCKS': 1000,
+
+    # The number of seconds that a block timestamp may be ahead of the 
+    # time of the node that receives the block header
+    'MAX_FUTURE_TIME': 2*60*60,
+
+    # Initial block download: the number of headers or blocks in a request,
+    # the number of headers or blocks that may be requested ahead of the
+    # next block to be connected, the number of concurrent requests and the
+    # number of times a failed request is retried with another peer
+    'SYNC_BATCH_SIZE': 16,
+    'SYNC_WINDOW': 256,
+    'SYNC_WORKERS': 8,
+    'SYNC_RETRIES': 3,
+
+    # JSON-RPC client: the maximum number of requests in flight, the maximum
+    # number of keep-alive connections to a peer, the number of seconds
+    # before a request times out and the number of times a failed request
+    # is retried
+    'RPC_CONCURRENCY': 128,
+    'RPC_PEER_CONNECTIONS': 4,
+    'RPC_TIMEOUT': 10,
+    'RPC_RETRIES': 2,
+
+    # The assume valid checkpoint: the height and block header hash of a block 
+    # whose history is trusted. The signatures of the transactions in the 
+    # blocks up to and including this block are not verified if the blocks 
+    # are on the header chain of this block. All other validation is done. 
+    # A height of -1 verifies every signature.
+    'ASSUME_VALID_HEIGHT': -1,
+    'ASSUME_VALID_HASH': "",
+
+    
+    # The number of worker threads that validate the independent 
+    # transactions of a block concurrently. 1 validates sequentially
+    'VALIDATION_WORKERS': 4,
+
+    
     # The number of new blocks from a reference block that must be mined before
     # coinbase transaction  in the previous reference block can be spent
     'COINBASE_INTERVAL': 100,
@@ -38,12 +95,20 @@ conf = {
     'NONCE': 0,
 
 
-    # Difficulty Number used in mining proof of work computations
+    # The number of worker processes that compute the mining proof of work.
+    # 0 uses one worker process per core
+    'MINING_WORKERS': 0,
+
+
+    # Difficulty used in mining proof of work computations. A block is mined
+    # if the SHA-256 hash of its header is less than its expected target.
+    # DIFFICULTY_TARGET is the initial target, 2**(256 - DIFFICULTY_BITS).
+    # The expected target of later blocks is computed from the header chain
     'DIFFICULTY_BITS': 20,
-    'DIFFICULTY_NUMBER':  1/ (10 **20),
+    'DIFFICULTY_TARGET': 2 ** (256 - 20),
 
 
-    # Retargeting interval in blocks in order to adjust the DIFFICULTY_NUMBER
+    # Retargeting interval in blocks in order to adjust the target
     'RETARGET_INTERVAL': 1000,
 
 
@@ -0,0 +1,249 @@
+"""
+hrpc.py: an asynchronous, pooled JSON-RPC client for Helium nodes.
+
+Requests are sent with HTTP/1.1 POST over persistent keep-alive connections.
+The connections to a peer are kept in an idle pool after each response and
+are reused by the next request to the peer, so a request does not pay for a
+new TCP connection. At most RPC_PEER_CONNECTIONS connections are opened to a
+peer and at most RPC_CONCURRENCY requests are in flight.
+
+The client runs on an asyncio event loop in a daemon thread. Synchronous
+callers, such as the mining threads, submit requests to this loop and wait
+for the results. A broadcast sends a request to every peer concurrently, so
+it takes about one round trip instead of one round trip per peer.
+
+Each request is bounded by RPC_TIMEOUT seconds and a failed request is
+retried RPC_RETRIES times. A connection on which a request fails is closed.
+"""
+import hconfig
+import asyncio
+import threading
+import urllib.parse
+import pdb
+import logging
+
+"""
+log debugging messages to the file debug.log
+"""
+logging.basicConfig(filename="debug.log",filemode="w", format='%(asctime)s:%(levelname)s:%(message)s',
+    level=logging.DEBUG)
+
+
+"""
+the event loop of the client and the thread which runs it
+"""
+client_loop = None
+loop_thread = None
+loop_lock   = threading.Lock()
+
+"""
+the idle keep-alive connections to each peer, keyed by (host, port, ssl)
+as lists of (reader, writer) pairs, and the semaphores which limit the
+number of connections to each peer and the number of requests in flight
+"""
+idle_connections = {}
+peer_semaphores  = {}
+request_semaphore = None
+
+"""
+client statistics: the number of requests sent, of connections opened, of
+retried requests and of requests which failed
+"""
+rpc_stats = {"requests": 0, "connections": 0, "retries": 0, "failures": 0}
+
+
+def start_loop() -> "event loop":
+    """
+    starts the client event loop in a daemon thread if it is not running
+    and returns it
+    """
+    global client_loop, loop_thread, request_semaphore
+
+    with loop_lock:
+        if client_loop != None and loop_thread.is_alive(): return client_loop
+
+        client_loop = asyncio.new_event_loop()
+        idle_connections.clear()
+        peer_semaphores.clear()
+        request_semaphore = None
+
+        loop_thread = threading.Thread(target=client_loop.run_forever, daemon=True)
+        loop_thread.start()
+
+    return client_loop
+
+
+def peer_address(peer: "string") -> "tuple":
+    """
+    returns the (host, port, ssl) of a peer address. A peer address is a
+    url, for example http://127.0.0.51:8081, or host:port
+    """
+    if peer.find("://") == -1: peer = "http://" + peer
+    url = urllib.parse.urlsplit(peer)
+
+    use_ssl = (url.scheme == "https")
+    port = url.port
+    if port == None: port = 443 if use_ssl else 80
+
+    return (url.hostname, port, use_ssl)
+
+
+def make_request(address: "tuple", body: "bytes") -> "bytes":
+    """
+    returns an HTTP/1.1 POST request for a JSON-RPC body
+    """
+    head = "POST / HTTP/1.1\r\n" + \
+           "Host: " + address[0] + ":" + str(address[1]) + "\r\n" + \
+           "Content-Type: application/json\r\n" + \
+           "Content-Length: " + str(len(body)) + "\r\n" + \
+           "Connection: keep-alive\r\n\r\n"
+    return head.encode("latin-1") + body
+
+
+async def read_response(reader: "StreamReader") -> "tuple":
+    """
+    reads an HTTP response. Returns (status, keep_alive, body)
+    """
+    status_line = (await reader.readline()).decode("latin-1")
+    parts = status_line.split(None, 2)
+    if len(parts) < 2 or parts[0].startswith("HTTP/") == False:
+        raise(ValueError("invalid status line: " + status_line))
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""): break
+        name, __, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    connection = headers.get("connection", "").lower()
+    if parts[0] == "HTTP/1.1": keep_alive = (connection != "close")
+    else: keep_alive = (connection == "keep-alive")
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = b""
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0: break
+            body += await reader.readexactly(size)
+            await reader.readexactly(2)
+        # skip the trailers
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""): pass
+
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+
+    else:
+        body = await reader.read()
+        keep_alive = False
+
+    return (int(parts[1]), keep_alive, body)
+
+
+async def exchange(address: "tuple", body: "bytes") -> "string":
+    """
+    sends a request to a peer on an idle connection, or on a new connection
+    if the peer does not have an idle connection, and returns the response
+    body. The connection is returned to the idle pool if the peer keeps it
+    alive, otherwise it is closed.
+    """
+    connections = idle_connections.setdefault(address, [])
+    connection = None
+    while len(connections) > 0:
+        connection = connections.pop()
+        if connection[1].is_closing() == False and connection[0].at_eof() == False: break
+        connection[1].close()
+        connection = None
+
+    if connection == None:
+        connection = await asyncio.open_connection(address[0], address[1],
+                                                   ssl=address[2] or None)
+        rpc_stats["connections"] += 1
+
+    reader, writer = connection
+    keep_alive = False
+    try:
+        writer.write(make_request(address, body))
+        await writer.drain()
+        status, keep_alive, data = await read_response(reader)
+        if status != 200:
+            raise(ValueError("http status " + str(status)))
+
+    finally:
+        if keep_alive == True: connections.append(connection)
+        else: writer.close()
+
+    return data.decode()
+
+
+async def send(peer: "string", json_rpc: "string") -> "string or False":
+    """
+    sends a JSON-RPC request to a peer and returns the response text. A
+    request which fails or takes more than RPC_TIMEOUT seconds is retried
+    RPC_RETRIES times. Returns False if every attempt fails.
+    """
+    global request_semaphore
+
+    address = peer_address(peer)
+    if request_semaphore == None:
+        request_semaphore = asyncio.Semaphore(hconfig.conf["RPC_CONCURRENCY"])
+    if address not in peer_semaphores:
+        peer_semaphores[address] = asyncio.Semaphore(hconfig.conf["RPC_PEER_CONNECTIONS"])
+
+    body = json_rpc.encode()
+    attempts = hconfig.conf["RPC_RETRIES"] + 1
+
+    async with request_semaphore:
+        async with peer_semaphores[address]:
+            for attempt in range(attempts):
+                if attempt > 0: rpc_stats["retries"] += 1
+                rpc_stats["requests"] += 1
+                try:
+                    return await asyncio.wait_for(exchange(address, body),
+                                                  hconfig.conf["RPC_TIMEOUT"])
+
+                except Exception as err:
+                    logging.debug('send: ' + peer + ': exception: ' + repr(err))
+
+    rpc_stats["failures"] += 1
+    return False
+
+
+async def send_all(peers: "list", json_rpc: "string") -> "list":
+    """
+    sends a JSON-RPC request to every peer concurrently
+    """
+    return await asyncio.gather(*[send(peer, json_rpc) for peer in peers])
+
+
+def call(peer: "string", json_rpc: "string") -> "string or False":
+    """
+    sends a JSON-RPC request to a peer from a synchronous caller and
+    returns the response text or False
+    """
+    loop = start_loop()
+    return asyncio.run_coroutine_threadsafe(send(peer, json_rpc), loop).result()
+
+
+def broadcast(peers: "list", json_rpc: "string") -> "list":
+    """
+    sends a JSON-RPC request to every peer concurrently from a synchronous
+    caller. Returns the response texts in peer order, with False for the
+    peers whose requests failed.
+    """
+    if len(peers) == 0: return []
+    loop = start_loop()
+    return asyncio.run_coroutine_threadsafe(send_all(peers, json_rpc), loop).result()
+
+
+def close_connections():
+    """
+    closes the idle connections to all of the peers
+    """
+    async def close_all():
+        for connections in idle_connections.values():
+            for reader, writer in connections: writer.close()
+            connections.clear()
+
+    if client_loop == None or loop_thread.is_alive() == False: return
+    asyncio.run_coroutine_threadsafe(close_all(), client_loop).result()
@@ -0,0 +1,243 @@
+"""
+hsync.py: initial block download for a Helium node that joins the network.
+
+The node catches up with its peers in two phases. First the headers of the
+missing blocks are downloaded and validated in order: proof of work,
+linkage, height and timestamp. Then the block bodies are downloaded and
+each body is checked against its validated header before it is added to
+the blockchain.
+
+Both phases use the same pipeline. Ranges of SYNC_BATCH_SIZE heights are
+requested concurrently from several peers, up to SYNC_WINDOW heights ahead
+of the next height to be connected. Responses which arrive out of order wait
+in a reorder buffer until the heights before them have been connected. A
+failed request is retried with another peer. With enough requests in flight
+the download is limited by validation and not by the round trip time to
+the peers.
+"""
+import hblockchain as bchain
+import hconfig
+import hmining
+import hpow
+import networknode
+import concurrent.futures
+import json
+import threading
+import time
+import pdb
+import logging
+
+"""
+log debugging messages to the file debug.log
+"""
+logging.basicConfig(filename="debug.log",filemode="w", format='%(asctime)s:%(levelname)s:%(message)s',
+    level=logging.DEBUG)
+
+
+"""
+statistics for the last initial block download
+"""
+sync_stats = {"headers": 0, "blocks": 0, "bytes": 0, "requests": 0, "failures": 0,
+              "seconds": 0.0, "blocks_per_second": 0.0}
+
+stats_lock = threading.Lock()
+
+
+def count(key: "string", value: "integer" = 1):
+    """
+    adds value to a sync statistic. The statistics are updated by the
+    request threads.
+    """
+    with stats_lock:
+        sync_stats[key] += value
+
+
+def request(peer: "string", method: "string", params: "dictionary") -> "result or False":
+    """
+    makes a JSON-RPC call to a peer and returns the decoded result, or
+    False if the call fails or the peer returns an error
+    """
+    try:
+        cmd = {"jsonrpc": "2.0", "method": method, "params": params, "id": 0}
+        ret = networknode.hclient(peer, json.dumps(cmd))
+        count("requests")
+        count("bytes", len(ret))
+
+        result = json.loads(ret)["result"]
+        if type(result) == str:
+            if result.startswith("error"): raise(ValueError(result))
+            result = json.loads(result)
+
+    except Exception as err:
+        logging.debug('request: exception: ' + str(err))
+        count("failures")
+        return False
+
+    return result
+
+
+def fetch_ranges(peers: "list", method: "string", start: "integer", stop: "integer",
+                 connect: "function") -> "integer or False":
+    """
+    requests the items (headers or blocks) at heights start to stop - 1 from
+    the peers with the RPC method and calls connect(height, item) for each
+    item in height order. Requests for SYNC_BATCH_SIZE heights are made
+    concurrently, up to SYNC_WINDOW heights ahead of the next height to be
+    connected. A range is requested from the peers in turn and a failed range
+    is retried with the next peer, up to SYNC_RETRIES times. A peer may return
+    fewer items than requested; the remainder is requested again. If connect
+    returns False for an item, the range fails: the item and the items after
+    it in the same response are dropped and requested from the next peer.
+    Returns the number of items connected or False if a range cannot be
+    fetched or connected.
+    """
+    if len(peers) == 0: return False
+
+    batch   = hconfig.conf["SYNC_BATCH_SIZE"]
+    window  = hconfig.conf["SYNC_WINDOW"]
+    workers = hconfig.conf["SYNC_WORKERS"]
+
+    buffer       = {}
+    pending      = {}
+    next_height  = start
+    next_request = start
+
+    def submit(executor, height, number, tries):
+        peer = peers[(height // batch + tries) % len(peers)]
+        future = executor.submit(request, peer, method, {"height": height, "count": number})
+        pending[future] = (height, number, tries)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        while next_height < stop:
+            # keep the window full
+            while next_request < stop and next_request - next_height < window:
+                number = min(batch, stop - next_request)
+                submit(executor, next_request, number, 0)
+                next_request += number
+
+            done, __ = concurrent.futures.wait(pending,
+                           return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                height, number, tries = pending.pop(future)
+                items = future.result()
+
+                if items == False or type(items) != list or len(items) == 0:
+                    if tries >= hconfig.conf["SYNC_RETRIES"]:
+                        raise(ValueError("cannot fetch height " + str(height)))
+                    submit(executor, height, number, tries + 1)
+                    continue
+
+                # each item is buffered with the end of its response and its tries
+                items = items[:number]
+                for index, item in enumerate(items):
+                    buffer[height + index] = (item, height + len(items), tries)
+
+                # request the items which the peer did not return
+                if len(items) < number:
+                    submit(executor, height + len(items), number - len(items), tries)
+
+            # connect the items in height order
+            while next_height in buffer:
+                item, end, tries = buffer.pop(next_height)
+                if connect(next_height, item) == True:
+                    next_height += 1
+                    continue
+
+                if tries >= hconfig.conf["SYNC_RETRIES"]:
+                    raise(ValueError("cannot connect height " + str(next_height)))
+                for height in range(next_height + 1, end): buffer.pop(height, None)
+                submit(executor, next_height, end - next_height, tries + 1)
+
+    except Exception as err:
+        logging.debug('fetch_ranges: ' + method + ': exception: ' + str(err))
+        for future in pending: future.cancel()
+        return False
+
+    finally:
+        executor.shutdown(wait=False)
+
+    return next_height - start
+
+
+def initial_block_download(peers: "list" = None) -> "integer or False":
+    """
+    downloads the blocks which the peers have and this node does not have,
+    headers first. peers defaults to the known node addresses.
+    The headers are validated and inserted into the header index. Each block
+    body must have the header hash of its validated header and is added to
+    the blockchain with add_block.
+    Returns the number of blocks added or False. Updates sync_stats.
+    """
+    if peers == None:
+        hmining.get_address_list()
+        peers = list(hmining.address_list)
+
+    for key in sync_stats: sync_stats[key] = 0
+    start_time = time.time()
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(peers), 1)) as executor:
+            heights = list(executor.map(lambda peer: request(peer, "get_blockchain_height", {}),
+                                        peers))
+
+        heights = [height if type(height) == int else -1 for height in heights]
+        if len(heights) == 0 or max(heights) < 0: return 0
+
+        start = 0
+        if len(bchain.blockchain) > 0: start = bchain.blockchain[-1]["height"] + 1
+        stop = max(heights) + 1
+        if stop <= start: return 0
+
+        # only request blocks from peers which have blocks after the tip
+        peers = [peer for peer, height in zip(peers, heights) if height >= start]
+
+        # the header hash of each connected header, keyed by height. A header 
+        # must link to the previous header, or to the tip at start, so that 
+        # the ranges of peers on different forks are not mixed
+        header_hashes = {}
+        if start > 0: header_hashes[start - 1] = bchain.blockheader_hash(bchain.blockchain[-1])
+
+        def connect_header(height, header):
+            blkhash = bchain.blockheader_hash(header)
+            if header["height"] != height: return False
+            if height > 0 and header["prevblockhash"] != header_hashes.get(height - 1): return False
+            if hmining.proof_of_work(header) == False: return False
+            if bchain.validate_header(header) == False: return False
+
+            with hmining.semaphore:
+                bchain.insert_header(header, blkhash)
+            header_hashes[height] = blkhash
+            count("headers")
+            return True
+
+        def connect_block(height, block):
+            if bchain.blockheader_hash(block) != header_hashes[height]: return False
+
+            with hmining.semaphore:
+                if bchain.add_block(block) == False: return False
+                hmining.remove_mempool_transactions(block)
+            count("blocks")
+            return True
+
+        if fetch_ranges(peers, "get_headers", start, stop, connect_header) == False:
+            return False
+
+        blocks = fetch_ranges(peers, "get_blocks", start, stop, connect_block)
+
+    except Exception as err:
+        logging.debug('initial_block_download: exception: ' + str(err))
+        return False
+
+    finally:
+        sync_stats["seconds"] = max(time.time() - start_time, 1e-9)
+        sync_stats["blocks_per_second"] = sync_stats["blocks"] / sync_stats["seconds"]
+        logging.debug('initial_block_download: %d headers, %d blocks, %d bytes, %.1f blocks/sec',
+                      sync_stats["headers"], sync_stats["blocks"], sync_stats["bytes"],
+                      sync_stats["blocks_per_second"])
+
+        # cancel the mining of a candidate block on the old tip
+        if sync_stats["blocks"] > 0: hpow.new_tip()
+
+    return blocks
@@ -1,16 +1,17 @@
 '''
-netnode: implementation of a synchronous RPC-Client node that makes remote
-procedure calls to RPC servers using the JSON RPC protocol version 2, and
+netnode: implementation of an RPC-Client node that makes remote procedure
+calls to RPC servers using the JSON RPC protocol version 2, and
 a JSON-RPC server that responds to requests from RPC client nodes.
 '''
 import blk_index as blkindex
 import hblockchain
 import hchaindb
+import hconfig
 import hmining
+import hrpc
 import networknode
 from   tornado import ioloop, web
 from   jsonrpcserver import method, async_dispatch as dispatch
-from   jsonrpcclient.clients.http_client import HTTPClient
 import ipaddress
 import threading
 import json
@@ -29,16 +30,31 @@ format='server: %(asctime)s:%(levelname)s:%(message)s', level=logging.DEBUG)
 
 def hclient(remote_server, json_rpc):
      '''
-     sends a synchronous request to a remote RPC server
+     sends a request to a remote RPC server and waits for the response.
+     The request is sent on a pooled keep-alive connection, see hrpc
      '''
-     try:
-          client = HTTPClient(remote_server)
+     return response_text(remote_server, hrpc.call(remote_server, json_rpc))
+
+
+def hbroadcast(remote_servers, json_rpc):
+     '''
+     sends a request to every remote RPC server concurrently and returns
+     the responses in server order
+     '''
+     responses = hrpc.broadcast(remote_servers, json_rpc)
+     return [response_text(server, valstr) for server, valstr in zip(remote_servers, responses)]
 
-          response = client.send(json_rpc)
-          valstr = response.text
+
+def response_text(remote_server, valstr):
+     '''
+     returns the text of a JSON-RPC response or an error response if the
+     request failed or the server returned an error
+     '''
+     try:
+          if valstr == False: raise(ValueError("request failed"))
           val = json.loads(valstr)
-          print("result: " + str(val["result"]))
-          print("id:  " + str(val["id"]))
+          if "error" in val: raise(ValueError(str(val["error"])))
+          logging.debug("node_client: " + remote_server + " id: " + str(val["id"]))
           return valstr
 
      except Exception as err:
@@ -96,6 +112,45 @@ async def get_block(height):
      return block
 
 
+@method
+async def get_headers(height, count):
+     """
+     returns the headers of up to count blocks starting at height, capped at
+     hconfig.conf["SYNC_BATCH_SIZE"], or an error if the height does not exist
+     """
+     with hmining.semaphore:
+          if len(hblockchain.blockchain) == 0:
+               return ("error-empty blockchain")
+
+          if height < 0 or height > hblockchain.blockchain[-1]["height"]:
+               return "error-invalid block height"
+
+          count  = min(count, hconfig.conf["SYNC_BATCH_SIZE"])
+          blocks = hblockchain.blockchain[height:height + count]
+          headers = [hblockchain.block_header(block) for block in blocks]
+
+     return json.dumps(headers)
+
+
+@method
+async def get_blocks(height, count):
+     """
+     returns up to count blocks starting at height, capped at 
+     hconfig.conf["SYNC_BATCH_SIZE"], or an error if the height does not exist
+     """
+     with hmining.semaphore:
+          if len(hblockchain.blockchain) == 0:
+               return ("error-empty blockchain")
+
+          if height < 0 or height > hblockchain.blockchain[-1]["height"]:
+               return "error-invalid block height"
+
+          count  = min(count, hconfig.conf["SYNC_BATCH_SIZE"])
+          blocks = hblockchain.blockchain[height:height + count]
+
+     return json.dumps(blocks)
+
+
 @method
 async def get_blockchain_height():
      """ 
@@ -111,11 +166,14 @@ async def get_blockchain_height():
 @method
 async def clear_blockchain():
      """ 
-     clears the primary and secondary blockchains.
+     clears the blockchain, the block tree and the header index.
      """
      with hmining.semaphore:
           hblockchain.blockchain.clear()
-          hblockchain.secondary_blockchain.clear()
+          hblockchain.block_tree.clear()
+          hblockchain.best_tip = None
+          hblockchain.header_index.clear()
+          hblockchain.best_header = None
      return "ok"
 
 
@@ -0,0 +1,747 @@
+"""
+hmempool.py: the mining node's pool of valid transactions which are waiting
+to be included in a block.
+The mempool is a dictionary keyed by transaction id. A second dictionary
+indexes the previous transaction fragments which are spent by mempool
+transactions. Insertion, removal and membership tests are O(1) and the
+transactions of a block are removed in O(block size).
+
+The fee and the fee rate of a transaction are computed once, when the
+transaction is admitted. A heap orders the transactions by fee rate so that
+a block template is assembled by walking the best paying transactions
+without sorting the mempool.
+
+The mempool is bounded. When the total size of its transactions exceeds
+hconfig.conf["MEMPOOL_MAX_SIZE"] the transactions with the lowest fee rate
+are evicted together with their descendants. Transactions expire after
+hconfig.conf["MEMPOOL_EXPIRY"] seconds. A transaction whose locktime is in
+the future waits in a timelock queue and becomes selectable when its
+locktime is reached.
+
+At most one mempool transaction spends a fragment. A transaction which spends
+a fragment that is already spent in the mempool is rejected, unless it pays
+more than the transactions that it conflicts with, in which case it replaces
+them. A transaction may spend the outputs of mempool transactions.
+
+The mempool is saved to a file with the admission time, fee and size of each
+transaction, and is reloaded when the node starts. A reloaded transaction is
+revalidated against the chainstate without verifying its signatures again.
+"""
+import hchaindb
+import hconfig
+import tx
+import heapq
+import itertools
+import json
+import os
+import pickle
+import time
+import pdb
+import logging
+
+"""
+log debugging messages to the file debug.log
+"""
+logging.basicConfig(filename="debug.log",filemode="w", format='%(asctime)s:%(levelname)s:%(message)s',
+    level=logging.DEBUG)
+
+
+"""
+the mempool entries keyed by transaction id. An entry is a dictionary:
+
+          {"tx": <transaction>, "time": <admission time>, "fee": <fee>,
+           "size": <json size in bytes>, "feerate": <fee per byte>,
+           "sequence": <admission sequence number>, "locked": <bool>}
+
+Python dictionaries preserve insertion order, so the entries are
+in arrival order.
+"""
+mempool = {}
+
+"""
+the spent fragment index: maps the fragment key of a previous transaction
+output, txid + "_" + vout_index, to the id of the mempool transaction
+which spends it
+"""
+spent_index = {}
+
+"""
+the total json size in bytes of the mempool transactions
+"""
+total_size = 0
+
+"""
+binary min-heaps of (key, sequence, txid) tuples:
+
+    fee_heap:       key is -feerate, the selectable transactions
+    eviction_heap:  key is feerate, all of the transactions
+    timelock_heap:  key is locktime, the transactions with a future locktime
+
+Removed transactions are not deleted from the heaps. Their stale items are
+skipped and a heap is compacted when it holds more stale items than
+live ones.
+"""
+fee_heap      = []
+eviction_heap = []
+timelock_heap = []
+
+"""
+the maximum number of mempool transactions that a replacement can evict
+"""
+MAX_REPLACEMENTS = 100
+
+"""
+the change log which keeps the block template up to date. A change is
+("add", txid) when a transaction becomes selectable and ("remove", txid)
+when a transaction leaves the mempool. If the log grows beyond MAX_CHANGES
+before it is drained, it is discarded and the template is rebuilt.
+"""
+changes = []
+changes_overflow = False
+MAX_CHANGES = 10000
+
+"""
+admission sequence numbers, ties between equal fee rates are broken
+in arrival order
+"""
+sequence = itertools.count()
+
+
+def log_change(kind: "string", txid: "string"):
+    """
+    appends a change to the change log
+    """
+    global changes_overflow
+
+    if changes_overflow: return
+    if len(changes) >= MAX_CHANGES:
+        changes.clear()
+        changes_overflow = True
+        return
+    changes.append((kind, txid))
+
+
+def drain_changes() -> "list or None":
+    """
+    returns the changes since the last call and empties the change log.
+    Returns None if changes were discarded.
+    """
+    global changes_overflow
+
+    if changes_overflow:
+        changes_overflow = False
+        return None
+
+    drained = list(changes)
+    changes.clear()
+    return drained
+
+
+def fragment_key(vin: "dictionary") -> "string":
+    """
+    returns the fragment key of the previous transaction output which
+    is consumed by a vin element
+    """
+    return vin["txid"] + "_" + str(vin["vout_index"])
+
+
+def contains(txid: "string") -> "bool":
+    """
+    tests whether a transaction is in the mempool
+    """
+    return txid in mempool
+
+
+def get_transaction(txid: "string") -> "dictionary or None":
+    """
+    returns a mempool transaction or None if it is not in the mempool
+    """
+    entry = mempool.get(txid)
+    if entry == None: return None
+    return entry["tx"]
+
+
+def spender(key: "string") -> "string or None":
+    """
+    returns the id of the mempool transaction which spends a previous
+    transaction fragment, or None
+    """
+    return spent_index.get(key)
+
+
+def parents(trx: "dictionary") -> "set":
+    """
+    returns the ids of the mempool transactions whose outputs are spent
+    by a transaction
+    """
+    return {vin["txid"] for vin in trx["vin"] if vin["txid"] in mempool}
+
+
+def transaction_fee(trx: "dictionary") -> "integer":
+    """
+    computes the fee of a transaction. A previous transaction fragment is
+    taken from the output of a mempool transaction or else from the
+    chainstate. Returns 0 if the fee cannot be computed.
+    """
+    try:
+        fragments = []
+        for vin in trx["vin"]:
+            parent = mempool.get(vin["txid"])
+            if parent != None:
+                fragments.append(parent["tx"]["vout"][vin["vout_index"]])
+            else:
+                fragments.append(hchaindb.get_transaction(fragment_key(vin)))
+
+        fee = tx.transaction_fee(trx, fragments)
+        if fee == False: return 0
+
+    except Exception as err:
+        logging.debug('transaction_fee: exception: ' + str(err))
+        return 0
+
+    return fee
+
+
+def transactions() -> "list":
+    """
+    returns the mempool transactions in arrival order
+    """
+    return [entry["tx"] for entry in mempool.values()]
+
+
+def add_transaction(trx: "dictionary", now: "integer" = None, 
+                    metadata: "dictionary" = None) -> "bool":
+    """
+    adds a validated transaction to the mempool and indexes the fragments
+    that it spends. A transaction with a locktime later than now is placed
+    in the timelock queue. The mempool is then trimmed to its maximum size.
+    metadata optionally holds the saved "time", "fee" and "size" of a
+    reloaded transaction.
+    Returns False if the transaction is already in the mempool or if it
+    is evicted by the trim.
+    """
+    global total_size
+
+    try:
+        if now == None: now = int(time.time())
+
+        txid = trx["transactionid"]
+        if txid in mempool: return False
+
+        if metadata == None:
+            metadata = {"time": now, "fee": transaction_fee(trx), 
+                        "size": len(json.dumps(trx))}
+
+        size = metadata["size"]
+        fee  = metadata["fee"]
+
+        entry = {"tx": trx, "time": metadata["time"], "fee": fee, "size": size,
+                 "feerate": fee / size, "sequence": next(sequence),
+                 "locked": trx["locktime"] > now}
+        mempool[txid] = entry
+        total_size += size
+
+        for vin in trx["vin"]:
+            spent_index[fragment_key(vin)] = txid
+
+        heapq.heappush(eviction_heap, (entry["feerate"], entry["sequence"], txid))
+        if entry["locked"]:
+            heapq.heappush(timelock_heap, (trx["locktime"], entry["sequence"], txid))
+        else:
+            heapq.heappush(fee_heap, (-entry["feerate"], entry["sequence"], txid))
+
+        trim(hconfig.conf["MEMPOOL_MAX_SIZE"])
+        if txid in mempool and entry["locked"] == False: log_change("add", txid)
+
+    except Exception as err:
+        logging.debug('add_transaction: exception: ' + str(err))
+        return False
+
+    return txid in mempool
+
+
+def remove_transaction(txid: "string") -> "bool":
+    """
+    removes a transaction from the mempool and from the spent fragment index.
+    Returns False if the transaction is not in the mempool.
+    """
+    global total_size
+
+    entry = mempool.pop(txid, None)
+    if entry == None: return False
+
+    total_size -= entry["size"]
+    log_change("remove", txid)
+
+    for vin in entry["tx"]["vin"]:
+        key = fragment_key(vin)
+        if spent_index.get(key) == txid: del spent_index[key]
+
+    for heap in (fee_heap, eviction_heap, timelock_heap):
+        if len(heap) > 2 * len(mempool) + 64: compact_heap(heap)
+
+    return True
+
+
+def descendants(txid: "string") -> "list":
+    """
+    returns the id of a mempool transaction followed by the ids of all of
+    the mempool transactions which depend on its outputs
+    """
+    found   = []
+    seen    = set()
+    pending = [txid]
+
+    while len(pending) > 0:
+        txid = pending.pop()
+        if txid in seen or txid not in mempool: continue
+        seen.add(txid)
+        found.append(txid)
+        pending.extend(children(txid))
+
+    return found
+
+
+def children(txid: "string") -> "list":
+    """
+    returns the ids of the mempool transactions which spend the outputs
+    of a mempool transaction
+    """
+    entry = mempool.get(txid)
+    if entry == None: return []
+
+    spenders = []
+    for index in range(len(entry["tx"]["vout"])):
+        spender_id = spent_index.get(txid + "_" + str(index))
+        if spender_id != None: spenders.append(spender_id)
+    return spenders
+
+
+def remove_with_descendants(txid: "string") -> "list":
+    """
+    removes a transaction and all of the mempool transactions which depend
+    on its outputs. Returns the ids of the removed transactions.
+    """
+    removed = descendants(txid)
+    for txid in removed:
+        remove_transaction(txid)
+
+    return removed
+
+
+def output_fragment(trx: "dictionary", index: "integer") -> "dictionary":
+    """
+    returns an output of a mempool transaction in chainstate fragment form.
+    See hchaindb.transaction_update
+    """
+    vout = trx["vout"][index]
+    return {"pkhash": vout["ScriptPubKey"][2], "value": vout["value"], 
+            "spent": False, "tx_chain": "", "height": None, "coinbase": False}
+
+
+def pending_fragments(trx: "dictionary") -> "dictionary":
+    """
+    returns the mempool outputs that are spent by a transaction, keyed by
+    fragment key
+    """
+    fragments = {}
+    for vin in trx["vin"]:
+        parent = mempool.get(vin["txid"])
+        if parent != None:
+            fragments[fragment_key(vin)] = output_fragment(parent["tx"], vin["vout_index"])
+    return fragments
+
+
+def conflicts(trx: "dictionary") -> "set":
+    """
+    returns the ids of the mempool transactions which spend a fragment
+    that is also spent by a transaction
+    """
+    return {spent_index[fragment_key(vin)] for vin in trx["vin"] 
+            if fragment_key(vin) in spent_index}
+
+
+def replaceable(trx: "dictionary", conflicting: "set") -> "list or False":
+    """
+    tests whether a transaction can replace the mempool transactions that
+    it conflicts with. The transaction must pay a higher fee rate than each
+    conflicting transaction and a higher fee than the conflicting
+    transactions and their descendants together. It cannot spend the
+    outputs of a transaction that it replaces.
+    Returns the ids of the transactions that are replaced or False
+    """
+    replaced = []
+    for txid in conflicting:
+        replaced.extend(descendants(txid))
+
+    if len(replaced) > MAX_REPLACEMENTS: return False
+    if len(parents(trx) & set(replaced)) > 0: return False
+
+    fee     = transaction_fee(trx)
+    feerate = fee / len(json.dumps(trx))
+
+    for txid in conflicting:
+        if feerate <= mempool[txid]["feerate"]: return False
+
+    if fee <= sum(mempool[txid]["fee"] for txid in set(replaced)): return False
+
+    return replaced
+
+
+def smallest_items(heap: "list"):
+    """
+    yields the items of a heap in ascending order without changing the heap.
+    Only the items which are yielded and their children are visited, so 
+    taking the k smallest items costs O(k log k)
+    """
+    frontier = [(heap[0], 0)] if len(heap) > 0 else []
+    while len(frontier) > 0:
+        item, index = heapq.heappop(frontier)
+        yield item
+        for child in (2 * index + 1, 2 * index + 2):
+            if child < len(heap): heapq.heappush(frontier, (heap[child], child))
+
+
+def fits(trx: "dictionary", replaced: "list") -> "bool":
+    """
+    tests whether a transaction stays in the mempool after the trim which
+    follows its admission, once the transactions that it replaces have been
+    removed. The trim can only free space by evicting transactions with a
+    lower fee rate than the transaction, which must not spend their outputs.
+    """
+    size    = len(json.dumps(trx))
+    removed = set(replaced)
+    excess  = total_size + size - hconfig.conf["MEMPOOL_MAX_SIZE"]
+    excess -= sum(mempool[txid]["size"] for txid in removed)
+    if excess <= 0: return True
+
+    feerate = transaction_fee(trx) / size
+
+    for item in smallest_items(eviction_heap):
+        if excess <= 0: break
+        if live_item(item) == None or item[2] in removed: continue
+        if item[0] > feerate: return False
+
+        evicted = set(descendants(item[2])) - removed
+        if len(parents(trx) & evicted) > 0: return False
+        excess -= sum(mempool[txid]["size"] for txid in evicted)
+        removed |= evicted
+
+    return excess <= 0
+
+
+def accept_transaction(trx: "dictionary", zero_inputs: "bool" = False, 
+                       now: "integer" = None) -> "bool":
+    """
+    admits a transaction into the mempool. The transaction is validated 
+    against the chainstate and the outputs of the mempool transactions. 
+    Then it is rejected if it conflicts with mempool transactions that it
+    cannot replace. The transactions that it replaces are removed.
+    Returns True if the transaction is added and False otherwise.
+    """
+    try:
+        if trx["transactionid"] in mempool: return False
+
+        # the transaction is validated before the fee lookups and the
+        # descendant walks of the replacement checks
+        pending = pending_fragments(trx)
+        if len(pending) == 0:
+            valid = tx.validate_transaction(trx, zero_inputs)
+        else:
+            valid = tx.validate_transaction(trx, zero_inputs, pending)
+
+        if valid == False:
+            raise(ValueError("invalid transaction"))
+
+        replaced    = []
+        conflicting = conflicts(trx)
+        if len(conflicting) > 0:
+            replaced = replaceable(trx, conflicting)
+            if replaced == False:
+                raise(ValueError("conflicting spend cannot replace the mempool transactions"))
+
+            # do not remove the replaced transactions if the trim would
+            # then evict the replacement
+            if fits(trx, replaced) == False:
+                raise(ValueError("replacement does not fit in the mempool"))
+
+        for txid in replaced:
+            remove_transaction(txid)
+
+        if len(replaced) > 0:
+            logging.debug('accept_transaction: replaced %d transactions', len(replaced))
+
+    except Exception as err:
+        logging.debug('accept_transaction: exception: ' + str(err))
+        return False
+
+    return add_transaction(trx, now)
+
+
+def remove_block_transactions(block: "dictionary") -> "bool":
+    """
+    removes the transactions in a block from the mempool. A mempool
+    transaction which spends a fragment that is spent by the block is
+    removed as well, together with its descendants, since it can no longer
+    be mined.
+    """
+    try:
+        for trx in block["tx"]:
+            remove_transaction(trx["transactionid"])
+
+            for vin in trx["vin"]:
+                txid = spent_index.get(fragment_key(vin))
+                if txid != None: remove_with_descendants(txid)
+
+    except Exception as err:
+        logging.debug('remove_block_transactions: exception: ' + str(err))
+        return False
+
+    return True
+
+
+def live_item(item: "tuple") -> "dictionary or None":
+    """
+    returns the mempool entry of a heap item or None if the item is stale
+    """
+    entry = mempool.get(item[2])
+    if entry == None or entry["sequence"] != item[1]: return None
+    return entry
+
+
+def compact_heap(heap: "list"):
+    """
+    removes the stale items from a heap
+    """
+    if heap is fee_heap:
+        live = lambda item: live_item(item) != None and not mempool[item[2]]["locked"]
+    elif heap is timelock_heap:
+        live = lambda item: live_item(item) != None and mempool[item[2]]["locked"]
+    else:
+        live = lambda item: live_item(item) != None
+
+    heap[:] = [item for item in heap if live(item)]
+    heapq.heapify(heap)
+
+
+def trim(max_size: "integer") -> "list":
+    """
+    evicts the transactions with the lowest fee rate, together with their
+    descendants, until the total size of the mempool is at most max_size
+    bytes. Returns the ids of the evicted transactions.
+    """
+    evicted = []
+
+    while total_size > max_size and len(eviction_heap) > 0:
+        item = heapq.heappop(eviction_heap)
+        if live_item(item) == None: continue
+        evicted.extend(remove_with_descendants(item[2]))
+
+    if len(evicted) > 0:
+        logging.debug('trim: evicted %d transactions', len(evicted))
+
+    return evicted
+
+
+def release_transactions(now: "integer") -> "list":
+    """
+    moves the transactions in the timelock queue whose locktime has been
+    reached to the fee rate heap. Returns the ids of the released
+    transactions.
+    """
+    released = []
+
+    while len(timelock_heap) > 0 and timelock_heap[0][0] <= now:
+        item  = heapq.heappop(timelock_heap)
+        entry = live_item(item)
+        if entry == None or entry["locked"] == False: continue
+
+        entry["locked"] = False
+        heapq.heappush(fee_heap, (-entry["feerate"], entry["sequence"], item[2]))
+        log_change("add", item[2])
+        released.append(item[2])
+
+    return released
+
+
+def expire_transactions(now: "integer") -> "list":
+    """
+    removes the transactions, and their descendants, which were admitted
+    more than hconfig.conf["MEMPOOL_EXPIRY"] seconds before now. The
+    mempool is in admission order, so only the expired entries are visited.
+    Returns the ids of the expired transactions.
+    """
+    cutoff  = now - hconfig.conf["MEMPOOL_EXPIRY"]
+    expired = []
+
+    for txid, entry in mempool.items():
+        if entry["time"] >= cutoff: break
+        expired.append(txid)
+
+    removed = []
+    for txid in expired:
+        removed.extend(remove_with_descendants(txid))
+
+    return removed
+
+
+def select_transactions(max_size: "integer", now: "integer" = None) -> "list":
+    """
+    selects the mempool transactions for a block template in order of
+    decreasing fee rate, until the next transaction does not fit into
+    max_size bytes. A transaction is selected after the mempool transactions
+    whose outputs it spends. The timelock queue is released and expired
+    transactions are removed first.
+    Returns a list of mempool entries in block order.
+
+    The fee rate heap is walked in order without modifying it: a second heap
+    holds the frontier of heap positions that can come next. A transaction
+    whose parents have not been selected waits until its first missing parent
+    is selected. Selecting k transactions takes O(k log k) steps.
+    """
+    if now == None: now = int(time.time())
+
+    release_transactions(now)
+    expire_transactions(now)
+
+    selected = []
+    chosen   = set()
+    size     = 0
+
+    # the frontier holds (item, heap position), ready holds waiting items
+    # whose parents have been selected
+    frontier = [(fee_heap[0], 0)] if len(fee_heap) > 0 else []
+    ready    = []
+    waiting  = {}
+
+    while len(frontier) > 0 or len(ready) > 0:
+        if len(ready) > 0 and (len(frontier) == 0 or ready[0] < frontier[0][0]):
+            item = heapq.heappop(ready)
+        else:
+            item, position = heapq.heappop(frontier)
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(fee_heap):
+                    heapq.heappush(frontier, (fee_heap[child], child))
+
+        entry = live_item(item)
+        if entry == None or entry["locked"] or item[2] in chosen: continue
+
+        trx = entry["tx"]
+        missing = parents(trx) - chosen
+        if len(missing) > 0:
+            waiting.setdefault(missing.pop(), []).append(item)
+            continue
+
+        if size + entry["size"] > max_size: break
+
+        selected.append(entry)
+        chosen.add(item[2])
+        size += entry["size"]
+
+        for child_item in waiting.pop(item[2], []):
+            heapq.heappush(ready, child_item)
+
+    return selected
+
+
+def snapshot() -> "list":
+    """
+    returns the mempool transactions, in admission order, with their
+    admission time, fee and size. The caller must hold the lock which
+    guards the mempool, see hmining.save_mempool
+    """
+    return [{"tx": entry["tx"], "time": entry["time"], "fee": entry["fee"],
+             "size": entry["size"]} for entry in mempool.values()]
+
+
+def save_mempool(filepath: "string" = None, records: "list" = None) -> "bool":
+    """
+    saves a snapshot of the mempool to a file. records is a snapshot which
+    has been taken by the caller and defaults to a snapshot of the mempool.
+    The file is written to a temporary file which then replaces the
+    previous file.
+    """
+    try:
+        if filepath == None: filepath = hconfig.conf["MEMPOOL_FILE"]
+        if records == None: records = snapshot()
+
+        f = open(filepath + ".tmp", 'wb')
+        pickle.dump(records, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.replace(filepath + ".tmp", filepath)
+
+    except Exception as err:
+        logging.debug('save_mempool: exception: ' + str(err))
+        return False
+
+    return True
+
+
+def revalidate(trx: "dictionary") -> "bool":
+    """
+    cheaply revalidates a transaction which was verified before it was saved.
+    Tests that the transaction is not in the chainstate, that it does not
+    conflict with the mempool and that its inputs can still be spent with
+    the values that it spends. The signatures are not verified again.
+    """
+    try:
+        if hchaindb.get_transaction(trx["transactionid"] + "_0") != False: return False
+        if len(conflicts(trx)) > 0: return False
+
+        zero_inputs = len(trx["vin"]) == 0
+        fragments   = tx.spendable_inputs(trx, pending_fragments(trx))
+        if fragments == False: return False
+        if tx.validate_values(trx, fragments, zero_inputs) == False: return False
+
+    except Exception as err:
+        logging.debug('revalidate: exception: ' + str(err))
+        return False
+
+    return True
+
+
+def load_mempool(filepath: "string" = None, now: "integer" = None) -> "integer or False":
+    """
+    reloads a saved mempool. The transactions are revalidated in admission
+    order, so a transaction is revalidated after the mempool transactions
+    whose outputs it spends. Expired transactions are removed.
+    Returns the number of transactions that are reloaded or False if the
+    file cannot be read.
+    """
+    try:
+        if filepath == None: filepath = hconfig.conf["MEMPOOL_FILE"]
+        if now == None: now = int(time.time())
+
+        f = open(filepath, 'rb')
+        records = pickle.load(f)
+        f.close()
+
+        for record in records:
+            if record["tx"]["transactionid"] in mempool: continue
+            if revalidate(record["tx"]) == False: continue
+            add_transaction(record["tx"], now, record)
+
+        expire_transactions(now)
+
+    except Exception as err:
+        logging.debug('load_mempool: exception: ' + str(err))
+        return False
+
+    logging.debug('load_mempool: reloaded %d of %d transactions', len(mempool), len(records))
+    return len(mempool)
+
+
+def clear():
+    """
+    removes all of the transactions from the mempool
+    """
+    global total_size, changes_overflow
+
+    mempool.clear()
+    spent_index.clear()
+    changes.clear()
+    changes_overflow = True
+    fee_heap.clear()
+    eviction_heap.clear()
+    timelock_heap.clear()
+    total_size = 0
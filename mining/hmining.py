@@ -9,6 +9,9 @@ import blk_index
 import hconfig
 import hblockchain as bchain
 import hchaindb
+import hmempool
+import hpow
+import hsubsidy
 import networknode
 import rcrypt
 import tx
@@ -35,11 +38,6 @@ address list of nodes on the Helium network
 address_list = []
 
 
-"""
-   specify a list container to hold transactions which are received by the miner. 
-"""
-mempool       = []
-
 """
   blocks mined by other miners which are received by this mining node
   and are to intended to be appended to this miner's blockchain.
@@ -47,20 +45,48 @@ mempool       = []
 received_blocks = []
 
 """
-   blocks which are received and cannot be added to the head of the blockchain 
-   or the parent of the block at the head of the blockchain.
+   blocks which are received and cannot be attached to the block tree because
+   their parent block has not been received. An orphan block is keyed by its
+   block header hash:
+
+        {"block": <block>, "time": <time received>}
+
+   The orphans are held in the order in which they are received. 
+   orphan_children maps a prevblockhash to the header hashes of the orphan
+   blocks that are waiting for that parent.
 """   
-orphan_blocks = []
+orphan_blocks   = {}
+orphan_children = {}
 
 """
-list of transactions to be removed from memcache because they are part of a
-block that has been mined
-"""   
-remove_list = []
+   the block header hashes of the blocks which have been received and of the
+   blocks which have been rejected as invalid, oldest first. A block in 
+   either of them is dropped as soon as it is received.
+"""
+seen_blocks     = {}
+rejected_blocks = {}
 
 
 semaphore = threading.Semaphore()
 
+"""
+the public key which receives the mining rewards and the transaction fees.
+One key pair is made for a mining session.
+"""
+miner_pubkey = None
+
+"""
+the long-lived block template which is mined. The template is rebuilt when
+the tip of the blockchain changes and is otherwise updated incrementally
+from the mempool change log:
+
+    "block":         the candidate block or None
+    "prevblockhash": the header hash of the block that the template extends
+    "sizes":         txid -> mempool size of each template transaction
+    "space":         the number of bytes left for transactions
+"""
+template = {"block": None, "prevblockhash": None, "sizes": {}, "space": 0}
+
 
 def mining_reward(block_height:"integer") -> "non-negative integer":
     """
@@ -70,28 +96,13 @@ def mining_reward(block_height:"integer") -> "non-negative integer":
     The reward depends on the number of blocks that have been mined so far. 
     The initial reward  is hconfig.conf["MINING_REWARD"] coins. 
     This reward halves every hconfig.conf["REWARD_INTERVAL"] blocks.
+    See hsubsidy for the subsidy schedule.
     """
 
     try:
-        # there is no reward for the genesis block
-        sz = block_height 
-        sz = sz // hconfig.conf["REWARD_INTERVAL"]
-        if sz == 0:  return hconfig.conf["MINING_REWARD"] 
-
-        # determine the mining reward
-        reward = hconfig.conf["MINING_REWARD"]
-        for __ctr in range(0,sz):
-            reward = reward/2
-        
-        # truncate to an integer
-        reward = int(round(reward))  
-
-        # the mining reward cannot be less than the lowest denominated 
-        # currency unit 
-        if reward < hconfig.conf["HELIUM_CENT"]: return 0
+        reward = hsubsidy.block_subsidy(block_height)
             
     except Exception as err:
-        print(str(err))
         logging.debug('mining reward: exception: ' + str(err))
         return -1
 
@@ -107,11 +118,11 @@ def receive_transaction(transaction: "dictionary") -> "bool":
     #     it already exists in the mempool
     #     it exists in the Chainstate
     #     it is invalid
+    #     it conflicts with mempool transactions that it cannot replace
 
     try:
         # if the transaction is in the mempool, return
-        for trans in mempool:
-            if trans == transaction: return False
+        if hmempool.contains(transaction["transactionid"]): return False
 
         # do not add the transaction if it has been accounted for in
         # the chainstate database.
@@ -120,15 +131,18 @@ def receive_transaction(transaction: "dictionary") -> "bool":
         if hchaindb.get_transaction(tx_fragment_id) != False:
             return True
 
-        # verify that the incoming transaction is valid
+        # verify that the incoming transaction is valid against the
+        # chainstate and the mempool, and add it to the mempool.
+        # the transaction is not added if it is invalid, if it is a 
+        # conflicting spend or if it is evicted by a full mempool
+        # the mining thread reads and changes the mempool under the semaphore
         if len(transaction["vin"]) >  0: zero_inputs = False
         else: zero_inputs = True
-        if tx.validate_transaction(transaction, zero_inputs) == False:
+        with semaphore:
+            accepted = hmempool.accept_transaction(transaction, zero_inputs)
+        if accepted == False:
             raise(ValueError("invalid transaction received"))
 
-        # add the transaction to the mempool
-        mempool.append(transaction)
-
         
         # place the transaction on the P2P network for further
         # propagation
@@ -156,11 +170,11 @@ async def make_candidate_block() -> "dictionary || bool":
     try:
         # if the mempool is empty then no transactions can be put into 
         # the candidate block
-        if len(mempool) == 0: return False
+        if len(hmempool.mempool) == 0: return False
         
-        # make a public-private key pair that the miner will use to receive
-        # the mining reward as well as the transaction fees.
-        key_pair = make_miner_keys()
+        # get the public key that the miner uses to receive the mining 
+        # reward as well as the transaction fees.
+        pubkey = get_miner_pubkey()
 
         block = {}
 
@@ -208,28 +222,27 @@ async def make_candidate_block() -> "dictionary || bool":
         now = int(time.time())
 
 
-        # add transactions from the mempool to the candidate block until 
-        # the transactions in the mempool are exhausted or the block
-        # attains it's maximum permissible size
-        for memtx in mempool:
-                # do not process future transactions
-                if memtx['locktime'] > now: continue
+        # add the best paying transactions from the mempool to the candidate 
+        # block until the transactions in the mempool are exhausted or the 
+        # block attains it's maximum permissible size. Future transactions
+        # are not processed. The mempool transactions are copied so that
+        # the fee output is not added to the mempool transaction.
+        space   = hconfig.conf['MAX_BLOCK_SIZE'] - block_size
+        entries = hmempool.select_transactions(space, now)
 
-                memtx = add_transaction_fee(memtx, key_pair[1])
+        template["sizes"] = {}
+        for entry in entries:
+                block['tx'].append(template_transaction(entry, pubkey))
+                template["sizes"][entry["tx"]["transactionid"]] = entry["size"]
+                space -= entry["size"]
 
-                # add the transaction to the candidate block
-                block_size += sys.getsizeof(memtx)
-                if block_size <= hconfig.conf['MAX_BLOCK_SIZE']:
-                     block['tx'].append(memtx)
-                     remove_list.append(memtx)
-                else:
-                     break     
+        template["space"] = space
 
         # return if there are no transactions in the block
         if len(block["tx"]) == 0: return False
 
         # add a coinbase transaction
-        coinbase_tx = make_coinbase_transaction(block['height'], key_pair[1])
+        coinbase_tx = make_coinbase_transaction(block['height'], pubkey)
         block['tx'].insert(0, coinbase_tx)
 
         # update the length of the block
@@ -259,12 +272,127 @@ async def make_candidate_block() -> "dictionary || bool":
     return block
 
 
+def get_miner_pubkey() -> "string":
+    """
+    returns the public key of the mining session. The key pair is made 
+    the first time that it is needed.
+    """
+    global miner_pubkey
+
+    if not miner_pubkey: miner_pubkey = make_miner_keys()
+    return miner_pubkey
+
+
+def template_transaction(entry: "dictionary", pubkey: "string") -> "dictionary":
+    """
+    returns a copy of a mempool transaction which pays its cached fee to 
+    the miner. The fee output is not added to the mempool transaction.
+    """
+    memtx = dict(entry["tx"])
+    memtx["vout"] = list(memtx["vout"])
+    return add_transaction_fee(memtx, pubkey, entry["fee"])
+
+
+async def update_template(now: "integer" = None) -> "dictionary || bool":
+    """
+    brings the block template up to date and returns the template block, 
+    or False if there is no block to mine. 
+    The template is rebuilt by make_candidate_block when the tip changes.
+    Otherwise the mempool changes since the last update are applied: 
+    transactions which have left the mempool are removed and new 
+    transactions are appended while they fit, after their mempool parents. 
+    The template is not revalidated since its transactions were validated 
+    when they entered the mempool. The cost of an update depends on the 
+    size of the template and not on the size of the mempool.
+    The template is updated under the semaphore since the RPC threads change
+    the mempool and the blockchain.
+    """
+    try:
+        with semaphore:
+            if now == None: now = int(time.time())
+
+            if len(bchain.blockchain) > 0:
+                tip = bchain.blockheader_hash(bchain.blockchain[-1])
+            else:
+                tip = ""
+
+            hmempool.release_transactions(now)
+            hmempool.expire_transactions(now)
+            changes = hmempool.drain_changes()
+
+            if template["block"] == None or template["prevblockhash"] != tip or changes == None:
+                template["block"] = None
+                block = await make_candidate_block()
+                if block == False: return False
+
+                template["block"] = block
+                template["prevblockhash"] = tip
+                return block
+
+            if len(changes) == 0: return template["block"]
+
+            block  = template["block"]
+            sizes  = template["sizes"]
+            pubkey = get_miner_pubkey()
+            added  = []
+
+            for kind, txid in changes:
+                if kind == "remove":
+                    if txid in sizes:
+                        template["space"] += sizes.pop(txid)
+                    continue
+
+                entry = hmempool.mempool.get(txid)
+                if txid in sizes or entry == None or entry["locked"]: continue
+                if len(hmempool.parents(entry["tx"]) - set(sizes)) > 0: continue
+                if entry["size"] > template["space"]: continue
+
+                added.append(template_transaction(entry, pubkey))
+                sizes[txid] = entry["size"]
+                template["space"] -= entry["size"]
+
+            # keep the coinbase transaction and the transactions still in the template
+            transactions = [trx for trx in block["tx"][1:] if trx["transactionid"] in sizes]
+            transactions = [block["tx"][0]] + transactions + added
+            if len(transactions) == 1:
+                template["block"] = None
+                return False
+
+            block = dict(block)
+            block["tx"] = transactions
+            block["timestamp"] = now
+            block["merkle_root"] = bchain.merkle_root(block["tx"], True)
+            template["block"] = block
+
+    except Exception as err:
+        logging.debug('update_template: exception: ' + str(err))
+        template["block"] = None
+        return False
+
+    return block
+
+
+def current_header() -> "dictionary || bool":
+    """
+    returns the header of the template block, which is the part of the
+    block that is hashed by the proof of work, or False if there is no
+    template block
+    """
+    block = template["block"]
+    if block == None: return False
+
+    return {"version": block["version"], "prevblockhash": block["prevblockhash"],
+            "merkle_root": block["merkle_root"], "timestamp": block["timestamp"],
+            "difficulty_bits": block["difficulty_bits"], "nonce": block["nonce"],
+            "height": block["height"]}
+
+
 def make_miner_keys():
     """
     makes a public-private key pair that the miner will use to receive
     the mining reward and the transaction fee for each transaction.
-    This function writes the  keys to a file and returns hash: 
-    RIPEMD160(SHA256(public key))
+    This function writes the  keys to a file and returns the public key.
+    The rewards and fees are paid to RIPEMD160(SHA256(public key))
     """
 
     try:
@@ -272,9 +400,6 @@ def make_miner_keys():
         privkey = keys[0]
         pubkey  = keys[1]
 
-        pkhash  = rcrypt.make_SHA256_hash(pubkey)
-        mdhash  = rcrypt.make_RIPEMD160_hash(pkhash)
-
         # write the keys to file with the private key as a hexadecimal string
         f = open('coinbase_keys.txt', 'a')
         f.write(privkey)
@@ -285,28 +410,31 @@ def make_miner_keys():
 
     except Exception as err:
         logging.debug('make_miner_keys: exception: ' + str(err))
+        return False
 
-    return mdhash
+    return pubkey
 
 
-def add_transaction_fee(trx: 'dictionary', pubkey: 'string') -> 'dictionary':
+def add_transaction_fee(trx: 'dictionary', pubkey: 'string', fee: 'integer' = None) -> 'dictionary':
     """
     add_transaction_fee directs the transaction fee of a transaction to 
     the miner.
-    receives a transaction and a miner's public key.
+    receives a transaction, a miner's public key and optionally the fee 
+    that the mempool computed when the transaction was admitted.
     amends and returns the transaction so that it consumes the transaction fee.
     """
 
     try:
-        # get the previous transaction fragments
-        prev_fragments = []
+        if fee == None:
+            # get the previous transaction fragments
+            prev_fragments = []
 
-        for vin in trx["vin"]:
-            fragment_id = vin["txid"] + "_" + str(vin["vout_index"])
-            prev_fragments.append(hchaindb.get_transaction(fragment_id))
+            for vin in trx["vin"]:
+                fragment_id = vin["txid"] + "_" + str(vin["vout_index"])
+                prev_fragments.append(hchaindb.get_transaction(fragment_id))
 
-        #  Calculate the transaction fee
-        fee = tx.transaction_fee(trx, prev_fragments)
+            #  Calculate the transaction fee
+            fee = tx.transaction_fee(trx, prev_fragments)
 
         if fee > 0:
             vout = {}
@@ -376,18 +504,10 @@ def make_coinbase_transaction(block_height: "integer", pubkey: "string") -> 'dic
 
 def remove_mempool_transactions(block: 'dictionary') -> "bool":
     """
-    removes the transactions in the candidate block from the mempool
+    removes the transactions in the candidate block from the mempool.
+    Called with the semaphore held
     """
-    try:
-        for transaction in block["tx"]:
-            if transaction in mempool:
-                mempool.remove(transaction)  
-
-    except Exception as err:
-        logging.debug('remove_mempool_transactions: exception: ' + str(err))
-        return False
-
-    return True
+    return hmempool.remove_block_transactions(block)
 
 
 async def mine_block(candidate_block: 'dictionary') -> "bool":
@@ -396,35 +516,23 @@ async def mine_block(candidate_block: 'dictionary') -> "bool":
     Returns the solution nonce as a hexadecimal string if the block is 
     mined and False otherwise
  
-    Executes in a Python thread 
+    The proof of work is computed by the worker processes of the hpow engine
+    and is run in an executor so that the event loop is not blocked.
+    Mining is cancelled when a new block is added to the blockchain.
     """
 
     try:
-        final_nonce = None
+        # the block is mined at the expected target of a child of the tip.
+        # The workers stop when a received block is added to the blockchain
+        target = mining_target(candidate_block["prevblockhash"])
+        loop = asyncio.get_running_loop()
+        final_nonce = await loop.run_in_executor(None, hpow.mine, candidate_block, None, target)
+        # a solution nonce can be zero
+        if final_nonce is False: return False
+
+        # the miner stores the solved block which it propagates
+        candidate_block['nonce'] = final_nonce
         save_block = dict(candidate_block)
-
-        # Loop until block is mined
-        while True:
-            # compute the SHA-256 hash for the block header of the candidate block
-            hash = bchain.blockheader_hash(candidate_block)
-            # convert the SHA-256 hash string to a Python integer
-            mined_value = int(hash, 16)
-            mined_value = 1/mined_value
-        
-            # test to determine whether the block has been mined
-            if mined_value < hconfig.conf["DIFFICULTY_NUMBER"]:
-                final_nonce = candidate_block["nonce"]
-                break
-
-            with semaphore:
-                if len(received_blocks) > 0:
-                    if compare_transaction_lists(candidate_block) == False: 
-                        return False
-
-            # failed to mine the block so increment the 
-            # nonce and try again
-            candidate_block['nonce'] += 1
-
         logging.debug('mining.py: block has been mined')
 
         # add block to the miner's blockchain
@@ -443,6 +551,17 @@ async def mine_block(candidate_block: 'dictionary') -> "bool":
     return hex(final_nonce)
 
 
+def mining_target(prevblockhash: 'string') -> 'integer':
+    """
+    returns the expected target of a block whose parent has the header hash
+    prevblockhash, see hblockchain.child_target. The initial 
+    DIFFICULTY_TARGET is returned if the expected target is not known.
+    """
+    target = bchain.child_target(prevblockhash)
+    if target == None: target = hconfig.conf["DIFFICULTY_TARGET"]
+    return target
+
+
 def proof_of_work(block):
     """
     Proves whether a received block has in fact been mined.
@@ -452,14 +571,10 @@ def proof_of_work(block):
         if block['difficulty_bits'] != hconfig.conf["DIFFICULTY_BITS"]:
             raise(ValueError("wrong difficulty bits used"))
 
-        # compute the SHA-256 hash for the block header of the candidate block
-        hash = bchain.blockheader_hash(block)
-        # convert the SHA-256 hash string to a Python integer to base 10
-        mined_value = int(hash, 16)
-        mined_value = 1/mined_value
-
-        # test to determine whether the block has been mined
-        if mined_value < hconfig.conf["DIFFICULTY_NUMBER"]: return True
+        # compare the raw SHA-256 digest of the block header with the 
+        # expected target of the block
+        limit = hpow.target_limit(mining_target(block["prevblockhash"]))
+        if hpow.meets_target(hpow.header_digest(block), limit): return True
 
     except Exception as err:
         logging.debug('proof_of_work: exception: ' + str(err))
@@ -468,67 +583,97 @@ def proof_of_work(block):
     return False
 
 
+def remember_block(blocks: 'dictionary', blkhash: 'string', limit: 'integer'):
+    """
+    adds a block header hash to seen_blocks or rejected_blocks and forgets
+    the oldest hashes if there are more than limit hashes
+    """
+    blocks[blkhash] = True
+
+    # the hashes are held oldest first
+    while len(blocks) > limit:
+        del blocks[next(iter(blocks))]
+
+
+def known_block(blkhash: 'string') -> 'bool':
+    """
+    tests whether a block has been received, rejected, added to the block
+    tree or is an orphan block
+    """
+    return blkhash in rejected_blocks or blkhash in seen_blocks or \
+           blkhash in bchain.block_tree or blkhash in orphan_blocks
+
+
 def receive_block(block):
     """
     Maintains the received_blocks list. 
     Receives a block and returns False if:
 
-    (1)  the block is invalid
+    (1)  the block has already been received or rejected, is in the block
+         tree or is an orphan block
     (2)  the block height is less than (blockchain height - 2)
-    (3)  block height > (blockchain height + 1)
-    (4)  the proof of work fails
-    (5)  the block does not contain at least two transactions
-    (6)  the first block transaction is not a coinbase transaction
-    (7)  transactions in the block are invalid
-    (8)  block is already in the blockchain
-    (9)  the block is already in the received_blocks list
+    (3)  the proof of work of the block header fails
+    (4)  the block header is invalid
     
-    Otherwise (i)  adds the block to the received_blocks list
-             (ii) propagates the block
+    Otherwise the block header is added to the header index and:
+
+         (i)   if the header is on the best header chain, the block and any
+               held blocks of the chain which are not in the block tree, up 
+               to the best header, are added to the received_blocks list; 
+               see queue_held_blocks. The block bodies are validated when 
+               they are added to the blockchain.
+         (ii)  otherwise the block body is held in the header index without
+               being validated.
+         (iii) the block is propagated
+
+    A block whose parent is not known, for example a block which is 
+    received ahead of its parent, is held in the bounded orphan pool.
+
+    The already known test costs one header hash and a few dictionary 
+    lookups, so duplicate blocks are dropped before the proof of work and 
+    header validation. A block which fails the proof of work or the header
+    validation, or which descends from a block whose body is invalid, is
+    remembered in rejected_blocks.
     
     Executes in a python thread
     """
   
     try:
-        # test if block is already in the received_blocks list
-        with semaphore:
-            for blk in received_blocks:
-                if blk == block: return False
-    
-        # verify the proof of work
-        if proof_of_work(block) == False:
-            raise(ValueError("block proof of work failed"))
+        blkhash = bchain.blockheader_hash(block)
 
-        # reset the nonce to its initial value
-        block["nonce"] == hconfig.conf["NONCE"]
-
-        # validate the block
-        if bchain.validate_block(block) == False: return False
+        # test if the block is already known
+        with semaphore:
+            if known_block(blkhash) == True: return False
 
         if len(bchain.blockchain) > 0:
             # do not add stale blocks to the blockchain
             if block["height"] < bchain.blockchain[-1]["height"] - 2:
                 raise(ValueError("block height too old"))
 
-            # do not add blocks that are too distant into the future
-            if block["height"] > bchain.blockchain[-1]["height"] + 1:
-                raise(ValueError("block height beyond future"))
-
-        # test if block is in the primary or secondary blockchains
-        if len(bchain.blockchain) > 0:
-            if block == bchain.blockchain[-1]: return False          
-    
-        if len(bchain.blockchain) > 1:
-          if block == bchain.blockchain[-2]: return False          
-        
-        if len(bchain.secondary_blockchain) > 0:
-            if block == bchain.secondary_blockchain[-1]: return False          
+        # verify the proof of work and validate the block header
+        header = bchain.block_header(block)
+        if proof_of_work(header) == False or bchain.validate_header(header) == False:
+            with semaphore:
+                remember_block(rejected_blocks, blkhash, hconfig.conf["MAX_REJECTED_BLOCKS"])
+            raise(ValueError("block header proof of work or validation failed"))
 
-        if len(bchain.secondary_blockchain) > 1:
-            if block == bchain.secondary_blockchain[-2]: return False          
+        with semaphore:
+            if known_block(blkhash) == True: return False
+            remember_block(seen_blocks, blkhash, hconfig.conf["MAX_SEEN_BLOCKS"])
 
-        # add the block to the blocks_received list
-        received_blocks.append(block)
+            # a block whose parent is not known is processed as an orphan
+            if header["height"] > 0 and bchain.header_parent(header) == None:
+                received_blocks.append(block)
+            else:
+                node = bchain.insert_header(header, blkhash)
+                if node["invalid"] == True:
+                    remember_block(rejected_blocks, blkhash, hconfig.conf["MAX_REJECTED_BLOCKS"])
+                    raise(ValueError("block descends from an invalid block"))
+                node["block"] = block
+
+                # only the blocks of the best header chain are validated
+                if bchain.on_best_header_chain(blkhash) == False or queue_held_blocks(blkhash) == 0:
+                    logging.debug('receive_block: holding a block which cannot be connected yet')
     
         process_received_blocks()
 
@@ -556,27 +701,14 @@ def process_received_blocks() -> 'bool':
           if blkhash == block["prevblockhash"] then add the block to the blockchain.
  
 
-     (4)  if the blockchain has at least two blocks, then if:
-             let blk_hash be the hash second-latest block of the blockchain, then if 
-             
-             block["prevblockhash"] == blk_hash
-             
-             create a secondary block consisting of all of the blocks of the blockchain
-             except for the latest. Append the block to the secondary blockchain.
+     (4)  if the parent of the block is in the block tree, the block is added to 
+          a competing branch. If the branch now has more cumulative work than the 
+          blockchain, the blockchain is reorganized onto the branch.
 
-    (5)  Otherwise move the block to the orphans list.      
+     (5)  Otherwise move the block to the orphans list.      
                 
-    (6)  If the received block was attached to a blockchain, for each block in the orphans
-         list, try  to attach the orphan block to the primary blockchain or the secondary
-         blockchain if it exists.
- 
-    (7) If the received block was attached to a blockchain and the secondary blockchain has
-        elements then swap the blockchain and the secondary blockchain if the length of the
-        secondary blockchain is greater.   
- 
-   (8)  if the receive block was attached and the secondary blockchain has elements then
-        clear the secondary blockchain if its length is more than two blocks behind the
-        primary blockchain.
+     (6)  If the received block was attached to the block tree, connect the orphan
+          blocks which descend from it.
   
     Note: Runs In A Python thread 
     """
@@ -590,148 +722,226 @@ def process_received_blocks() -> 'bool':
         else:
             return True
 
-        # add it to the primary blockchain
+        # add it to the blockchain or to a competing branch
         with semaphore:
-            if bchain.add_block(block) == True:
-                logging.debug('receive_mined_block: block added to primary blockchain')
-                add_flag = True
-            
+            connected = connect_block(block)
 
-            # test whether the primary blockchain must be forked                
-            # if the previous block hash is equal to the hash of the parent block of the
-            # block at the head of the blockchain add the block as a child of the parent and
-            # create a secondary blockchain. This constitutes a fork of the primary
-            # blockchain        
-            elif len(bchain.blockchain) >= 2 and  block['prevblockhash'] == bchain.blockheader_hash(bchain.blockchain[-2]):
-                logging.debug('receive_mined_block: forking the blockchain')
-                fork_blockchain(block)
-                if bchain.add_block(block) == True:
-                    logging.debug('receive_mined_block: block added to blockchain')
-                    add_flag = True
-
-
-            # add it to the secondary blockchain
-            elif len(bchain.secondary_blockchain) > 0 and block['prevblockhash'] == bchain.blockheader_hash(bchain.secondary_blockchain[-1]):
-                swap_blockchains()
-                if bchain.add_block(block) == True:
-                    logging.debug('receive_mined_block: block added to blockchain')
-                    add_flag = True
-
-            # cannot attach the block to a blockchain, place it in the orphans list
-            else:
-                orphan_blocks.append(block)
+            # cannot attach the block to the block tree, place it in the orphans list
+            if connected == False:
+                add_orphan(block)
+            elif len(connected) > 0:
+                logging.debug('receive_mined_block: block added to blockchain')
+                add_flag = True
 
         if add_flag == True:
-            if block["height"] % hconfig.conf["RETARGET_INTERVAL"] == 0:
-                retarget_difficulty_number(block)
-            handle_orphans()
-            swap_blockchains()
+            # cancel the mining of the current candidate block
+            hpow.new_tip()
 
-            # remove any transactions in this block that are also
+            # remove any transactions in the connected blocks that are also
             # in the the mempool
             with semaphore:
-                remove_mempool_transactions(block)
+                for connected_block in connected:
+                    remove_mempool_transactions(connected_block)
+
+        # connect the orphan blocks that are waiting for this block
+        if connected != False:
+            handle_orphans(bchain.blockheader_hash(block))
 
         propagate_mined_block(block)
 
     return True
 
 
-def fork_blockchain(block: 'list') -> 'bool':
-
+def connect_block(block: 'dictionary') -> 'list or bool':
     """
-    forks the primary blockchain and creates a secondary blockchain from 
-    the primary blockchain and then adds the received block to the secondary block
+    attaches a block to the block tree.
+    A block which extends the blockchain is added to it. A block whose parent
+    is elsewhere in the block tree starts or extends a competing branch. If
+    that branch has more cumulative work than the blockchain, the blockchain 
+    is reorganized onto the branch; a branch with equal work does not replace
+    the blockchain.
+    Returns the list of blocks added to the blockchain, which is empty if the
+    block is only added to a competing branch or is invalid. An invalid block
+    is rejected, see reject_block. Returns False if the parent of the block 
+    is not in the block tree.
     """
     try:
-        bchain.secondary_blockchain = list(bchain.blockchain[0:-1])
-        bchain.secondary_blockchain.append(block)
-    
-        # switch the primary and secondary blockchain if required
-        swap_blockchains()
+        if bchain.add_block(block) == True: return [block]
+
+        parent = block['prevblockhash']
+        if parent not in bchain.block_tree: return False
+
+        blkhash = bchain.blockheader_hash(block)
+        if parent == bchain.best_tip: 
+            reject_block(blkhash)
+            return []
+
+        node = bchain.insert_node(block, blkhash)
+        if node["work"] <= bchain.tip_work(): 
+            logging.debug('connect_block: block added to a competing branch')
+            return []
+
+        connected = bchain.reorganize(blkhash)
+        if connected == False:
+            del bchain.block_tree[blkhash]
+            reject_block(blkhash)
+            return []
 
     except Exception as err:
-        logging.debug('fork_blockchain: exception: ' + str(err))
-        return False
+        logging.debug('connect_block: exception: ' + str(err))
+        return []
 
-    return True
+    return connected
 
 
-def swap_blockchains() -> 'bool':
+def reject_block(blkhash: 'string'):
     """
-    compares the length of the primary and secondary blockchains.
-    The longest blockchain is designated as the primary blockchain and the other
-    blockchain is designated as the secondary blockchain.
-    if the primary blockchain is ahead of the secondary blockchin by at least 
-    two blocks then clear the secondary blockchain.
+    rejects a block whose header is valid but whose body failed validation.
+    The block is remembered in rejected_blocks and its header and the headers
+    which descend from it are marked as invalid, which moves best_header to
+    the valid header chain with the most cumulative work. The held blocks of
+    that chain are added to the received_blocks list.
+    Called with the semaphore held
     """
+    logging.debug('reject_block: block body failed validation')
+    remember_block(rejected_blocks, blkhash, hconfig.conf["MAX_REJECTED_BLOCKS"])
+    if bchain.invalidate_header(blkhash) == False: return
 
+    queue_held_blocks(bchain.best_header)
+
+
+def queue_held_blocks(blkhash: 'string') -> 'integer':
+    """
+    adds the held blocks of the best header chain which can be connected 
+    to the received_blocks list. blkhash is a header on the best header 
+    chain whose body has been received. The held blocks up to the best 
+    header are added if every body on the chain has been received, otherwise
+    the held blocks up to blkhash are added. A held block whose parent body
+    arrives late is then connected with its parent.
+    Returns the number of blocks added. Called with the semaphore held
+    """
+    blocks = bchain.best_chain_blocks(bchain.best_header)
+    if blocks == False: blocks = bchain.best_chain_blocks(blkhash)
+    if blocks == False: return 0
+
+    # received_blocks is processed last in first out
+    for held_block in reversed(blocks):
+        bchain.header_index[bchain.blockheader_hash(held_block)]["block"] = None
+        received_blocks.append(held_block)
+
+    return len(blocks)
+
+
+def add_orphan(block: 'dictionary', now: 'integer' = None) -> 'bool':
+    """
+    adds a block whose parent is not in the block tree to the orphan blocks.
+    Stale orphans are evicted and the oldest orphans are evicted if there are
+    more than MAX_ORPHAN_BLOCKS orphans.
+    Returns True if the block is in the orphan blocks
+    """
     try:
-        # if the secondary blockchain is longer than the primary blockchain
-        # designate the secondary blockchain as the primary blockchain
-        # and the primary blockchain as the secondary blockchain 
-        if len(bchain.secondary_blockchain) >= len(bchain.blockchain):
-            tmp = list(bchain.blockchain)
-            bchain.blockchain = list(bchain.secondary_blockchain)
-            bchain.secondary_blockchain = list(tmp)
-
-        # if the primary blockchain is ahead of the secondary blockchain by
-        # at least two blocks then clear the secondary blockchain
-        if len(bchain.blockchain) - len(bchain.secondary_blockchain) > 2:
-            bchain.secondary_blockchain.clear()
+        if now == None: now = int(time.time())
+        blkhash = bchain.blockheader_hash(block)
+        if blkhash in orphan_blocks: return True
+
+        orphan_blocks[blkhash] = {"block": block, "time": now}
+        orphan_children.setdefault(block["prevblockhash"], []).append(blkhash)
+
+        evict_orphans(now)
 
     except Exception as err:
-        logging.debug('swap_blockchains: exception: ' + str(err))
+        logging.debug('add_orphan: exception: ' + str(err))
         return False
 
-    return True
+    return blkhash in orphan_blocks
+
+
+def remove_orphan(blkhash: 'string') -> 'dictionary or None':
+    """
+    removes an orphan block and returns it. Returns None if there is no
+    orphan block with the block header hash
+    """
+    entry = orphan_blocks.pop(blkhash, None)
+    if entry == None: return None
+
+    parent   = entry["block"]["prevblockhash"]
+    children = orphan_children.get(parent, [])
+    if blkhash in children: children.remove(blkhash)
+    if len(children) == 0: orphan_children.pop(parent, None)
+
+    return entry["block"]
 
 
-def handle_orphans() -> "bool":
+def evict_orphans(now: 'integer' = None) -> 'integer':
     """
-    tries to attach an orphan block to the head of the primary or secondary blockchain.
-    Sometimes blocks are received out of order and cannot be attached to the primary 
-    or secondary blockchains. These blocks are placed in an orphan_blocks list and as
-    new blocks are added to the primary or secondary blockchains, an attempt is made to
-    add orphaned  blocks to the blockchain(s).
+    removes orphan blocks which have expired, which are two or more blocks
+    behind the head of the blockchain or which exceed MAX_ORPHAN_BLOCKS, 
+    oldest first. Returns the number of orphans removed
+    """
+    if now == None: now = int(time.time())
+    expiry = now - hconfig.conf["ORPHAN_EXPIRY"]
+    height = None
+    if len(bchain.blockchain) > 0: height = bchain.blockchain[-1]["height"]
+
+    stale = []
+    for blkhash, entry in orphan_blocks.items():
+        if entry["time"] < expiry: 
+            stale.append(blkhash)
+        elif height != None and height >= 3 and height - entry["block"]["height"] >= 2:
+            stale.append(blkhash)
+
+    for blkhash in stale:
+        remove_orphan(blkhash)
+
+    # the orphans are held oldest first
+    excess = 0
+    while len(orphan_blocks) > hconfig.conf["MAX_ORPHAN_BLOCKS"]:
+        remove_orphan(next(iter(orphan_blocks)))
+        excess += 1
+
+    return len(stale) + excess
+
+
+def handle_orphans(blkhash: 'string' = None) -> "bool":
+    """
+    connects the orphan blocks that descend from a block which has been 
+    added to the block tree. blkhash is the block header hash of this block
+    and defaults to the head of the blockchain. 
+    Sometimes blocks are received out of order and cannot be attached to the 
+    block tree. These blocks are held in orphan_blocks. When a block is 
+    attached, its waiting children are found in orphan_children and connected,
+    and then their children, and so on. Stale orphans are evicted.
     """
     try:
-        # iterate through the orphan blocks attempting to append an orphan
-        # block to a blockchain
-        if len(bchain.blockchain) == 0: return
-        # try to append to the primary blockchain
-        for block in orphan_blocks:
-            if block['prevblockhash'] == bchain.blockheader_hash(bchain.blockchain[-1]):
-                if block["height"] == bchain.blockchain[-1]["height"] + 1:
-                    bchain.blockchain.append(block)
-                    orphan_blocks.remove(block)
-
-                    # remove this orphan blocks transactions from the mempool
-                    with semaphore:
-                        remove_mempool_transactions(block)
-
-        # try to append to the secondary blockchain
-        if len(bchain.secondary_blockchain) > 0:
-            for block in orphan_blocks:
-                if block['prevblockhash'] == bchain.blockheader_hash(bchain.secondary_blockchain[-1]):
-                    if block["height"] == bchain.secondary_blockchain[-1]["height"] + 1:
-                        bchain.secondary_blockchain.append(block)
-                        orphan_blocks.remove(block)
-                        
-                        # remove this blocks transactions from the mempool
-                        with semaphore:
-                            remove_mempool_transactions(block)
-
-        # remove stale orphaned blocks
-        for block in orphan_blocks:
-            if bchain.blockchain[-1]["height"] >=3:
-                    if bchain.blockchain[-1]["height"] - block["height"] >= 2: orphan_blocks.remove(block)  
+        if blkhash == None: blkhash = bchain.best_tip
+        tip_changed = False
+
+        parents = [blkhash]
+        while len(parents) > 0:
+            parent = parents.pop()
+
+            for child in list(orphan_children.get(parent, [])):
+                block = remove_orphan(child)
+                with semaphore:
+                    connected = connect_block(block)
+                    if connected == False: continue
+
+                    # remove the transactions of the connected blocks from the mempool
+                    for connected_block in connected:
+                        remove_mempool_transactions(connected_block)
+
+                if len(connected) > 0: tip_changed = True
+                parents.append(child)
+
+        # cancel the mining of the current candidate block
+        if tip_changed == True: hpow.new_tip()
+
+        evict_orphans()
 
     except Exception as err:
         logging.debug('handle_orphans: exception: ' + str(err))
         return False
 
-
     return True
 
 
@@ -750,31 +960,10 @@ def remove_received_block(block: 'dictionary') -> "bool":
     return True
 
 
-def retarget_difficulty_number(block):
-    """
-    recalibrates the difficulty number every hconfig.conf["RETARGET_INTERVAL"] blocks
-    """
-    if block["height"] == 0: return
-
-    old_diff_no   = hconfig.conf["DIFFICULTY_NUMBER"]
-    initial_block = bchain.blockchain[(block["height"] - hconfig.conf["RETARGET_INTERVAL"])]
-    time_initial  = initial_block["timestamp"] 
-    time_now      = block["timestamp"]
-
-    elapsed_seconds = time_now - time_initial 
-    # the average time to mine a block is 600 seconds
-    blocks_expected_to_be_mined = int(elapsed_seconds / 600) 
-    discrepancy = 1000 - blocks_expected_to_be_mined
-
-    hconfig.conf["DIFFICULTY_NUMBER"] =  old_diff_no - \
-        old_diff_no * (20/100)*(discrepancy /(1000 + blocks_expected_to_be_mined)) 
-
-    return
-
-
 def propagate_transaction(txn: "dictionary"):
     """
-    propagates a transaction that is received
+    propagates a transaction that is received. The transaction is sent
+    to every known node concurrently
     """
     if len(address_list) % 20 == 0: get_address_list()
     cmd = {}
@@ -783,17 +972,14 @@ def propagate_transaction(txn: "dictionary"):
     cmd["params"]  = {"trx":txn}
     cmd["id"] = 0
 
-    for addr in address_list:
-        rpc = json.dumps(cmd)
-        networknode.hclient(addr,rpc)
-    
+    networknode.hbroadcast(list(address_list), json.dumps(cmd))
     return
 
 
 def propagate_mined_block(block): 
     """
     sends a block to other mining nodes so that they may add this block
-    to their blockchain. 
+    to their blockchain. The block is sent to every known node concurrently.
     We refresh the list of known node addresses periodically
     """
     if len(address_list) % 20 == 0: get_address_list()
@@ -804,10 +990,7 @@ def propagate_mined_block(block):
     cmd["params"]  = {"block":block}
     cmd["id"] = 0
 
-    for addr in address_list:
-        rpc = json.dumps(cmd)
-        networknode.hclient(addr,rpc)
-
+    networknode.hbroadcast(list(address_list), json.dumps(cmd))
     return
 
 
@@ -828,32 +1011,42 @@ def get_address_list():
     return         
 
 
+def save_mempool() -> "bool":
+    """
+    saves the mempool. The mining thread and the RPC threads change the
+    mempool, so the snapshot of the mempool is taken under the semaphore.
+    The snapshot is written to the file after the semaphore is released.
+    """
+    with semaphore:
+        records = hmempool.snapshot()
+    return hmempool.save_mempool(records=records)
+
+
 def start_mining():
     """
     assemble a candidate block
     then mine this block
+    the mempool is saved every hconfig.conf["MEMPOOL_SAVE_INTERVAL"] seconds
     """
+    saved = time.time()
+
     while True:
-        candidate_block = make_candidate_block()
-        if candidate_block() == False:
+        if time.time() - saved >= hconfig.conf["MEMPOOL_SAVE_INTERVAL"]:
+            save_mempool()
+            saved = time.time()
+
+        # the template block is copied since the miner sets its nonce
+        candidate_block = asyncio.run(update_template())
+        if candidate_block == False:
             time.sleep(1)
             continue
+        candidate_block = dict(candidate_block)
         # remove transactions in the mined block from the mempool
-        if mine_block(candidate_block) != False:
-            remove_mempool_transactions(remove_list)
-        else: time.sleep(1)
-
-
-def compare_transaction_lists(block):
-    """
-    tests whether a transaction in a received block is also in a candidate
-    block that is being mined
-    """      
-    for tx1 in block["tx"]:
-        for tx2 in remove_list:
-            if tx1 == tx2: return False
- 
-    return True        
+        # if a new tip arrived build a fresh candidate block immediately
+        if asyncio.run(mine_block(candidate_block)) != False:
+            with semaphore:
+                remove_mempool_transactions(candidate_block)
+        elif hpow.mining_stats["cancelled"] == False: time.sleep(1)
 
 
 #####################################
@@ -862,10 +1055,16 @@ def compare_transaction_lists(block):
 #####################################
 
 if __name__ == "__main__":
+    # reload the mempool that was saved when the miner stopped
+    hmempool.load_mempool()
+
     #Create the Threads
     t1 = threading.Thread(target=start_mining, args=(), daemon=True)
     t1.start()
-    t1.join()
+    try:
+        t1.join()
+    finally:
+        save_mempool()
 
 
 
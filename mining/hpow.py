@@ -0,0 +1,359 @@
+"""
+hpow.py: the Helium proof of work engine.
+The nonce space of a candidate block is partitioned across a number of worker
+processes. Worker i tests the nonces start + i, start + i + n, start + i + 2n...
+where n is the number of workers. All of the workers stop as soon as one of
+them finds a solution nonce. The engine reports the aggregate hashrate of the
+workers.
+
+Mining is cancelled cooperatively. The tip generation counter is incremented
+when a new block is added to the blockchain. The workers compare it with the
+generation at which they started every CHECK_INTERVAL nonces and stop when it
+has changed. The proof of work loop does not take any locks.
+
+The difficulty is an exact integer target. A block is mined if the SHA-256
+hash of its header, read as a 256-bit big-endian integer, is less than the
+target. The test is done by comparing the raw 32 byte digest against the
+32 byte encoding of (target - 1).
+
+The expected target of every block of a header chain is a function of the
+header timestamps alone and is computed by chain_targets. NumPy is used for
+the timestamp arithmetic if it is installed. The targets themselves are 
+exact Python integers.
+"""
+import hconfig
+import hashlib
+import multiprocessing
+import os
+import queue
+import time
+import pdb
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+log debugging messages to the file debug.log
+"""
+logging.basicConfig(filename="debug.log",filemode="w", format='%(asctime)s:%(levelname)s:%(message)s',
+    level=logging.DEBUG)
+
+
+"""
+the largest nonce that is tested for a candidate block
+"""
+MAX_NONCE = 2**32
+
+"""
+the number of nonces a worker tests between tests of the stop event and
+the tip generation
+"""
+CHECK_INTERVAL = 4096
+
+"""
+the tip generation counter, shared with the worker processes
+"""
+tip_generation = multiprocessing.get_context().Value('Q', 0)
+
+"""
+the interval in seconds at which the engine polls for a solution
+"""
+POLL_INTERVAL = 0.25
+
+"""
+statistics for the last proof of work computation
+"""
+mining_stats = {"hashes": 0, "seconds": 0.0, "hashrate": 0.0, "workers": 0,
+                "cancelled": False}
+
+
+def difficulty_target(difficulty_bits: "integer") -> "integer":
+    """
+    returns the integer target that corresponds to a number of difficulty bits.
+    A hash less than this target has at least difficulty_bits leading zero bits.
+    """
+    return 2 ** (256 - difficulty_bits)
+
+
+def retarget(target: "integer", elapsed_seconds: "integer", 
+             interval: "integer") -> "integer":
+    """
+    returns the target which follows a retargeting interval of interval 
+    blocks that were mined in elapsed_seconds. The target is adjusted by up 
+    to 20% in proportion to the discrepancy between the number of blocks 
+    mined and the number of blocks expected to be mined in the elapsed time.
+    The computation is done in exact integer arithmetic.
+    """
+    # the average time to mine a block is 600 seconds
+    blocks_expected_to_be_mined = max(elapsed_seconds, 0) // 600
+    discrepancy = interval - blocks_expected_to_be_mined
+
+    # target * (1 - (20/100) * discrepancy / (interval + blocks_expected_to_be_mined))
+    denominator = 5 * (interval + blocks_expected_to_be_mined)
+    return max(1, target * (denominator - discrepancy) // denominator)
+
+
+def chain_targets(timestamps: "list", initial_target: "integer" = None,
+                  interval: "integer" = None) -> "list":
+    """
+    returns the expected target of each block of a header chain which starts
+    at the genesis block. timestamps[i] is the timestamp of the block with
+    height i. The target changes after each block whose height is a non-zero
+    multiple of interval, from the time taken to mine the preceding interval
+    blocks.
+    The elapsed times of all of the intervals are computed in one array 
+    operation; the targets are then chained once per interval.
+    """
+    if initial_target == None: initial_target = difficulty_target(hconfig.conf["DIFFICULTY_BITS"])
+    if interval == None: interval = hconfig.conf["RETARGET_INTERVAL"]
+    count = len(timestamps)
+
+    if numpy != None:
+        stamps  = numpy.asarray(timestamps, dtype=numpy.int64)
+        elapsed = (stamps[interval:count - 1:interval] - 
+                   stamps[0:max(count - 1 - interval, 0):interval]).tolist()
+    else:
+        elapsed = [timestamps[height] - timestamps[height - interval] 
+                   for height in range(interval, count - 1, interval)]
+
+    period_targets = [initial_target]
+    for seconds in elapsed:
+        period_targets.append(retarget(period_targets[-1], seconds, interval))
+
+    return [period_targets[max(height - 1, 0) // interval] for height in range(count)]
+
+
+def verify_chain(headers: "list") -> "bool":
+    """
+    tests the proof of work of every header of a header chain which starts at
+    the genesis block against its expected target
+    """
+    targets = chain_targets([header["timestamp"] for header in headers])
+    return all(meets_target(header_digest(header), target_limit(target))
+               for header, target in zip(headers, targets))
+
+
+def target_limit(target: "integer") -> "bytes":
+    """
+    returns the largest 32 byte digest which satisfies a target. A digest 
+    satisfies the target if digest <= target_limit(target). Returns None
+    if no digest can satisfy the target.
+    """
+    if target <= 0: return None
+    return min(target - 1, 2**256 - 1).to_bytes(32, 'big')
+
+
+def meets_target(digest: "bytes", limit: "bytes") -> "bool":
+    """
+    tests whether a raw SHA-256 digest satisfies a target limit
+    """
+    return limit != None and digest <= limit
+
+
+def header_digest(block: "dictionary") -> "bytes":
+    """
+    returns the raw SHA-256 digest of a block header. The hexadecimal form
+    of this digest is hblockchain.blockheader_hash(block).
+    hashlib computes the same SHA-256 digest as rcrypt.
+    """
+    header = header_prefix(block) + str(block['nonce'])
+    return hashlib.sha256(header.encode('ascii')).digest()
+
+
+def header_prefix(block: "dictionary") -> "string":
+    """
+    returns the part of a block header that precedes the nonce. The prefix
+    is constant while a candidate block is mined.
+    See hblockchain.blockheader_hash
+    """
+    return block['version'] + block['prevblockhash'] + block['merkle_root'] + \
+           str(block['timestamp']) + str(block['difficulty_bits'])
+
+
+def number_of_workers() -> "integer":
+    """
+    returns the number of worker processes specified by
+    hconfig.conf["MINING_WORKERS"]. Zero means one worker per core.
+    """
+    workers = hconfig.conf["MINING_WORKERS"]
+    if workers <= 0: workers = os.cpu_count() or 1
+    return workers
+
+
+def new_tip() -> "integer":
+    """
+    announces that a new block has been added to the blockchain. Cancels
+    the proof of work computation for the current candidate block.
+    Returns the new tip generation.
+    """
+    with tip_generation.get_lock():
+        tip_generation.value += 1
+        return tip_generation.value
+
+
+def search_nonces(prefix: "string", start: "integer", stride: "integer",
+                  max_nonce: "integer", limit: "bytes",
+                  found: "queue", stop: "event", hashes: "shared integer",
+                  generation: "shared integer", expected: "integer"):
+    """
+    the worker function. Tests the nonces start, start + stride, ... below
+    max_nonce until a solution is found, the stop event is set or the
+    generation counter differs from expected.
+    A solution nonce is put into the found queue and the stop event is set.
+    The number of hashes computed is added to the shared hashes counter.
+
+    The constant header prefix is hashed once into a midstate. Each trial
+    copies the midstate and hashes only the nonce.
+    """
+    nonce = start
+    if limit == None: return
+
+    midstate = hashlib.sha256(prefix.encode('ascii'))
+
+    while nonce < max_nonce and not stop.is_set() and generation.value == expected:
+        end = min(nonce + stride * CHECK_INTERVAL, max_nonce)
+        count = 0
+
+        for trial in range(nonce, end, stride):
+            count += 1
+            header_hash = midstate.copy()
+            header_hash.update(str(trial).encode('ascii'))
+            if header_hash.digest() <= limit:
+                found.put(trial)
+                stop.set()
+                break
+
+        with hashes.get_lock():
+            hashes.value += count
+
+        nonce = end
+
+    return
+
+
+def mine(block: "dictionary", workers: "integer" = None, 
+         target: "integer" = None) -> "integer or False":
+    """
+    searches for a nonce that solves the proof of work for a block, starting
+    at block["nonce"]. The nonce space is partitioned across worker processes.
+    target is the expected target of the block and defaults to the initial
+    DIFFICULTY_TARGET.
+    Returns the solution nonce or False if the search is cancelled by a new
+    tip or the nonce space is exhausted. The block is not modified.
+    Updates mining_stats.
+    """
+    if workers == None: workers = number_of_workers()
+    if target == None: target = hconfig.conf["DIFFICULTY_TARGET"]
+
+    prefix     = header_prefix(block)
+    limit      = target_limit(target)
+    nonce      = False
+    processes  = []
+
+    context = multiprocessing.get_context()
+    found   = context.Queue()
+    stop    = context.Event()
+    hashes  = context.Value('Q', 0)
+
+    expected   = tip_generation.value
+    start_time = time.time()
+
+    try:
+        if workers == 1:
+            search_nonces(prefix, block["nonce"], 1, MAX_NONCE, limit, found, stop, hashes,
+                          tip_generation, expected)
+            if stop.is_set(): nonce = found.get()
+
+        else:
+            for index in range(workers):
+                process = context.Process(target=search_nonces, daemon=True,
+                            args=(prefix, block["nonce"] + index, workers, MAX_NONCE,
+                                  limit, found, stop, hashes, tip_generation, expected))
+                process.start()
+                processes.append(process)
+
+            while True:
+                try:
+                    nonce = found.get(timeout=POLL_INTERVAL)
+                    break
+                except queue.Empty:
+                    pass
+
+                # the nonce space has been exhausted or a new tip has arrived
+                if not any(process.is_alive() for process in processes):
+                    try: nonce = found.get(timeout=POLL_INTERVAL)
+                    except queue.Empty: pass
+                    break
+
+    except Exception as err:
+        logging.debug('mine: exception: ' + str(err))
+        nonce = False
+
+    stop.set()
+    for process in processes:
+        process.join()
+
+    seconds = max(time.time() - start_time, 1e-9)
+    mining_stats["hashes"]   = hashes.value
+    mining_stats["seconds"]  = seconds
+    mining_stats["hashrate"] = hashes.value / seconds
+    mining_stats["workers"]  = workers
+    mining_stats["cancelled"] = (nonce is False and tip_generation.value != expected)
+
+    logging.debug('mine: %d workers, %d hashes, %.0f hashes/sec', workers,
+                  hashes.value, mining_stats["hashrate"])
+
+    return nonce
+
+
+def benchmark(block: "dictionary", trials: "integer" = 200000) -> "dictionary":
+    """
+    measures the single core hashrate of the proof of work inner loop on a
+    block header. "before" is the inner loop which the midstate replaced: it
+    hashes the header prefix followed by the nonce for each nonce and 
+    compares the digest with the target limit. "after" copies the midstate
+    of the header prefix and hashes only the nonce.
+    Returns a dictionary with the hashes per second of each loop.
+    """
+    limit  = target_limit(1)
+    prefix = header_prefix(block)
+    result = {}
+
+    start_time = time.time()
+    for nonce in range(trials):
+        digest = hashlib.sha256((prefix + str(nonce)).encode('ascii')).digest()
+        if digest <= limit: break
+    result["before"] = trials / max(time.time() - start_time, 1e-9)
+
+    start_time = time.time()
+    midstate = hashlib.sha256(prefix.encode('ascii'))
+    for nonce in range(trials):
+        header_hash = midstate.copy()
+        header_hash.update(str(nonce).encode('ascii'))
+        if header_hash.digest() <= limit: break
+    result["after"] = trials / max(time.time() - start_time, 1e-9)
+
+    return result
+
+
+#####################################
+# run the hashrate benchmark:
+# $(virtual) python hpow.py 
+#####################################
+
+if __name__ == "__main__":
+    block = {
+        "version": hconfig.conf["VERSION_NO"],
+        "prevblockhash": "f" * 64,
+        "merkle_root": "e" * 64,
+        "timestamp": int(time.time()),
+        "difficulty_bits": hconfig.conf["DIFFICULTY_BITS"],
+        "nonce": hconfig.conf["NONCE"]
+    }
+
+    rates = benchmark(block)
+    print("before: %.0f hashes/sec" % rates["before"])
+    print("after:  %.0f hashes/sec" % rates["after"])
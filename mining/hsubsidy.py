@@ -0,0 +1,110 @@
+"""
+hsubsidy.py: the Helium block subsidy schedule.
+
+The subsidy of a block is the number of new helium cents which its coinbase
+transaction may create. The subsidy of the first REWARD_INTERVAL blocks is
+MINING_REWARD. It halves every REWARD_INTERVAL blocks and is rounded to the
+nearest integer, with ties rounded to the nearest even integer.
+
+The subsidy of each halving era and the cumulative supply at the end of each
+era are computed once for the configured MINING_REWARD and REWARD_INTERVAL.
+The subsidy of a block and the total supply up to a block are then table
+lookups, in exact integer arithmetic.
+"""
+import hconfig
+import pdb
+import logging
+
+"""
+log debugging messages to the file debug.log
+"""
+logging.basicConfig(filename="debug.log",filemode="w", format='%(asctime)s:%(levelname)s:%(message)s',
+    level=logging.DEBUG)
+
+
+"""
+the subsidy schedule for the configured reward and interval:
+
+    "reward":   the MINING_REWARD of the schedule
+    "interval": the REWARD_INTERVAL of the schedule
+    "subsidy":  the subsidy of the blocks of each era. The last entry is 0.
+    "supply":   the total subsidy of the blocks before each era
+"""
+schedule = {"reward": None, "interval": None, "subsidy": [], "supply": []}
+
+
+def halve(reward: "integer", halvings: "integer") -> "integer":
+    """
+    returns reward / 2**halvings rounded to the nearest integer, with ties
+    rounded to the nearest even integer
+    """
+    if halvings == 0: return reward
+
+    quotient  = reward >> halvings
+    remainder = reward - (quotient << halvings)
+    half      = 1 << (halvings - 1)
+
+    if remainder > half or (remainder == half and quotient % 2 == 1): quotient += 1
+    return quotient
+
+
+def build_schedule():
+    """
+    computes the subsidy of each era and the cumulative supply at the start
+    of each era if the reward or the interval have changed
+    """
+    reward   = hconfig.conf["MINING_REWARD"]
+    interval = hconfig.conf["REWARD_INTERVAL"]
+    if schedule["reward"] == reward and schedule["interval"] == interval: return
+
+    subsidy = []
+    supply  = [0]
+    halvings = 0
+    while True:
+        era_subsidy = halve(reward, halvings)
+        subsidy.append(era_subsidy)
+        if era_subsidy == 0: break
+        supply.append(supply[-1] + era_subsidy * interval)
+        halvings += 1
+
+    schedule["subsidy"]  = subsidy
+    schedule["supply"]   = supply
+    schedule["reward"]   = reward
+    schedule["interval"] = interval
+
+
+def block_subsidy(height: "integer") -> "integer":
+    """
+    returns the subsidy of the block at a height
+    """
+    build_schedule()
+    era = height // schedule["interval"]
+    if era >= len(schedule["subsidy"]): return 0
+    return schedule["subsidy"][era]
+
+
+def total_supply(height: "integer") -> "integer":
+    """
+    returns the total subsidy of the blocks with heights 0 to height
+    """
+    build_schedule()
+    era = height // schedule["interval"]
+    if era >= len(schedule["subsidy"]): return schedule["supply"][-1]
+
+    blocks = height % schedule["interval"] + 1
+    return schedule["supply"][era] + blocks * schedule["subsidy"][era]
+
+
+def max_supply() -> "integer":
+    """
+    returns MAX_HELIUM_COINS in helium cents
+    """
+    return round(hconfig.conf["MAX_HELIUM_COINS"] / hconfig.conf["HELIUM_CENT"])
+
+
+def audit_supply(height: "integer") -> "bool":
+    """
+    tests that the total subsidy of the blocks up to a height does not
+    exceed MAX_HELIUM_COINS
+    """
+    return total_supply(height) <= max_supply()
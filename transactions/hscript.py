@@ -0,0 +1,163 @@
+"""
+hscript.py: implements the Helium script engine.
+A ScriptPubKey is recognised and compiled once into a compact tuple form.
+A compiled p2pkhash script is executed as a direct RIPEMD-160 hash comparison
+followed by a signature verification. Scripts which do not match a standard
+template are executed by a general stack interpreter.
+"""
+import rcrypt
+import pdb
+import logging
+
+"""
+log debugging messages to the file debug.log
+"""
+logging.basicConfig(filename="debug.log",filemode="w", format='%(asctime)s:%(levelname)s:%(message)s',
+    level=logging.DEBUG)
+
+
+"""
+script templates
+"""
+P2PKH       = "p2pkh"
+NONSTANDARD = "nonstandard"
+
+"""
+script opcodes
+"""
+OP_DUP       = '<DUP>'
+OP_HASH_160  = '<HASH-160>'
+OP_EQ_VERIFY = '<EQ-VERIFY>'
+OP_CHECK_SIG = '<CHECK-SIG>'
+
+OPCODES = (OP_DUP, OP_HASH_160, OP_EQ_VERIFY, OP_CHECK_SIG)
+
+
+"""
+A compiled script is a tuple:
+
+          (P2PKH, <RIPEMD-160 public key hash>)
+          (NONSTANDARD, <tuple of script elements>)
+
+The p2pkhash ScriptPubKey template is:
+
+          ['<DUP>', '<HASH-160>', pkhash, '<EQ-VERIFY>', '<CHECK-SIG>']
+"""
+
+
+def compile_script(script: "list") -> "tuple or False":
+    """
+    compiles a ScriptPubKey list.
+    Returns (P2PKH, pkhash) if the script is a p2pkhash script, otherwise
+    returns (NONSTANDARD, script elements). Returns False if the script
+    is not a non-empty list of strings.
+    """
+    try:
+        if type(script) != list or len(script) == 0:
+            raise(ValueError("script is not a non-empty list"))
+
+        for element in script:
+            if type(element) != str:
+                raise(ValueError("script element is not a string"))
+
+        if len(script) == 5 and script[0] == OP_DUP and script[1] == OP_HASH_160 and \
+           script[3] == OP_EQ_VERIFY and script[4] == OP_CHECK_SIG and \
+           len(script[2]) > 0 and script[2] not in OPCODES:
+            return (P2PKH, script[2])
+
+    except Exception as err:
+        logging.debug('compile_script: exception: ' + str(err))
+        return False
+
+    return (NONSTANDARD, tuple(script))
+
+
+def compile_fragment(fragment: "dictionary") -> "tuple":
+    """
+    compiles the locking script of a chainstate transaction fragment.
+    The chainstate stores the public key hash of a p2pkhash script, this is
+    already the compiled form of the script. A fragment with a non-standard
+    locking script carries the script in a "ScriptPubKey" attribute.
+    """
+    if "ScriptPubKey" in fragment:
+        return compile_script(fragment["ScriptPubKey"])
+    return (P2PKH, fragment["pkhash"])
+
+
+def hash_160(pubkey: "string") -> "string":
+    """
+    returns RIPEMD160(SHA256(pubkey)) as a hexadecimal string
+    """
+    return rcrypt.make_RIPEMD160_hash(rcrypt.make_SHA256_hash(pubkey))
+
+
+def run_p2pkh(signature: "string", pubkey: "string", pkhash: "string") -> "bool":
+    """
+    executes a compiled p2pkhash script. Tests that the public key hashes to
+    pkhash and then verifies the signature. The cheap hash comparison is
+    done before the signature verification.
+    Returns True if the script succeeds and False otherwise.
+    """
+    if hash_160(pubkey) != pkhash: return False
+    if rcrypt.verify_signature(pubkey, pubkey, signature) != True: return False
+    return True
+
+
+def execute_script(script_sig: "list", script_pubkey: "tuple or list") -> "bool":
+    """
+    general stack interpreter for non-standard scripts. The ScriptSig
+    elements are pushed onto the stack and then the ScriptPubKey is executed.
+    The script succeeds if the top of the stack is True when the script ends.
+    Returns True if the script succeeds and False otherwise.
+    """
+    try:
+        stack = list(script_sig)
+
+        for element in script_pubkey:
+            if element == OP_DUP:
+                stack.append(stack[-1])
+
+            elif element == OP_HASH_160:
+                stack.append(hash_160(stack.pop()))
+
+            elif element == OP_EQ_VERIFY:
+                if stack.pop() != stack.pop():
+                    raise(ValueError("EQ-VERIFY failure"))
+
+            elif element == OP_CHECK_SIG:
+                pubkey    = stack.pop()
+                signature = stack.pop()
+                stack.append(rcrypt.verify_signature(pubkey, pubkey, signature) == True)
+
+            elif element.startswith('<') and element.endswith('>'):
+                raise(ValueError("unknown opcode: " + element))
+
+            else:
+                stack.append(element)
+
+        if len(stack) == 0 or stack[-1] != True:
+            raise(ValueError("script did not leave True on the stack"))
+
+    except Exception as err:
+        logging.debug('execute_script: exception: ' + str(err))
+        return False
+
+    return True
+
+
+def verify_script(script_sig: "list", compiled: "tuple") -> "bool":
+    """
+    executes a ScriptSig against a compiled ScriptPubKey.
+    p2pkhash scripts take the fast path, other scripts are interpreted.
+    Returns True if the script succeeds and False otherwise.
+    """
+    try:
+        if compiled[0] == P2PKH:
+            if len(script_sig) != 2: return False
+            return run_p2pkh(script_sig[0], script_sig[1], compiled[1])
+
+        return execute_script(script_sig, compiled[1])
+
+    except Exception as err:
+        logging.debug('verify_script: exception: ' + str(err))
+        return False
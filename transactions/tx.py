@@ -5,6 +5,7 @@ transaction operations.
 import hconfig
 import hblockchain as hchain
 import hchaindb
+import hscript
 import json
 import rcrypt
 import secrets
@@ -71,13 +72,36 @@ def create_transaction(transaction: 'dictionary', zero_inputs: 'boolean'=False)
     return True
 
 
-def validate_transaction(trans: "dictionary", zero_inputs: "boolean"=False) -> "bool":
+"""
+transaction validation is performed in stages which are ordered from the
+cheapest to the most expensive so that an invalid transaction is rejected
+at the cheapest possible stage:
+
+    (1) syntax:  stateless checks of the transaction's structure
+    (2) inputs:  a batched lookup of the spendable fragments in the chainstate
+    (3) values:  the spent values and the transaction fee
+    (4) scripts: execution of the locking scripts and signature verification
+
+rejection_counters counts the number of transactions rejected at each stage.
+"""
+rejection_counters = {"syntax": 0, "inputs": 0, "values": 0, "scripts": 0}
+
+
+def validate_transaction(trans: "dictionary", zero_inputs: "boolean"=False, 
+                         pending: "dictionary"=None, verify_scripts: "boolean"=True) -> "bool":
     """
     verifies that a transaction has valid values.  
     receives a transaction and a predicate.
     zero_inputs is True if the transacton is in the genesis block or if the transaction
     is a coinbase transaction, otherwise zero_inputs is False.
-.
+    pending optionally maps fragment keys to the unspent outputs of unconfirmed
+    (mempool) transactions, in chainstate fragment form. These are used in
+    place of the chainstate.
+    verify_scripts is False for the transactions of a block below the assume
+    valid checkpoint. The script stage, which verifies the signatures, is 
+    then skipped. See hblockchain.assume_valid
+    The validation stages are executed in order and validation stops at the
+    first stage that fails.
 
     The following transaction validation tests are performed:
         (1)  The required attributes are present. 
@@ -98,8 +122,35 @@ def validate_transaction(trans: "dictionary", zero_inputs: "boolean"=False) -> "
              vout array of the previous transaction.
         (14) The transaction inputs can be spent
         (15) The genesis block does not have any inputs
+        (16) The vin list does not spend the same fragment more than once
+        (17) The coinbase outputs spent by the transaction are mature
     """
+    if validate_syntax(trans, zero_inputs) == False:
+        rejection_counters["syntax"] += 1
+        return False
+
+    spendable_fragments = spendable_inputs(trans, pending)
+    if spendable_fragments == False:
+        rejection_counters["inputs"] += 1
+        return False
 
+    if validate_values(trans, spendable_fragments, zero_inputs) == False:
+        rejection_counters["values"] += 1
+        return False
+
+    if verify_scripts == True and validate_scripts(trans, spendable_fragments) == False:
+        rejection_counters["scripts"] += 1
+        return False
+
+    return True
+
+
+def validate_syntax(trans: "dictionary", zero_inputs: "boolean"=False) -> "bool":
+    """
+    stateless validation of the structure of a transaction. Does not access
+    the chainstate database.
+    Returns True if the transaction is well-formed and False otherwise
+    """
     try:
         if type(trans) != dict:
             raise(ValueError("not dict type"))
@@ -126,21 +177,18 @@ def validate_transaction(trans: "dictionary", zero_inputs: "boolean"=False) -> "
         if zero_inputs == True and len(trans["vin"]) > 0:
             raise(ValueError("genesis block cannot have inputs"))
 
+        if len(trans['vin']) > hconfig.conf['MAX_INPUTS']:
+            raise(ValueError("vin list length error"))
 
         # validate the vin elements
-        # there are no vin inputs for a genesis block transaction
-        spendable_fragments = []
-
+        # a fragment cannot be spent twice by the same transaction
+        tx_keys = set()
         for vin_element in trans['vin']:
             if validate_vin(vin_element) == False: return False
             tx_key = vin_element['txid'] + '_' + str(vin_element['vout_index'])
-
-            spendable_fragment = prevtx_value(tx_key)
-                
-            if spendable_fragment == False:
-                raise(ValueError("invalid spendable input for transaction"))
-            else:    
-                spendable_fragments.append(spendable_fragment)
+            if tx_key in tx_keys:
+                raise(ValueError("vin list spends a fragment twice"))
+            tx_keys.add(tx_key)
 
         # validate the transaction's vout list
         if len(trans['vout']) > hconfig.conf['MAX_OUTPUTS'] or len(trans['vout']) <= 0:
@@ -149,20 +197,98 @@ def validate_transaction(trans: "dictionary", zero_inputs: "boolean"=False) -> "
         for vout_element in trans['vout']:
             if validate_vout(vout_element) == False: return False          
 
-        # validate the transaction fee
-        if zero_inputs == False:
-             if (transaction_fee(trans, spendable_fragments)) == False: return False
+    except Exception as err:
+        logging.debug('validate_syntax: exception: ' + str(err))
+        return False
+
+    return True
+
+
+def spendable_inputs(trans: "dictionary", pending: "dictionary"=None, 
+                     height: "integer"=None) -> "list or False":
+    """
+    fetches the chainstate fragments consumed by the vin elements of a
+    transaction. The fragment keys are looked up as a batch in key order.
+    A key in the pending dictionary is taken from it instead of the chainstate.
+    height is the height of the block which spends the fragments. It
+    defaults to the height of the next block.
+    Returns a list of fragments in vin order or False if a fragment does
+    not exist or cannot be spent
+    """
+    try:
+        if height == None: height = next_height()
+
+        tx_keys = []
+        for vin_element in trans['vin']:
+            tx_keys.append(vin_element['txid'] + '_' + str(vin_element['vout_index']))
+
+        fragments = {}
+        for tx_key in sorted(tx_keys):
+            if pending != None and tx_key in pending:
+                spendable_fragment = pending[tx_key]
+            else:
+                spendable_fragment = prevtx_value(tx_key)
+            if spendable_fragment == False:
+                raise(ValueError("invalid spendable input for transaction"))
+            if fragment_mature(spendable_fragment, height) == False:
+                raise(ValueError("immature coinbase input: " + tx_key))
+            fragments[tx_key] = spendable_fragment
 
-        # test that the transaction inputs are unlocked 
+    except Exception as err:
+        logging.debug('spendable_inputs: exception: ' + str(err))
+        return False
+
+    return [fragments[tx_key] for tx_key in tx_keys]
+
+
+def next_height() -> "integer":
+    """
+    returns the height of the next block of the blockchain
+    """
+    if len(hchain.blockchain) == 0: return 0
+    return hchain.blockchain[-1]["height"] + 1
+
+
+def fragment_mature(fragment: "dictionary", height: "integer") -> "bool":
+    """
+    tests whether a chainstate fragment can be spent in a block at a height.
+    A coinbase output cannot be spent until COINBASE_INTERVAL blocks have
+    been mined on top of the block which created it. The creation height
+    and the coinbase flag are held in the fragment so the test does not
+    need a blk_index lookup. See hchaindb.transaction_update
+    """
+    if fragment.get("coinbase") != True: return True
+    return height - fragment["height"] >= hconfig.conf["COINBASE_INTERVAL"]
+
+
+def validate_values(trans: "dictionary", spendable_fragments: "list", 
+                    zero_inputs: "boolean"=False) -> "bool":
+    """
+    validates the transaction fee of a transaction against the fragments
+    that it consumes. There is no transaction fee for the genesis block or
+    coinbase transactions.
+    Returns True if the values are valid and False otherwise
+    """
+    if zero_inputs == True: return True
+    if transaction_fee(trans, spendable_fragments) == False: return False
+    return True
+
+
+def validate_scripts(trans: "dictionary", spendable_fragments: "list") -> "bool":
+    """
+    tests that the transaction inputs are unlocked. This stage performs the
+    signature verifications and is executed last.
+    Returns True if all of the inputs are unlocked and False otherwise
+    """
+    try:
         ctr = 0
         for vin in trans['vin']:
             if unlock_transaction_fragment(vin, spendable_fragments[ctr]) == False:
                 raise(ValueError("failed to unlock transaction"))
             ctr += 1    
 
-
     except Exception as err:
-        logging.debug('validate_transaction: exception: ' + str(err))
+        logging.debug('validate_scripts: exception: ' + str(err))
         return False
 
     return True
@@ -201,23 +327,9 @@ def validate_vout(vout_element: 'dictionary') -> bool:
             raise(ValueError("value is <= 0"))
 
         # validate the p2pkhash script
-        if len(vout_element["ScriptPubKey"]) != 5:
-            raise(ValueError("ScriptPubKey length error"))
-    
-        if vout_element["ScriptPubKey"][0] != '<DUP>':
-            raise(ValueError("ScriptPubKey <DUP> error"))
-    
-        if vout_element["ScriptPubKey"][1] != '<HASH-160>':
-            raise(ValueError("ScriptPubKey <HASH-160> error"))
-
-        if vout_element["ScriptPubKey"][3] != '<EQ-VERIFY>':
-            raise(ValueError("ScriptPubKey <EQ-VERIFY> error"))
-        
-        if vout_element["ScriptPubKey"][4] != '<CHECK-SIG>':
-            raise(ValueError("ScriptPubKey <CHECK-SIG> error"))
-
-        if len(vout_element["ScriptPubKey"][2]) == 0: 
-            raise(ValueError("ScriptPubKey RIPMD-160 hash error"))
+        compiled = hscript.compile_script(vout_element["ScriptPubKey"])
+        if compiled == False or compiled[0] != hscript.P2PKH:
+            raise(ValueError("ScriptPubKey is not a p2pkhash script"))
 
     except Exception as err:
         print("validate_vout exception" + str(err))
@@ -234,7 +346,9 @@ def prevtx_value(txkey: "string") -> 'bool':
             "pkkhash":  <string>,
             "value":    <int>, 
             "spent":    <bool>, 
-            "tx_chain": <string>
+            "tx_chain": <string>,
+            "height":   <int or None>,
+            "coinbase": <bool>
          }
     
     receives a transaction fragment key: 
@@ -300,50 +414,21 @@ def transaction_fee(trans: 'dictionary', value_list: 'list<dictionary>' ) -> 'in
 
 def unlock_transaction_fragment(vinel: "dictionary", fragment: "dictionary") -> "boolean":
     """
-    unlocks a previous transaction fragment using the p2pkhash script.
-    Executes the script and returns False if the transaction is not unlocked
+    unlocks a previous transaction fragment by executing its locking script.
+    A p2pkhash fragment is unlocked by comparing the RIPEMD-160 hash of the
+    public key in the ScriptSig with the fragment's public key hash and then
+    verifying the signature. Returns False if the transaction is not unlocked
     Receives: the consuming vin and the previous transaction fragment consumed
     by the vin element.
     """
     try:
-        execution_stack = [] 
-        result_stack = []
-
-        # make the execution stack for a p2pkhash script 
-        # since we only have one type of script in Helium
-        # we can use hard-coded values
-        execution_stack.append('SIG')
-        execution_stack.append('PUBKEY')
-        execution_stack.append('<DUP>')
-        execution_stack.append('<HASH_160>')
-        execution_stack.append('HASH-160')
-        execution_stack.append('<EQ-VERIFY>')
-        execution_stack.append('<CHECK_SIG>')
-
-        # Run the p2pkhash execution stack 
-        result_stack.insert(0, vinel['ScriptSig'][0])    
-        result_stack.insert(0, vinel['ScriptSig'][1])    
-        result_stack.insert(0, vinel['ScriptSig'][1])    
-        
-        hash_160 = rcrypt.make_SHA256_hash(vinel['ScriptSig'][1])
-        hash_160 = rcrypt.make_RIPEMD160_hash(hash_160)
+        compiled = hscript.compile_fragment(fragment)
+        if compiled == False:
+            raise(ValueError("invalid fragment locking script"))
+
+        if hscript.verify_script(vinel['ScriptSig'], compiled) == False:
+            raise(ValueError("script execution failure"))
 
-        result_stack.insert(0, hash_160)    
-        result_stack.insert(0, fragment["pkhash"])    
-        
-        # do the EQ_VERIFY operation
-        tmp1 = result_stack.pop(0)
-        tmp2 = result_stack.pop(0)
-      
-        # test for RIPEMD-160 hash match 
-        if tmp1 != tmp2:
-            raise(ValueError("public key match failure"))
-
-        # test for a signature match
-        ret = rcrypt.verify_signature(vinel['ScriptSig'][1], vinel['ScriptSig'][1], vinel['ScriptSig'][0])
-        if ret == False:
-            raise(ValueError("signature match failure"))
-     
     except Exception as err:
         logging.debug('unlock_transaction_fragment: exception: ' + str(err))
         return False
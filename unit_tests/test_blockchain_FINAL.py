@@ -7,11 +7,13 @@ import rcrypt
 import hconfig
 import time
 import hblockchain
+import hpow
 import os
 import pdb
 import secrets
 import tx
 import blk_index
+import hchaindb
 
 def teardown_module():
     """
@@ -495,3 +497,305 @@ def test_merkle_root_block_transaction(monkeypatch):
     block_2["prevblockhash"] = hblockchain.blockheader_hash(block_1)
     assert hblockchain.add_block(block_2) == True
 
+
+
+"""
+test the detection of conflicting transactions within a block
+"""
+def make_conflict_block():
+    """
+    make a block where the second transaction spends an output
+    of the first transaction
+    """
+    trx_1 = {"transactionid": rcrypt.make_uuid(), "vin": [],
+             "vout": [{"value": 10}, {"value": 20}]}
+    trx_2 = {"transactionid": rcrypt.make_uuid(),
+             "vin": [{"txid": trx_1["transactionid"], "vout_index": 1}],
+             "vout": [{"value": 20}]}
+    trx_3 = {"transactionid": rcrypt.make_uuid(),
+             "vin": [{"txid": rcrypt.make_uuid(), "vout_index": 0}],
+             "vout": [{"value": 5}]}
+    return {"tx": [trx_1, trx_2, trx_3]}
+
+
+def test_block_without_conflicts():
+    """
+    test that a block may spend outputs created earlier in the block
+    """
+    assert hblockchain.validate_block_conflicts(make_conflict_block()) == True
+
+
+def test_block_duplicate_transaction():
+    """
+    test that a block cannot contain the same transaction twice
+    """
+    block = make_conflict_block()
+    block["tx"].append(dict(block["tx"][2]))
+    assert hblockchain.validate_block_conflicts(block) == False
+
+
+def test_block_double_spend():
+    """
+    test that a block cannot spend the same fragment twice
+    """
+    block = make_conflict_block()
+    block["tx"][2]["vin"].append(dict(block["tx"][1]["vin"][0]))
+    assert hblockchain.validate_block_conflicts(block) == False
+
+
+def test_block_spends_later_output():
+    """
+    test that a transaction cannot spend an output of a later
+    transaction in the same block
+    """
+    block = make_conflict_block()
+    block["tx"][0], block["tx"][1] = block["tx"][1], block["tx"][0]
+    assert hblockchain.validate_block_conflicts(block) == False
+
+
+def test_block_spends_missing_output():
+    """
+    test that a transaction cannot spend a non-existent output of an
+    earlier transaction in the same block
+    """
+    block = make_conflict_block()
+    block["tx"][1]["vin"][0]["vout_index"] = 2
+    assert hblockchain.validate_block_conflicts(block) == False
+
+
+def test_conflict_rejected_before_chainstate(monkeypatch):
+    """
+    test that a block with an in-block double spend is rejected before
+    any transaction is validated or written to the chainstate
+    """
+    def fail(*args):
+        raise(AssertionError("transaction processed"))
+
+    monkeypatch.setattr(hblockchain, "validate_block", lambda x: True)
+    monkeypatch.setattr(tx, "validate_transaction", fail)
+    monkeypatch.setattr(hchaindb, "transaction_update", fail)
+
+    block = make_conflict_block()
+    block["height"] = 1
+    block["tx"][2]["vin"].append(dict(block["tx"][1]["vin"][0]))
+    assert hblockchain.add_block(block) == False
+
+
+def test_dependency_levels():
+    """
+    test that transactions which spend outputs created earlier in the
+    block are placed in a later level
+    """
+    block = make_conflict_block()
+    trx_4 = {"transactionid": rcrypt.make_uuid(),
+             "vin": [{"txid": block["tx"][1]["transactionid"], "vout_index": 0}],
+             "vout": [{"value": 20}]}
+    block["tx"].append(trx_4)
+
+    assert hblockchain.dependency_levels(block["tx"]) == [[0, 2], [1], [3]]
+
+
+def test_parallel_validation_rejects_invalid_transaction(monkeypatch):
+    """
+    test that a block is rejected if one of the concurrently validated
+    transactions is invalid and that the chainstate is not updated
+    """
+    invalid = []
+    updated = []
+    monkeypatch.setattr(tx, "validate_transaction", lambda x, y: x not in invalid)
+    monkeypatch.setattr(hchaindb, "transaction_update", lambda x: updated.append(x) or True)
+    monkeypatch.setitem(hconfig.conf, "VALIDATION_WORKERS", 4)
+
+    block = {"height": 1, "tx": [{"transactionid": rcrypt.make_uuid(), "vin": [],
+             "vout": [{"value": 1}]} for ctr in range(8)]}
+
+    assert hblockchain.validate_transactions(block, list(range(8))) == True
+    invalid.append(block["tx"][5])
+    assert hblockchain.validate_transactions(block, list(range(8))) == False
+
+    monkeypatch.setattr(hblockchain, "validate_block", lambda x: True)
+    assert hblockchain.add_block(block) == False
+    assert updated == []
+
+
+def test_workers_read_the_block_view(monkeypatch):
+    """
+    test that the validation workers read the chainstate view of the
+    thread which connects the block
+    """
+    monkeypatch.setitem(hconfig.conf, "VALIDATION_WORKERS", 4)
+    monkeypatch.setattr(tx, "validate_transaction", 
+                        lambda x, y: hchaindb.current_view() is view)
+    block = {"height": 1, "tx": [{} for ctr in range(8)]}
+
+    hchaindb.attach_view({"fragments": {}, "writes": set(), "undo": {}, "height": 1})
+    view = hchaindb.current_view()
+    assert hblockchain.validate_transactions(block, list(range(8))) == True
+    hchaindb.discard_view()
+    assert hblockchain.validate_transactions(block, list(range(8))) == False
+
+
+def make_header(parent=None):
+    """
+    makes a synthetic block header which extends the parent header
+    """
+    header = {"version": hconfig.conf["VERSION_NO"], "prevblockhash": "",
+              "merkle_root": rcrypt.make_uuid(), "timestamp": int(time.time()),
+              "difficulty_bits": hconfig.conf["DIFFICULTY_BITS"], 
+              "nonce": hconfig.conf["NONCE"], "height": 0}
+    if parent != None:
+        header["prevblockhash"] = hblockchain.blockheader_hash(parent)
+        header["height"] = parent["height"] + 1
+    return header
+
+
+@pytest.mark.parametrize("key, value", [
+    ("version", "-1"),
+    ("timestamp", -1),
+    ("timestamp", int(time.time()) + 3 * 60 * 60),
+    ("difficulty_bits", 0),
+    ("nonce", -1),
+    ("height", 5),
+])
+def test_invalid_header(key, value):
+    """
+    test that a block header with an invalid attribute or an invalid
+    linkage to its parent is rejected
+    """
+    hblockchain.header_index.clear()
+    genesis = make_header()
+    hblockchain.insert_header(genesis)
+    header = make_header(genesis)
+
+    assert hblockchain.validate_header(header) == True
+    header[key] = value
+    assert hblockchain.validate_header(header) == False
+    hblockchain.header_index.clear()
+
+
+def test_mined_header_is_valid(monkeypatch):
+    """
+    test that a header which is solved by the proof of work engine is a
+    valid header
+    """
+    monkeypatch.setitem(hconfig.conf, "DIFFICULTY_TARGET", 2**250)
+    hblockchain.header_index.clear()
+    genesis = make_header()
+    hblockchain.insert_header(genesis)
+
+    header = make_header(genesis)
+    while hpow.meets_target(hpow.header_digest(header), hpow.target_limit(2**250)):
+        header["merkle_root"] = rcrypt.make_uuid()
+
+    header["nonce"] = hpow.mine(header, 1)
+    assert header["nonce"] != hconfig.conf["NONCE"]
+    assert hblockchain.validate_header(header) == True
+    hblockchain.header_index.clear()
+
+
+def test_best_header_chain():
+    """
+    test that the best header moves to the header chain with the most
+    work and that the bodies of the chain are returned parents first
+    """
+    hblockchain.header_index.clear()
+    hblockchain.block_tree.clear()
+    hblockchain.best_header = None
+
+    genesis = make_header()
+    header1 = make_header(genesis)
+    fork1   = make_header(genesis)
+    fork2   = make_header(fork1)
+
+    for header in [genesis, header1, fork1]:
+        node = hblockchain.insert_header(header)
+        node["block"] = header
+    assert hblockchain.best_header == hblockchain.blockheader_hash(header1)
+    assert hblockchain.on_best_header_chain(hblockchain.blockheader_hash(fork1)) == False
+
+    hblockchain.insert_node(genesis)
+    hblockchain.insert_header(fork2)
+    assert hblockchain.best_header == hblockchain.blockheader_hash(fork2)
+    assert hblockchain.on_best_header_chain(hblockchain.blockheader_hash(fork1)) == True
+    assert hblockchain.on_best_header_chain(hblockchain.blockheader_hash(header1)) == False
+    assert hblockchain.best_chain_blocks(hblockchain.best_header) == False
+
+    hblockchain.header_index[hblockchain.best_header]["block"] = fork2
+    assert hblockchain.best_chain_blocks(hblockchain.best_header) == [fork1, fork2]
+
+    hblockchain.header_index.clear()
+    hblockchain.block_tree.clear()
+    hblockchain.best_header = None
+
+
+def test_assume_valid(monkeypatch):
+    """
+    test that the signatures of a block are only skipped if the block is on
+    the header chain of the checkpoint and at or below its height
+    """
+    hblockchain.header_index.clear()
+    hblockchain.checkpoint_chain.clear()
+
+    genesis = make_header()
+    header1 = make_header(genesis)
+    header2 = make_header(header1)
+    fork1   = make_header(genesis)
+    for header in [genesis, header1, header2, fork1]:
+        hblockchain.insert_header(header)
+
+    assert hblockchain.assume_valid(header1) == False
+
+    monkeypatch.setitem(hconfig.conf, "ASSUME_VALID_HEIGHT", 1)
+    monkeypatch.setitem(hconfig.conf, "ASSUME_VALID_HASH", hblockchain.blockheader_hash(header1))
+    assert hblockchain.assume_valid(genesis) == True
+    assert hblockchain.assume_valid(header1) == True
+    assert hblockchain.assume_valid(fork1) == False
+    assert hblockchain.assume_valid(header2) == False
+
+    monkeypatch.setitem(hconfig.conf, "ASSUME_VALID_HASH", rcrypt.make_uuid())
+    assert hblockchain.assume_valid(header1) == False
+
+    hblockchain.header_index.clear()
+    hblockchain.checkpoint_chain.clear()
+
+
+def test_validate_transactions_below_checkpoint(monkeypatch):
+    """
+    test that the transactions of a block below the checkpoint are 
+    validated without verifying their signatures
+    """
+    flags = []
+    monkeypatch.setattr(tx, "validate_transaction", 
+                        lambda x, y, verify_scripts=True: flags.append(verify_scripts) == None)
+    monkeypatch.setitem(hconfig.conf, "VALIDATION_WORKERS", 1)
+    block = {"height": 1, "tx": [{}, {}]}
+
+    monkeypatch.setattr(hblockchain, "assume_valid", lambda x: True)
+    assert hblockchain.validate_transactions(block, [0, 1]) == True
+    monkeypatch.setattr(hblockchain, "assume_valid", lambda x: False)
+    assert hblockchain.validate_transactions(block, [0, 1]) == True
+    assert flags == [False, False, True, True]
+
+
+def test_header_targets(monkeypatch):
+    """
+    test that the expected target of each header is stored in the header
+    index and that it agrees with the targets of the header chain
+    """
+    monkeypatch.setitem(hconfig.conf, "RETARGET_INTERVAL", 3)
+    hblockchain.header_index.clear()
+
+    headers = [make_header()]
+    for height in range(1, 10):
+        header = make_header(headers[-1])
+        header["timestamp"] = headers[-1]["timestamp"] + 60 * height
+        headers.append(header)
+    for header in headers:
+        hblockchain.insert_header(header)
+
+    targets = hpow.chain_targets([header["timestamp"] for header in headers])
+    assert [hblockchain.header_index[hblockchain.blockheader_hash(header)]["target"]
+            for header in headers] == targets
+    assert targets[4] != targets[3]
+
+    hblockchain.header_index.clear()
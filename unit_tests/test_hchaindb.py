@@ -9,6 +9,7 @@ import random
 import secrets
 import pdb
 import os
+import threading
 
 def setup_module():
     assert bool(chain.open_hchainstate("heliumdb")) == True
@@ -344,3 +345,153 @@ def test_previous_tx_non_existent():
     assert chain.transaction_update(trx) == False
 
 
+
+
+def make_fragment():
+    """
+    makes a random unspent transaction fragment
+    """
+    return {
+        "pkhash": make_pkhash(),
+        "value":  make_value() + 1,
+        "spent":  False,
+        "tx_chain": ""
+    }
+
+
+def test_prefetch_transactions():
+    """
+    prefetch existing and non-existent fragments in one pass
+    """
+    keys = []
+    for ctr in range(5):
+        key = make_transactionid() + "_" + str(make_vout_index())
+        assert chain.put_transaction(key, make_fragment()) == True
+        keys.append(key)
+
+    missing = "f" * 64 + "_0"
+    fragments = chain.prefetch_transactions(keys + [missing])
+
+    assert len(fragments) == 6
+    assert fragments[missing] == None
+    for key in keys:
+        assert fragments[key] == chain.get_transaction(key)
+
+
+def test_fragment_keys():
+    """
+    the fragment keys of a list of transactions are sorted and unique
+    """
+    trx = {"vin": [{"txid": "b", "vout_index": 1}, {"txid": "a", "vout_index": 0}]}
+    assert chain.fragment_keys([trx, trx]) == ["a_0", "b_1"]
+
+
+def test_commit_view():
+    """
+    fragments written to the chainstate view are only written to the
+    database when the view is committed
+    """
+    key = make_transactionid() + "_0"
+    assert chain.put_transaction(key, make_fragment()) == True
+
+    chain.open_view([key])
+    fragment = chain.get_transaction(key)
+    fragment["spent"] = True
+    assert chain.put_transaction(key, fragment) == True
+    assert chain.get_transaction(key)["spent"] == True
+    assert json.loads(chain.hDB.get(str.encode(key)).decode())["spent"] == False
+
+    assert chain.commit_view() == True
+    assert chain.current_view() == None
+    assert chain.get_transaction(key)["spent"] == True
+
+
+def test_discard_view():
+    """
+    fragments written to a discarded chainstate view are not written
+    to the database
+    """
+    key = make_transactionid() + "_0"
+    chain.open_view([key])
+    assert chain.get_transaction(key) == False
+    assert chain.put_transaction(key, make_fragment()) == True
+    assert chain.get_transaction(key) != False
+
+    chain.discard_view()
+    assert chain.get_transaction(key) == False
+
+
+def test_view_is_per_thread():
+    """
+    fragments written to the chainstate view of a thread are not seen by
+    other threads unless they attach the view
+    """
+    key = make_transactionid() + "_0"
+    chain.open_view([key])
+    assert chain.put_transaction(key, make_fragment()) == True
+    view = chain.current_view()
+
+    found = []
+    def read(attach):
+        if attach == True: chain.attach_view(view)
+        found.append(chain.get_transaction(key) != False)
+        chain.attach_view(None)
+
+    for attach in [False, True]:
+        reader = threading.Thread(target=read, args=(attach,))
+        reader.start()
+        reader.join()
+
+    assert found == [False, True]
+    assert chain.get_transaction(key) != False
+    chain.discard_view()
+
+
+def test_fragment_height_and_coinbase():
+    """
+    fragments created through a chainstate view record the height of the
+    block and whether they are coinbase outputs
+    """
+    coinbase = {"transactionid": make_transactionid(), "vin": [],
+                "vout": [{"value": 10, "ScriptPubKey": ["SIG", rcrypt.make_uuid()]}]}
+    coinbase["vout"][0]["ScriptPubKey"].append(rcrypt.make_uuid())
+
+    chain.open_view([], 7)
+    assert chain.transaction_update(coinbase) == True
+    assert chain.commit_view() == True
+    fragment = chain.get_transaction(coinbase["transactionid"] + "_0")
+    assert fragment["height"] == 7
+    assert fragment["coinbase"] == True
+    assert chain.current_view() == None
+
+    assert chain.is_coinbase(coinbase, 0) == False
+    assert chain.is_coinbase(coinbase, None) == False
+    coinbase["vin"] = [{"txid": "a", "vout_index": 0}]
+    assert chain.is_coinbase(coinbase, 7) == False
+
+
+def test_view_changes():
+    """
+    the changes of a committed chainstate view can be undone and redone
+    """
+    spent_key = make_transactionid() + "_0"
+    new_key   = make_transactionid() + "_0"
+    assert chain.put_transaction(spent_key, make_fragment()) == True
+
+    chain.open_view([spent_key])
+    fragment = chain.get_transaction(spent_key)
+    fragment["spent"] = True
+    chain.put_transaction(spent_key, fragment)
+    chain.put_transaction(new_key, make_fragment())
+    changes = chain.view_changes()
+    assert chain.commit_view() == True
+
+    assert changes["undo"][new_key] == None
+    assert chain.apply_fragments(changes["undo"]) == True
+    assert chain.get_transaction(spent_key)["spent"] == False
+    assert chain.get_transaction(new_key) == False
+
+    assert chain.apply_fragments(changes["redo"]) == True
+    assert chain.get_transaction(spent_key)["spent"] == True
+    assert chain.get_transaction(new_key) != False
+    assert chain.view_changes() == None
@@ -0,0 +1,468 @@
+"""
+pytest unit tests for the hmempool module
+"""
+import hmempool
+import hchaindb
+import hconfig
+import tx
+import rcrypt
+import heapq
+import itertools
+import random
+import pytest
+import pdb
+
+
+def setup_function():
+    hmempool.clear()
+
+
+def teardown_function():
+    hmempool.clear()
+
+
+def make_transaction(spends=None, value=10):
+    """
+    makes a synthetic transaction which spends a list of (txid, vout_index)
+    previous transaction fragments and has one output of value
+    """
+    trx = {}
+    trx["transactionid"] = rcrypt.make_uuid()
+    trx["version"] = "1"
+    trx["locktime"] = 0
+    trx["vin"] = []
+    trx["vout"] = [{"value": value, "ScriptPubKey": ['<DUP>', '<HASH-160>', "pkhash",
+                                                     '<EQ-VERIFY>', '<CHECK-SIG>']}]
+
+    if spends == None: spends = [(rcrypt.make_uuid(), 0)]
+    for txid, index in spends:
+        trx["vin"].append({"txid": txid, "vout_index": index,
+                           "ScriptSig": []})
+    return trx
+
+
+def test_add_transaction():
+    """
+    test that a transaction is added and its spent fragments are indexed
+    """
+    trx = make_transaction()
+    assert hmempool.add_transaction(trx) == True
+    assert hmempool.contains(trx["transactionid"]) == True
+    assert hmempool.get_transaction(trx["transactionid"]) == trx
+    assert hmempool.spender(hmempool.fragment_key(trx["vin"][0])) == trx["transactionid"]
+    assert len(hmempool.mempool) == 1
+
+
+def test_add_duplicate_transaction():
+    """
+    test that a transaction is not added twice
+    """
+    trx = make_transaction()
+    assert hmempool.add_transaction(trx) == True
+    assert hmempool.add_transaction(trx) == False
+    assert len(hmempool.mempool) == 1
+
+
+def test_transactions_in_arrival_order():
+    """
+    test that the mempool transactions are returned in arrival order
+    """
+    trxs = [make_transaction() for __ctr in range(5)]
+    for trx in trxs: hmempool.add_transaction(trx)
+    assert hmempool.transactions() == trxs
+
+
+def test_remove_transaction():
+    """
+    test that a removed transaction is dropped from the spent fragment index
+    """
+    trx = make_transaction()
+    hmempool.add_transaction(trx)
+    assert hmempool.remove_transaction(trx["transactionid"]) == True
+    assert hmempool.remove_transaction(trx["transactionid"]) == False
+    assert len(hmempool.mempool) == 0
+    assert len(hmempool.spent_index) == 0
+
+
+def test_remove_block_transactions():
+    """
+    test that the transactions of a block are removed and that the other
+    mempool transactions remain
+    """
+    trxs = [make_transaction() for __ctr in range(4)]
+    for trx in trxs: hmempool.add_transaction(trx)
+
+    block = {"tx": trxs[:2]}
+    assert hmempool.remove_block_transactions(block) == True
+    assert hmempool.transactions() == trxs[2:]
+    assert len(hmempool.spent_index) == 2
+
+
+def test_remove_block_conflicts():
+    """
+    test that a mempool transaction which spends a fragment that is spent
+    by a block transaction is removed
+    """
+    prev_txid = rcrypt.make_uuid()
+    pending = make_transaction([(prev_txid, 1)])
+    hmempool.add_transaction(pending)
+
+    mined = make_transaction([(prev_txid, 1)])
+    assert hmempool.remove_block_transactions({"tx": [mined]}) == True
+    assert hmempool.contains(pending["transactionid"]) == False
+    assert len(hmempool.spent_index) == 0
+
+
+def test_large_mempool():
+    """
+    test that a large mempool is built and emptied by one block
+    """
+    trxs = [make_transaction() for __ctr in range(20000)]
+    for trx in trxs: hmempool.add_transaction(trx)
+    assert len(hmempool.mempool) == 20000
+
+    assert hmempool.remove_block_transactions({"tx": trxs}) == True
+    assert len(hmempool.mempool) == 0
+    assert len(hmempool.spent_index) == 0
+
+
+def test_fee_cached_at_admission(monkeypatch):
+    """
+    test that the fee and the fee rate are computed at admission
+    """
+    monkeypatch.setattr(hchaindb, "get_transaction", lambda key: {"value": 100})
+    trx = make_transaction(value=60)
+    hmempool.add_transaction(trx)
+
+    entry = hmempool.mempool[trx["transactionid"]]
+    assert entry["fee"] == 40
+    assert entry["size"] > 0
+    assert entry["feerate"] == 40 / entry["size"]
+
+
+def test_select_by_fee_rate(monkeypatch):
+    """
+    test that the template transactions are selected in order of
+    decreasing fee rate
+    """
+    monkeypatch.setattr(hchaindb, "get_transaction", lambda key: {"value": 100})
+    trxs = [make_transaction(value=value) for value in (90, 20, 50, 70, 10)]
+    for trx in trxs: hmempool.add_transaction(trx)
+
+    entries = hmempool.select_transactions(1_000_000)
+    assert [entry["tx"] for entry in entries] == \
+           [trxs[4], trxs[1], trxs[2], trxs[3], trxs[0]]
+
+
+def test_select_parents_before_children(monkeypatch):
+    """
+    test that a transaction is selected after the mempool transaction
+    whose output it spends, even if it pays a higher fee rate
+    """
+    monkeypatch.setattr(hchaindb, "get_transaction", lambda key: {"value": 100})
+    parent = make_transaction(value=95)
+    child  = make_transaction([(parent["transactionid"], 0)], value=5)
+    other  = make_transaction(value=50)
+    for trx in (parent, other, child): hmempool.add_transaction(trx)
+
+    assert hmempool.mempool[child["transactionid"]]["fee"] == 90
+    entries = hmempool.select_transactions(1_000_000)
+    assert [entry["tx"] for entry in entries] == [other, parent, child]
+
+
+def test_select_size_limit(monkeypatch):
+    """
+    test that the selection stops when the next transaction does not fit
+    """
+    monkeypatch.setattr(hchaindb, "get_transaction", lambda key: {"value": 100})
+    trxs = [make_transaction(value=value) for value in (10, 20, 30)]
+    for trx in trxs: hmempool.add_transaction(trx)
+
+    size = hmempool.mempool[trxs[0]["transactionid"]]["size"]
+    entries = hmempool.select_transactions(2 * size)
+    assert [entry["tx"] for entry in entries] == trxs[:2]
+
+
+def test_timelock_queue():
+    """
+    test that a transaction with a future locktime waits in the timelock
+    queue until its locktime is reached
+    """
+    trxs = [make_transaction() for __ctr in range(3)]
+    for trx, locktime in zip(trxs, (3000, 2000, 0)):
+        trx["locktime"] = locktime
+        hmempool.add_transaction(trx, 1000)
+
+    assert len(hmempool.timelock_heap) == 2
+    assert [entry["tx"] for entry in hmempool.select_transactions(1_000_000, 1000)] == trxs[2:]
+    assert hmempool.release_transactions(2500) == [trxs[1]["transactionid"]]
+    assert hmempool.release_transactions(2500) == []
+    assert len(hmempool.select_transactions(1_000_000, 3000)) == 3
+    assert len(hmempool.timelock_heap) == 0
+
+
+def test_select_skips_removed_transactions():
+    """
+    test that removed transactions are not selected and that the fee rate
+    heap is compacted
+    """
+    trxs = [make_transaction() for __ctr in range(10)]
+    for trx in trxs: hmempool.add_transaction(trx)
+    for trx in trxs[:6]: hmempool.remove_transaction(trx["transactionid"])
+
+    entries = hmempool.select_transactions(1_000_000)
+    assert [entry["tx"] for entry in entries] == trxs[6:]
+
+    hmempool.compact_heap(hmempool.fee_heap)
+    assert len(hmempool.fee_heap) == 4
+
+
+def test_evict_lowest_fee_rate(monkeypatch):
+    """
+    test that a full mempool evicts the transaction with the lowest fee
+    rate together with its descendants
+    """
+    monkeypatch.setattr(hchaindb, "get_transaction", lambda key: {"value": 100})
+    low   = make_transaction(value=90)
+    child = make_transaction([(low["transactionid"], 0)], value=10)
+    high  = make_transaction(value=10)
+    for trx in (low, child, high): hmempool.add_transaction(trx)
+
+    size = hmempool.total_size
+    monkeypatch.setitem(hconfig.conf, "MEMPOOL_MAX_SIZE", size)
+    newer = make_transaction(value=50)
+    assert hmempool.add_transaction(newer) == True
+
+    assert hmempool.transactions() == [high, newer]
+    assert hmempool.total_size == sum(entry["size"] for entry in hmempool.mempool.values())
+    assert len(hmempool.spent_index) == 2
+
+
+def test_evict_new_transaction(monkeypatch):
+    """
+    test that a transaction which pays less than the transactions in a
+    full mempool is not added
+    """
+    monkeypatch.setattr(hchaindb, "get_transaction", lambda key: {"value": 100})
+    high = make_transaction(value=10)
+    hmempool.add_transaction(high)
+
+    monkeypatch.setitem(hconfig.conf, "MEMPOOL_MAX_SIZE", hmempool.total_size)
+    assert hmempool.add_transaction(make_transaction(value=90)) == False
+    assert hmempool.transactions() == [high]
+
+
+def test_expire_transactions(monkeypatch):
+    """
+    test that transactions expire with their descendants
+    """
+    monkeypatch.setitem(hconfig.conf, "MEMPOOL_EXPIRY", 100)
+    old    = make_transaction()
+    child  = make_transaction([(old["transactionid"], 0)])
+    recent = make_transaction()
+    hmempool.add_transaction(old, 1000)
+    hmempool.add_transaction(child, 1150)
+    hmempool.add_transaction(recent, 1150)
+
+    assert hmempool.expire_transactions(1200) == [old["transactionid"], child["transactionid"]]
+    assert hmempool.transactions() == [recent]
+    assert [entry["tx"] for entry in hmempool.select_transactions(1_000_000, 1200)] == [recent]
+
+
+def test_reject_conflicting_spend(monkeypatch):
+    """
+    test that a transaction which spends a fragment that is spent in the
+    mempool, and pays no more, is rejected
+    """
+    monkeypatch.setattr(hchaindb, "get_transaction", lambda key: {"value": 100})
+    monkeypatch.setattr(tx, "validate_transaction", lambda x, y: True)
+    prev_txid = rcrypt.make_uuid()
+    first  = make_transaction([(prev_txid, 0)], value=50)
+    second = make_transaction([(prev_txid, 0)], value=60)
+
+    assert hmempool.accept_transaction(first) == True
+    assert hmempool.accept_transaction(second) == False
+    assert hmempool.transactions() == [first]
+
+
+def test_replace_conflicting_spend(monkeypatch):
+    """
+    test that a conflicting transaction which pays more replaces the
+    mempool transaction and its descendants
+    """
+    monkeypatch.setattr(hchaindb, "get_transaction", lambda key: {"value": 100})
+    monkeypatch.setattr(tx, "validate_transaction", lambda x, y, z=None: True)
+    prev_txid = rcrypt.make_uuid()
+    first  = make_transaction([(prev_txid, 0)], value=90)
+    child  = make_transaction([(first["transactionid"], 0)], value=85)
+    second = make_transaction([(prev_txid, 0)], value=20)
+
+    assert hmempool.accept_transaction(first) == True
+    assert hmempool.accept_transaction(child) == True
+    assert hmempool.accept_transaction(second) == True
+    assert hmempool.transactions() == [second]
+    assert hmempool.spender(prev_txid + "_0") == second["transactionid"]
+
+
+def test_replacement_must_fit(monkeypatch):
+    """
+    test that a replacement which would be evicted from a full mempool
+    does not remove the transaction that it replaces
+    """
+    monkeypatch.setattr(hchaindb, "get_transaction", lambda key: {"value": 100})
+    monkeypatch.setattr(tx, "validate_transaction", lambda x, y, z=None: True)
+    prev_txid = rcrypt.make_uuid()
+    high   = make_transaction(value=10)
+    first  = make_transaction([(prev_txid, 0)], value=90)
+    second = make_transaction([(prev_txid, 0)], value=60)
+
+    assert hmempool.accept_transaction(high) == True
+    assert hmempool.accept_transaction(first) == True
+    monkeypatch.setitem(hconfig.conf, "MEMPOOL_MAX_SIZE", hmempool.total_size - 1)
+
+    assert hmempool.accept_transaction(second) == False
+    assert hmempool.transactions() == [high, first]
+    assert hmempool.spender(prev_txid + "_0") == first["transactionid"]
+
+
+def test_invalid_conflicting_spend_fails_fast(monkeypatch):
+    """
+    test that an invalid transaction which spends the fragment of a mempool
+    transaction is rejected before the replacement checks
+    """
+    monkeypatch.setattr(hchaindb, "get_transaction", lambda key: {"value": 100})
+    monkeypatch.setattr(tx, "validate_transaction", lambda x, y, z=None: x["vout"][0]["value"] != 60)
+    def replaceable(trx, conflicting):
+        raise(AssertionError("replacement checked"))
+    prev_txid = rcrypt.make_uuid()
+    first  = make_transaction([(prev_txid, 0)], value=90)
+    second = make_transaction([(prev_txid, 0)], value=60)
+
+    assert hmempool.accept_transaction(first) == True
+    monkeypatch.setattr(hmempool, "replaceable", replaceable)
+    monkeypatch.setattr(hmempool, "fits", replaceable)
+    assert hmempool.accept_transaction(second) == False
+    assert hmempool.transactions() == [first]
+
+
+def test_smallest_items():
+    """
+    test that the items of a heap are yielded in ascending order and that
+    the heap is not changed
+    """
+    heap = [random.randrange(1000) for __ctr in range(200)]
+    heapq.heapify(heap)
+    copy = list(heap)
+    assert list(hmempool.smallest_items(heap)) == sorted(heap)
+    assert list(itertools.islice(hmempool.smallest_items(heap), 3)) == sorted(heap)[:3]
+    assert list(hmempool.smallest_items([])) == []
+    assert heap == copy
+
+
+def test_replacement_cannot_spend_replaced_output(monkeypatch):
+    """
+    test that a transaction cannot replace the transaction whose output
+    it spends
+    """
+    monkeypatch.setattr(hchaindb, "get_transaction", lambda key: {"value": 100})
+    monkeypatch.setattr(tx, "validate_transaction", lambda x, y, z=None: True)
+    prev_txid = rcrypt.make_uuid()
+    first = make_transaction([(prev_txid, 0)], value=90)
+    assert hmempool.accept_transaction(first) == True
+
+    spender = make_transaction([(prev_txid, 0), (first["transactionid"], 0)], value=10)
+    assert hmempool.accept_transaction(spender) == False
+    assert hmempool.transactions() == [first]
+
+
+def test_validate_against_mempool_outputs(monkeypatch):
+    """
+    test that a transaction which spends a mempool output is validated
+    against that output
+    """
+    validated = []
+    def validate(trx, zero_inputs, pending=None):
+        validated.append(pending)
+        return True
+
+    monkeypatch.setattr(tx, "validate_transaction", validate)
+    parent = make_transaction(value=70)
+    child  = make_transaction([(parent["transactionid"], 0)])
+
+    assert hmempool.accept_transaction(parent) == True
+    assert hmempool.accept_transaction(child) == True
+    assert validated[0] == None
+    assert validated[1] == {parent["transactionid"] + "_0": {"pkhash": "pkhash", 
+                            "value": 70, "spent": False, "tx_chain": "",
+                            "height": None, "coinbase": False}}
+    assert hmempool.mempool[child["transactionid"]]["fee"] == 60
+
+
+def test_save_and_load_mempool(monkeypatch, tmp_path):
+    """
+    test that a saved mempool is reloaded with its metadata, without
+    verifying signatures, and that transactions which are no longer valid
+    are dropped
+    """
+    prev_txids = [rcrypt.make_uuid() for __ctr in range(3)]
+    chainstate = {txid + "_0": {"pkhash": "pkhash", "value": 100, "spent": False,
+                  "tx_chain": ""} for txid in prev_txids}
+    monkeypatch.setattr(hchaindb, "get_transaction", lambda key: chainstate.get(key, False))
+
+    def no_signatures(*args):
+        raise(AssertionError("signatures verified"))
+    monkeypatch.setattr(tx, "validate_scripts", no_signatures)
+
+    trxs  = [make_transaction([(txid, 0)], value=40) for txid in prev_txids]
+    child = make_transaction([(trxs[0]["transactionid"], 0)], value=30)
+    for trx in trxs + [child]: hmempool.add_transaction(trx, 1000)
+
+    filepath = str(tmp_path / "mempool.dat")
+    assert hmempool.save_mempool(filepath) == True
+    saved = {txid: dict(entry) for txid, entry in hmempool.mempool.items()}
+    hmempool.clear()
+
+    # the fragment spent by the second transaction has been spent in a block
+    chainstate[prev_txids[1] + "_0"]["spent"] = True
+    monkeypatch.setattr(tx, "validate_transaction", no_signatures)
+
+    assert hmempool.load_mempool(filepath, 2000) == 3
+    assert hmempool.transactions() == [trxs[0], trxs[2], child]
+    for txid, entry in hmempool.mempool.items():
+        assert entry["time"] == 1000
+        assert entry["fee"] == saved[txid]["fee"]
+        assert entry["size"] == saved[txid]["size"]
+
+
+def test_load_missing_mempool(tmp_path):
+    """
+    test that a missing mempool file is not loaded
+    """
+    assert hmempool.load_mempool(str(tmp_path / "missing.dat")) == False
+    assert len(hmempool.mempool) == 0
+
+
+def test_change_log():
+    """
+    test that transactions entering and leaving the mempool are logged
+    and that an overflowing log is discarded
+    """
+    assert hmempool.drain_changes() == None
+
+    locked = make_transaction()
+    locked["locktime"] = 2000
+    trx = make_transaction()
+    hmempool.add_transaction(trx, 1000)
+    hmempool.add_transaction(locked, 1000)
+    hmempool.remove_transaction(trx["transactionid"])
+    hmempool.release_transactions(2000)
+
+    assert hmempool.drain_changes() == [("add", trx["transactionid"]),
+                                        ("remove", trx["transactionid"]),
+                                        ("add", locked["transactionid"])]
+    assert hmempool.drain_changes() == []
+
+    for __ctr in range(hmempool.MAX_CHANGES + 1):
+        hmempool.add_transaction(make_transaction())
+    assert hmempool.drain_changes() == None
+    assert hmempool.drain_changes() == []
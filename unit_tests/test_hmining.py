@@ -2,19 +2,24 @@
    pytest unit tests for hmining module
 """
 import hmining
+import hmempool
 import hblockchain
+import hpow
 import tx
 import hchaindb
 import blk_index
 import hconfig
 import rcrypt
 import plyvel
+import asyncio
 import random
 import secrets
+import threading
 import time
 import pytest
 import pdb
 import os
+import pickle
 
 
 def teardown_module():
@@ -97,6 +102,7 @@ def test_mining_reward(block_height, reward):
     hconfig.conf["MINING_REWARD"] = 50
     assert hmining.mining_reward(block_height) == reward
     hconfig.conf["MINING_REWARD"] = 5_000_000
+    hconfig.conf["REWARD_INTERVAL"] = 210000
 
 
 def test_tx_in_mempool(monkeypatch):
@@ -104,15 +110,15 @@ def test_tx_in_mempool(monkeypatch):
     test do not add transaction to mempool if it is
     already in the mempool
     """
-    hmining.mempool.clear()
+    hmempool.clear()
     monkeypatch.setattr(tx, "validate_transaction", lambda x: True)
     monkeypatch.setattr(hchaindb, "get_transaction", lambda x: True)
 
     syn_tx = make_synthetic_transaction()
-    hmining.mempool.append(syn_tx)
+    hmempool.add_transaction(syn_tx)
     assert hmining.receive_transaction(syn_tx) == False
-    assert len(hmining.mempool) == 1
-    hmining.mempool.clear()
+    assert len(hmempool.mempool) == 1
+    hmempool.clear()
 
 
 def test_tx_in_chainstate(monkeypatch):
@@ -120,11 +126,11 @@ def test_tx_in_chainstate(monkeypatch):
     test do not add transaction if it is accounted for in the 
     Chainstate
     """
-    hmining.mempool.clear()
+    hmempool.clear()
     monkeypatch.setattr(hchaindb, "get_transaction", lambda x: {"mock": "fragment"})
     syn_tx = make_synthetic_transaction()
     assert hmining.receive_transaction(syn_tx) == True
-    hmining.mempool.clear()
+    hmempool.clear()
 
 
 def test_invalid_transaction(monkeypatch):
@@ -133,10 +139,10 @@ def test_invalid_transaction(monkeypatch):
    """
    monkeypatch.setattr(hchaindb, "get_transaction", lambda x: False)
    monkeypatch.setattr(tx, "validate_transaction", lambda x: False)
-   hmining.mempool.clear()
+   hmempool.clear()
    syn_tx = make_synthetic_transaction()
    assert hmining.receive_transaction(syn_tx) == False
-   assert len(hmining.mempool) == 0
+   assert len(hmempool.mempool) == 0
 
 
 def test_valid_transaction(monkeypatch):
@@ -145,18 +151,18 @@ def test_valid_transaction(monkeypatch):
    """
    monkeypatch.setattr(hchaindb, "get_transaction", lambda x: False)
    monkeypatch.setattr(tx, "validate_transaction", lambda x, y: True, False)
-   hmining.mempool.clear()
+   hmempool.clear()
    syn_tx = make_synthetic_transaction()
    assert hmining.receive_transaction(syn_tx) == True
-   assert len(hmining.mempool) == 1
-   hmining.mempool.clear()
+   assert len(hmempool.mempool) == 1
+   hmempool.clear()
 
 
 def test_make_from_empty_mempool():
     """
     test cannot make a candidate block when the mempool is empty
     """
-    hmining.mempool.clear()
+    hmempool.clear()
     assert hmining.make_candidate_block() == False
  
 
@@ -167,10 +173,10 @@ def test_future_lock_time(monkeypatch):
     monkeypatch.setattr(tx, "validate_transaction", lambda x: True)
     monkeypatch.setattr(hchaindb, "get_transaction", lambda x: True)
 
-    hmining.mempool.clear()
+    hmempool.clear()
     tx1 = make_synthetic_transaction()
     tx1["locktime"] = int(time.time()) + 86400
-    hmining.mempool.append(tx1)
+    hmempool.add_transaction(tx1)
 
     assert(bool(hmining.make_candidate_block())) == False
 
@@ -179,7 +185,7 @@ def test_no_transactions():
     """ 
     test that candidate blocks with no transactions are not be processed"
     """
-    hmining.mempool.clear()
+    hmempool.clear()
     tx1 = make_synthetic_transaction()
     tx1[tx] = []
     assert hmining.make_candidate_block() == False
@@ -224,10 +230,33 @@ def test_mine_block(monkeypatch):
     monkeypatch.setattr(blk_index, "put_index", lambda x,y: True)
 
     # make the mining easier
-    hconfig.conf["DIFFICULTY_NUMBER"] = 0.0001
+    monkeypatch.setitem(hconfig.conf, "DIFFICULTY_TARGET", 2**255)
     assert hmining.mine_block(block) != False
     
 
+def test_mine_block_at_expected_target(monkeypatch):
+    """
+    test that a candidate block is mined at the expected target of a child
+    of the tip, which changes after a retarget
+    """
+    targets = []
+    monkeypatch.setattr(hpow, "mine", lambda block, workers, target: targets.append(target) or False)
+
+    block1, block2 = make_tree_blockchain()
+    tip = hblockchain.blockheader_hash(block2)
+    hblockchain.header_index[tip]["target"] = 2**230
+    candidate = make_child_block(block2)
+
+    assert asyncio.run(hmining.mine_block(candidate)) == False
+    assert targets == [hblockchain.child_target(tip)]
+    assert targets[0] != hconfig.conf["DIFFICULTY_TARGET"]
+
+    hblockchain.blockchain.clear()
+    hblockchain.block_tree.clear()
+    hblockchain.header_index.clear()
+    hblockchain.best_header = None
+
+
 def test_receive_bad_block(monkeypatch):
     """
     test that received block is not added to the received_blocks
@@ -247,6 +276,7 @@ def test_receive_stale_block(monkeypatch):
     test that received block is not added to the received_blocks
     list if the block height is old
     """
+    monkeypatch.setattr(hmining, "proof_of_work", lambda x: True)
     monkeypatch.setattr(hblockchain, "validate_block", lambda x,y: True)
     monkeypatch.setattr(hchaindb, "get_transaction", lambda x: True)
     monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
@@ -258,7 +288,7 @@ def test_receive_stale_block(monkeypatch):
         hblockchain.blockchain.append(block)
 
     syn_block = make_synthetic_block()
-    syn_block["height"] = 47
+    syn_block["height"] = 46
 
     assert hmining.receive_block(syn_block) == False
     hblockchain.blockchain.clear()
@@ -266,24 +296,37 @@ def test_receive_stale_block(monkeypatch):
 
 def test_receive_future_block(monkeypatch):
     """
-    test that received block is not added to the received_blocks
-    list if the block height is too large
+    test that a block which is received ahead of its parent is held in 
+    the orphan pool and is connected when its parent is received
     """
-    monkeypatch.setattr(hblockchain, "validate_block", lambda x,y: True)
+    monkeypatch.setattr(hmining, "proof_of_work", lambda x: True)
+    monkeypatch.setattr(hblockchain, "validate_block", extends_tip)
     monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
-    monkeypatch.setattr(hchaindb, "get_transaction", lambda x: True)
-  
-    hmining.received_blocks.clear() 
-    for ctr in range(50):
-        block = make_synthetic_block()
-        block["height"] = ctr 
-        hblockchain.blockchain.append(block)
+    monkeypatch.setattr(hchaindb, "transaction_update", lambda x: True)
+    monkeypatch.setattr(blk_index, "put_index", lambda x,y: True)
+    monkeypatch.setattr(hmining, "propagate_mined_block", lambda x: True)
+    hmining.received_blocks.clear()
+    hmining.seen_blocks.clear()
+    hmining.orphan_blocks.clear()
+    hmining.orphan_children.clear()
 
-    syn_block = make_synthetic_block()
-    syn_block["height"] = 51
+    block1, block2 = make_tree_blockchain()
+    block3 = make_child_block(block2)
+    block4 = make_child_block(block3)
+
+    assert hmining.receive_block(block4) == True
+    assert list(hmining.orphan_blocks) == [hblockchain.blockheader_hash(block4)]
+    assert hblockchain.blockchain == [block1, block2]
+
+    assert hmining.receive_block(block3) == True
+    assert len(hmining.orphan_blocks) == 0
+    assert hblockchain.blockchain == [block1, block2, block3, block4]
 
-    assert hmining.receive_block(syn_block) == False
     hblockchain.blockchain.clear()
+    hblockchain.block_tree.clear()
+    hblockchain.header_index.clear()
+    hblockchain.best_header = None
+    hmining.seen_blocks.clear()
 
 
 def test_bad_difficulty_number(monkeypatch):
@@ -305,12 +348,14 @@ def test_invalid_block(monkeypatch):
     test that received block is not added to the received_blocks
     list if the block is invalid
     """
+    monkeypatch.setattr(hmining, "proof_of_work", lambda x: True)
     monkeypatch.setattr(hblockchain, "validate_block", lambda x,y: False)
     monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
     monkeypatch.setattr(hchaindb, "get_transaction", lambda x: True)
 
     hmining.received_blocks.clear() 
     block = make_synthetic_block()
+    block["timestamp"] = -1
     assert hmining.receive_block(block) == False
     assert len(hmining.received_blocks) == 0
 
@@ -328,16 +373,19 @@ def test_block_receive_once(monkeypatch):
     hmining.received_blocks.clear() 
     block1 = make_synthetic_block()
     hmining.received_blocks.append(block1)
+    hmining.seen_blocks[hblockchain.blockheader_hash(block1)] = True
 
     assert hmining.receive_block(block1) == False
     assert len(hmining.received_blocks) == 1
     hmining.received_blocks.clear()
+    hmining.seen_blocks.clear()
 
 
 def test_num_transactions(monkeypatch):
     """
     a received block must contain at least two transactions
     """
+    monkeypatch.setattr(hmining, "proof_of_work", lambda x: True)
     monkeypatch.setattr(hblockchain, "validate_block", lambda x: True)
     monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
     monkeypatch.setattr(hchaindb, "get_transaction", lambda x: True)
@@ -348,15 +396,18 @@ def test_num_transactions(monkeypatch):
     block1["tx"].append(make_synthetic_transaction())
  
     hmining.received_blocks.append(block1)
+    hmining.seen_blocks[hblockchain.blockheader_hash(block1)] = True
 
     assert hmining.receive_block(block1) == False
     assert len(hmining.received_blocks) == 1
     hmining.received_blocks.clear()
+    hmining.seen_blocks.clear()
 
 def test_coinbase_transaction_present(monkeypatch):
     """
     a received block must contain a coinbase transaction
     """
+    monkeypatch.setattr(hmining, "proof_of_work", lambda x: True)
     monkeypatch.setattr(hblockchain, "validate_block", lambda x: True)
     monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
     monkeypatch.setattr(hchaindb, "get_transaction", lambda x: True)
@@ -366,52 +417,54 @@ def test_coinbase_transaction_present(monkeypatch):
     block1["tx"] = [] 
 
     hmining.received_blocks.append(block1)
+    hmining.seen_blocks[hblockchain.blockheader_hash(block1)] = True
 
     assert hmining.receive_block(block1) == False
     assert len(hmining.received_blocks) == 1
     hmining.received_blocks.clear()
+    hmining.seen_blocks.clear()
 
 
 def test_block_in_blockchain(monkeypatch):
     """
     test if a received block is in the blockchain
     """
+    monkeypatch.setattr(hmining, "proof_of_work", lambda x: True)
     monkeypatch.setattr(hblockchain, "validate_block", lambda x: True)
     monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
     monkeypatch.setattr(hchaindb, "get_transaction", lambda x: True)
 
-    block1 = make_synthetic_block()
-    block2 = make_synthetic_block()
-    hblockchain.blockchain.append(block1)
-    hblockchain.blockchain.append(block2)
+    block1, block2 = make_tree_blockchain()
      
     assert len(hblockchain.blockchain) == 2 
     assert hmining.receive_block(block2) == False
     hblockchain.blockchain.clear()
+    hblockchain.block_tree.clear()
 
 
-def test_block_in_secondary_blockchain(monkeypatch):
+def test_block_in_block_tree(monkeypatch):
     """
-    test if a received block is in the secondary blockchain
+    test if a received block is on a competing branch of the block tree
     """
+    monkeypatch.setattr(hmining, "proof_of_work", lambda x: True)
     monkeypatch.setattr(hblockchain, "validate_block", lambda x: True)
     monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
     monkeypatch.setattr(hchaindb, "get_transaction", lambda x: True)
 
+    hblockchain.block_tree.clear()
     block1 = make_synthetic_block()
-    block2 = make_synthetic_block()
-    hblockchain.secondary_blockchain.append(block1)
-    hblockchain.secondary_blockchain.append(block2)
+    hblockchain.insert_node(block1)
      
-    assert len(hblockchain.secondary_blockchain) == 2 
-    assert hmining.receive_block(block2) == False
-    hblockchain.secondary_blockchain.clear()
+    assert len(hblockchain.block_tree) == 1 
+    assert hmining.receive_block(block1) == False
+    hblockchain.block_tree.clear()
 
 def test_add_block_received_list(monkeypatch):
     """
     add a block to the received blocks list. test for ablock
     coinbase tx
     """
+    monkeypatch.setattr(hmining, "proof_of_work", lambda x: True)
     monkeypatch.setattr(hblockchain, "validate_block", lambda x: True)
     #monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
     monkeypatch.setattr(hchaindb, "get_transaction", lambda x: True)
@@ -463,11 +516,11 @@ def test_remove_mempool_transaction():
     test removal of a transaction in the mempool
     """
     block = make_synthetic_block()
-    hmining.mempool.append(block["tx"][0])
+    hmempool.add_transaction(block["tx"][0])
 
-    assert len(hmining.mempool) == 1
+    assert len(hmempool.mempool) == 1
     assert hmining.remove_mempool_transactions(block) == True
-    assert len(hmining.mempool) == 0
+    assert len(hmempool.mempool) == 0
 
 
 def test_fork_primary_blockchain(monkeypatch):
@@ -480,7 +533,7 @@ def test_fork_primary_blockchain(monkeypatch):
     monkeypatch.setattr(hchaindb, "transaction_update", lambda x: True)
 
     hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
+    hblockchain.block_tree.clear()
     hmining.received_blocks.clear()
 
     block1 = make_synthetic_block()
@@ -499,10 +552,9 @@ def test_fork_primary_blockchain(monkeypatch):
 
     hmining.process_received_blocks()
     assert len(hblockchain.blockchain) == 4
-    assert len(hblockchain.secondary_blockchain) == 0
 
     hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
+    hblockchain.block_tree.clear()
     hmining.received_blocks.clear()
 
 
@@ -516,7 +568,7 @@ def test_append_to_primary_blockchain(monkeypatch):
     monkeypatch.setattr(hchaindb, "transaction_update", lambda x: True)
 
     hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
+    hblockchain.block_tree.clear()
     hmining.received_blocks.clear()
 
     block1 = make_synthetic_block()
@@ -535,10 +587,9 @@ def test_append_to_primary_blockchain(monkeypatch):
 
     hmining.process_received_blocks()
     assert len(hblockchain.blockchain) == 4
-    assert len(hblockchain.secondary_blockchain) == 0
 
     hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
+    hblockchain.block_tree.clear()
     hmining.received_blocks.clear()
 
 
@@ -547,9 +598,10 @@ def test_add_orphan_block(monkeypatch):
     test add_orphan_block
     """
     hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
+    hblockchain.block_tree.clear()
     hmining.received_blocks.clear()
     hmining.orphan_blocks.clear()
+    hmining.orphan_children.clear()
 
     monkeypatch.setattr(hblockchain, "blockheader_hash", lambda x: "mock_hash")
     monkeypatch.setattr(tx, "validate_transaction", lambda x,y : True)
@@ -561,6 +613,8 @@ def test_add_orphan_block(monkeypatch):
     block1 = make_synthetic_block()
     block1["height"] = block0["height"] + 1
     block1["prevblockhash"] = "mock_hash"
+    block1["tx"][0]["vout"][0]["value"] = hmining.mining_reward(block1["height"])
+    block1["merkle_root"] = hblockchain.merkle_root(block1["tx"], True)
 
     hblockchain.blockchain.append(block0)
     hmining.received_blocks.append(block1)
@@ -569,227 +623,705 @@ def test_add_orphan_block(monkeypatch):
     hmining.process_received_blocks()
     assert len(hmining.orphan_blocks) == 0
     assert len(hblockchain.blockchain) == 2
-    assert len(hblockchain.secondary_blockchain) == 0
     
     hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
+    hblockchain.block_tree.clear()
     hmining.received_blocks.clear()
 
 
-def test_swap_blockchain():
+def test_remove_stale_orphans(monkeypatch):
     """
-    test swap the primary and secondary blockchains 
+    test to remove old orphan blocks
     """
     hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
+    hblockchain.block_tree.clear()
     hmining.received_blocks.clear()
+    hmining.orphan_blocks.clear()
+    hmining.orphan_children.clear()
 
     block1 = make_synthetic_block()
+    block1["height"] = 1290
     block2 = make_synthetic_block()
-    block3 = make_synthetic_block()
-    block4 = make_synthetic_block()
-    block4["prevblockhash"] = hblockchain.blockheader_hash(block3)
+    block2["height"] = 1285
+
+    monkeypatch.setattr(hblockchain, "blockheader_hash", lambda x: "mock_hash")
+    monkeypatch.setattr(tx, "validate_transaction", lambda x,y : True)
+    monkeypatch.setattr(hchaindb, "transaction_update", lambda x : True)
+    monkeypatch.setattr(blk_index, "put_index", lambda x,y : True)
+
 
     hblockchain.blockchain.append(block1)
-    hblockchain.secondary_blockchain.append(block2)
-    hblockchain.secondary_blockchain.append(block3)
-    hblockchain.secondary_blockchain.append(block4)
     assert len(hblockchain.blockchain) == 1
-    assert len(hblockchain.secondary_blockchain) == 3
+    hmining.orphan_blocks["mock_hash"] = {"block": block2, "time": int(time.time())}
+    hmining.orphan_children[block2["prevblockhash"]] = ["mock_hash"]
+    assert len(hmining.orphan_blocks) == 1
     
-    hmining.swap_blockchains()
-    assert len(hblockchain.blockchain) == 3
-    assert len(hblockchain.secondary_blockchain) == 1
 
+    hmining.handle_orphans()
+    assert len(hmining.orphan_blocks) == 0
+    assert len(hblockchain.blockchain) == 1
+    
     hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
+    hblockchain.block_tree.clear()
+    hmining.orphan_blocks.clear()
+    hmining.orphan_children.clear()
 
 
-def test_clear_blockchain():
+def make_tree_blockchain():
     """
-    test clear the secondary blockchains 
+    makes a blockchain of two synthetic blocks which is also in the block tree.
+    The blocks do not change the chainstate.
     """
     hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
-    hmining.received_blocks.clear()
+    hblockchain.block_tree.clear()
+    hblockchain.header_index.clear()
+    hblockchain.best_header = None
 
     block1 = make_synthetic_block()
     block2 = make_synthetic_block()
-    block3 = make_synthetic_block()
-    block4 = make_synthetic_block()
-    block5 = make_synthetic_block()
+    block2["height"] = block1["height"] + 1
+    block2["prevblockhash"] = hblockchain.blockheader_hash(block1)
 
-    hblockchain.blockchain.append(block1)
-    hblockchain.blockchain.append(block2)
-    hblockchain.secondary_blockchain.append(block3)
-    hblockchain.blockchain.append(block4)
-    hblockchain.blockchain.append(block5)
-    assert len(hblockchain.secondary_blockchain) == 1
-    assert len(hblockchain.blockchain) == 4
-    
-    hmining.swap_blockchains()
-    assert len(hblockchain.blockchain) == 4
-    assert len(hblockchain.secondary_blockchain) == 0
+    for block in [block1, block2]:
+        hblockchain.blockchain.append(block)
+        hblockchain.best_tip = hblockchain.blockheader_hash(block)
+        node = hblockchain.insert_node(block, hblockchain.best_tip)
+        node["changes"] = {"undo": {}, "redo": {}}
+        hblockchain.insert_header(hblockchain.block_header(block), hblockchain.best_tip)
 
-    hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
+    return block1, block2
 
 
-def test_remove_stale_orphans(monkeypatch):
+def make_child_block(parent):
     """
-    test to remove old orphan blocks
+    makes a synthetic block which extends parent
+    """
+    block = make_synthetic_block()
+    block["height"] = parent["height"] + 1
+    block["prevblockhash"] = hblockchain.blockheader_hash(parent)
+    return block
+
+
+def extends_tip(block):
+    """
+    mock validate_block: the block must extend the blockchain
     """
+    return block["prevblockhash"] == hblockchain.blockheader_hash(hblockchain.blockchain[-1])
+
+
+def test_add_block_to_branch(monkeypatch):
+    """
+    test that a block which forks the blockchain with equal work is tracked 
+    in the block tree and does not replace the blockchain
+    """
+    monkeypatch.setattr(hblockchain, "validate_block", extends_tip)
+    monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
+    monkeypatch.setattr(hchaindb, "transaction_update", lambda x: True)
+    monkeypatch.setattr(blk_index, "put_index", lambda x,y: True)
+
+    block1, block2 = make_tree_blockchain()
+    fork = make_child_block(block1)
+
+    assert hmining.connect_block(fork) == []
+    assert hblockchain.blockheader_hash(fork) in hblockchain.block_tree
+    assert hblockchain.blockchain == [block1, block2]
+    assert hblockchain.best_tip == hblockchain.blockheader_hash(block2)
+
     hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
-    hmining.received_blocks.clear()
-    hmining.orphan_blocks.clear()
+    hblockchain.block_tree.clear()
 
-    block1 = make_synthetic_block()
-    block1["height"] = 1290
-    block2 = make_synthetic_block()
-    block2["height"] = 1285
 
-    monkeypatch.setattr(hblockchain, "blockheader_hash", lambda x: "mock_hash")
-    monkeypatch.setattr(tx, "validate_transaction", lambda x,y : True)
-    monkeypatch.setattr(hchaindb, "transaction_update", lambda x : True)
-    monkeypatch.setattr(blk_index, "put_index", lambda x,y : True)
+def test_reorganize_to_heavier_branch(monkeypatch):
+    """
+    test that the blockchain is reorganized onto a branch with more work
+    and that only the blocks after the fork point are replaced
+    """
+    monkeypatch.setattr(hblockchain, "validate_block", extends_tip)
+    monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
+    monkeypatch.setattr(hchaindb, "transaction_update", lambda x: True)
+    monkeypatch.setattr(blk_index, "put_index", lambda x,y: True)
 
+    block1, block2 = make_tree_blockchain()
+    fork1 = make_child_block(block1)
+    fork2 = make_child_block(fork1)
 
-    hblockchain.blockchain.append(block1)
-    assert len(hblockchain.blockchain) == 1
-    hmining.orphan_blocks.append(block2)
-    assert len(hmining.orphan_blocks) == 1
-    
+    assert hmining.connect_block(fork1) == []
+    assert hmining.connect_block(fork2) == [fork1, fork2]
+    assert hblockchain.blockchain == [block1, fork1, fork2]
+    assert hblockchain.best_tip == hblockchain.blockheader_hash(fork2)
+    assert hblockchain.on_blockchain(hblockchain.blockheader_hash(block2)) == False
+    assert hblockchain.tip_work() == 3 * hblockchain.block_work(block1)
 
-    hmining.handle_orphans()
-    assert len(hmining.orphan_blocks) == 0
-    assert len(hblockchain.blockchain) == 1
-    assert len(hblockchain.secondary_blockchain) == 0
-    
     hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
-    hmining.orphan_blocks.clear()
+    hblockchain.block_tree.clear()
 
 
-def test_add_orphan_to_blockchain(monkeypatch):
+def test_work_from_expected_target(monkeypatch):
     """
-    test to add orphan block to blockchain
+    test that the work of a block is computed from the expected target of
+    its header, so that a longer branch of easy blocks loses to a shorter
+    branch of hard blocks
     """
-    hmining.orphan_blocks.clear()
+    monkeypatch.setattr(hblockchain, "validate_block", extends_tip)
+    monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
+    monkeypatch.setattr(hchaindb, "transaction_update", lambda x: True)
+    monkeypatch.setattr(blk_index, "put_index", lambda x,y: True)
+
+    def make_branch_block(parent, target):
+        block = make_child_block(parent)
+        blkhash = hblockchain.blockheader_hash(block)
+        hblockchain.insert_header(hblockchain.block_header(block), blkhash)
+        hblockchain.header_index[blkhash]["target"] = target
+        return block
+
+    block1, block2 = make_tree_blockchain()
+    easy1 = make_branch_block(block1, 2**244)
+    easy2 = make_branch_block(easy1, 2**244)
+    easy3 = make_branch_block(easy2, 2**244)
+    hard1 = make_branch_block(block1, 2**230)
+
+    assert hblockchain.block_work(easy1, 2**244) == 2**256 // (2**244 + 1)
+    for block in [easy1, easy2, easy3]:
+        assert hmining.connect_block(block) == []
+    assert hblockchain.blockchain == [block1, block2]
+
+    assert hmining.connect_block(hard1) == [hard1]
+    assert hblockchain.blockchain == [block1, hard1]
+
     hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
-    hmining.received_blocks.clear()
+    hblockchain.block_tree.clear()
+    hblockchain.header_index.clear()
+    hblockchain.best_header = None
 
-    monkeypatch.setattr(hblockchain, "validate_block", lambda x: True)
-    monkeypatch.setattr(hblockchain, "blockheader_hash", lambda x: "mockvalue")
-    monkeypatch.setattr(tx, "validate_transaction", lambda x, y: True)
+
+def test_reorganize_invalid_branch(monkeypatch):
+    """
+    test that the blockchain is restored if a branch block is invalid
+    """
+    monkeypatch.setattr(hblockchain, "validate_block", 
+                        lambda x: extends_tip(x) and x.get("invalid") == None)
+    monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
     monkeypatch.setattr(hchaindb, "transaction_update", lambda x: True)
-    monkeypatch.setattr(blk_index, "put_index", lambda x, y: True)
+    monkeypatch.setattr(blk_index, "put_index", lambda x,y: True)
 
+    block1, block2 = make_tree_blockchain()
+    fork1 = make_child_block(block1)
+    fork1["invalid"] = True
+    fork2 = make_child_block(fork1)
 
-    block0 = make_synthetic_block()
-    block1 = make_synthetic_block()
-    block1["height"] = 1290
-    block2 = make_synthetic_block()
-    block2["height"] = 1291
+    assert hmining.connect_block(fork1) == []
+    assert hmining.connect_block(fork2) == []
+    assert hblockchain.blockchain == [block1, block2]
+    assert hblockchain.best_tip == hblockchain.blockheader_hash(block2)
+    assert hblockchain.blockheader_hash(fork2) not in hblockchain.block_tree
 
-    hblockchain.blockchain.append(block0)    
-    hblockchain.blockchain.append(block1)
-    assert len(hblockchain.blockchain) == 2
-    hmining.orphan_blocks.append(block2)
-    assert len(hmining.orphan_blocks) == 1
-    
-    block2["prevblockhash"] = "mockvalue"
+    hblockchain.blockchain.clear()
+    hblockchain.block_tree.clear()
 
-    hmining.handle_orphans()
+
+def test_add_orphan_to_block_tree(monkeypatch):
+    """
+    test that an orphan whose parent is on a branch of the block tree is 
+    attached to the branch
+    """
+    monkeypatch.setattr(hblockchain, "validate_block", extends_tip)
+    monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
+    monkeypatch.setattr(hchaindb, "transaction_update", lambda x: True)
+    monkeypatch.setattr(blk_index, "put_index", lambda x,y: True)
+    hmining.orphan_blocks.clear()
+    hmining.orphan_children.clear()
+
+    block1, block2 = make_tree_blockchain()
+    fork1 = make_child_block(block1)
+    fork2 = make_child_block(fork1)
+    hblockchain.insert_node(fork1)
+
+    assert hmining.add_orphan(fork2) == True
+    hmining.handle_orphans(hblockchain.blockheader_hash(fork1))
     assert len(hmining.orphan_blocks) == 0
-    assert len(hblockchain.blockchain) == 3
-    assert len(hblockchain.secondary_blockchain) == 0
-    
+    assert len(hmining.orphan_children) == 0
+    assert hblockchain.blockchain == [block1, fork1, fork2]
+
     hblockchain.blockchain.clear()
+    hblockchain.block_tree.clear()
     hmining.orphan_blocks.clear()
+    hmining.orphan_children.clear()
 
 
-def test_add_orphan_to_secondary_blockchain(monkeypatch):
+def test_add_orphans_to_blockchain(monkeypatch):
     """
-    test to add orphan block to the secondary blockchain
+    test that orphan blocks received out of order are connected recursively 
+    when their missing ancestor arrives
     """
+    monkeypatch.setattr(hblockchain, "validate_block", extends_tip)
+    monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
+    monkeypatch.setattr(hchaindb, "transaction_update", lambda x: True)
+    monkeypatch.setattr(blk_index, "put_index", lambda x,y: True)
+    monkeypatch.setattr(hmining, "propagate_mined_block", lambda x: True)
     hmining.orphan_blocks.clear()
-    hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
+    hmining.orphan_children.clear()
     hmining.received_blocks.clear()
 
-    #monkeypatch.setattr(hblockchain, "validate_block", lambda x: True)
-    monkeypatch.setattr(tx, "validate_transaction", lambda x, y: True)
-    monkeypatch.setattr(hchaindb, "transaction_update", lambda x: True)
-    monkeypatch.setattr(blk_index, "put_index", lambda x, y: True)
+    block1, block2 = make_tree_blockchain()
+    block3 = make_child_block(block2)
+    block4 = make_child_block(block3)
+    block5 = make_child_block(block4)
 
+    hmining.received_blocks.append(block5)
+    hmining.process_received_blocks()
+    hmining.received_blocks.append(block4)
+    hmining.process_received_blocks()
+    assert len(hmining.orphan_blocks) == 2
+    assert hmining.orphan_children[hblockchain.blockheader_hash(block3)] == \
+           [hblockchain.blockheader_hash(block4)]
 
-    block0 = make_synthetic_block()
-    hblockchain.blockchain.append(block0)
-    
-    block1 = make_synthetic_block()
-    block1["height"] = 1290
-    block2 = make_synthetic_block()
-    block2["height"] = 1291
-    block3 = make_synthetic_block()
-    block3["height"] = 1292
+    hmining.received_blocks.append(block3)
+    hmining.process_received_blocks()
+    assert len(hmining.orphan_blocks) == 0
+    assert len(hmining.orphan_children) == 0
+    assert hblockchain.blockchain == [block1, block2, block3, block4, block5]
 
-    block3["prevblockhash"] = hblockchain.blockheader_hash(block2)
+    hblockchain.blockchain.clear()
+    hblockchain.block_tree.clear()
+    hmining.received_blocks.clear()
 
-    hblockchain.secondary_blockchain.append(block1)
-    hblockchain.secondary_blockchain.append(block2)
-    assert len(hblockchain.secondary_blockchain) == 2
-    hmining.orphan_blocks.append(block3)
-    assert len(hmining.orphan_blocks) == 1
-    hmining.handle_orphans()
-    assert len(hmining.orphan_blocks) == 0
-    assert len(hblockchain.secondary_blockchain) == 1
-    assert len(hblockchain.blockchain) == 3
-    
+
+def test_evict_orphans(monkeypatch):
+    """
+    test that expired orphans are evicted and that the oldest orphans are 
+    evicted when there are more than MAX_ORPHAN_BLOCKS orphans
+    """
+    monkeypatch.setitem(hconfig.conf, "MAX_ORPHAN_BLOCKS", 2)
     hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
     hmining.orphan_blocks.clear()
+    hmining.orphan_children.clear()
 
+    now = int(time.time())
+    blocks = [make_synthetic_block() for __ctr in range(4)]
+    hashes = [hblockchain.blockheader_hash(block) for block in blocks]
 
+    hmining.add_orphan(blocks[0], now - hconfig.conf["ORPHAN_EXPIRY"] - 1)
+    assert hmining.add_orphan(blocks[1], now) == True
+    assert list(hmining.orphan_blocks) == [hashes[1]]
 
+    hmining.add_orphan(blocks[2], now)
+    hmining.add_orphan(blocks[3], now)
+    assert list(hmining.orphan_blocks) == hashes[2:]
+    assert hashes[1] not in hmining.orphan_children.get(blocks[1]["prevblockhash"], [])
+
+    hmining.orphan_blocks.clear()
+    hmining.orphan_children.clear()
 
-def test_append_to_secondary_blockchain(monkeypatch):
+
+def test_receive_duplicate_block(monkeypatch):
     """
-    test add a received block to the primary blockchain
+    test that a block is only processed the first time it is received
+    and that a rejected block is dropped without validation
     """
-    #monkeypatch.setattr(hblockchain, "validate_block", lambda x: True)
+    checked = []
+    monkeypatch.setattr(hmining, "proof_of_work", lambda x: checked.append(x) == None)
+    hmining.received_blocks.clear()
+    hmining.seen_blocks.clear()
+    hmining.rejected_blocks.clear()
+
+    block = make_synthetic_block()
+    block["version"] = "-1"
+    assert hmining.receive_block(block) == False
+    assert hblockchain.blockheader_hash(block) in hmining.rejected_blocks
+    assert hmining.receive_block(block) == False
+    assert len(checked) == 1
+
+    monkeypatch.setattr(hmining, "process_received_blocks", lambda: True)
+    block = make_synthetic_block()
+    assert hmining.receive_block(block) == True
+    assert hmining.receive_block(dict(block)) == False
+    assert len(checked) == 2
+    assert len(hmining.received_blocks) == 1
+
+    hmining.received_blocks.clear()
+    hmining.seen_blocks.clear()
+    hmining.rejected_blocks.clear()
+
+
+def test_losing_fork_not_validated(monkeypatch):
+    """
+    test that the body of a block which is not on the best header chain is
+    held without being validated and is validated when its header chain
+    becomes the best header chain
+    """
+    validated = []
+    monkeypatch.setattr(hmining, "proof_of_work", lambda x: True)
+    monkeypatch.setattr(hblockchain, "validate_block", 
+                        lambda x: validated.append(x) == None and extends_tip(x))
     monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
-    monkeypatch.setattr(hchaindb, "get_transaction", lambda x: True)
     monkeypatch.setattr(hchaindb, "transaction_update", lambda x: True)
+    monkeypatch.setattr(blk_index, "put_index", lambda x,y: True)
+    monkeypatch.setattr(hmining, "propagate_mined_block", lambda x: True)
+    hmining.received_blocks.clear()
+
+    block1, block2 = make_tree_blockchain()
+    fork1 = make_child_block(block1)
+    fork2 = make_child_block(fork1)
+
+    assert hmining.receive_block(fork1) == True
+    assert validated == []
+    assert hblockchain.header_index[hblockchain.blockheader_hash(fork1)]["block"] is fork1
+    assert hblockchain.blockchain == [block1, block2]
+
+    assert hmining.receive_block(fork2) == True
+    assert hblockchain.best_header == hblockchain.blockheader_hash(fork2)
+    assert hblockchain.blockchain == [block1, fork1, fork2]
+    assert hblockchain.header_index[hblockchain.blockheader_hash(fork1)]["block"] == None
 
     hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
+    hblockchain.block_tree.clear()
+    hblockchain.header_index.clear()
+    hblockchain.best_header = None
     hmining.received_blocks.clear()
+    hmining.seen_blocks.clear()
 
-    block1 = make_synthetic_block()
-    hblockchain.blockchain.append(block1)
 
-    block2 = make_synthetic_block()
-    block3 = make_synthetic_block()
-    block4 = make_synthetic_block()
-    block4["prevblockhash"] = hblockchain.blockheader_hash(block3)
+def test_held_child_connected_with_parent(monkeypatch):
+    """
+    test that a held block whose body arrives before the body of its parent
+    is connected when the body of the parent arrives
+    """
+    monkeypatch.setattr(hmining, "proof_of_work", lambda x: True)
+    monkeypatch.setattr(hblockchain, "validate_block", extends_tip)
+    monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
+    monkeypatch.setattr(hchaindb, "transaction_update", lambda x: True)
+    monkeypatch.setattr(blk_index, "put_index", lambda x,y: True)
+    monkeypatch.setattr(hmining, "propagate_mined_block", lambda x: True)
+    hmining.received_blocks.clear()
 
-    hblockchain.secondary_blockchain.append(block2)
-    hblockchain.secondary_blockchain.append(block3)
-    assert len(hblockchain.blockchain) == 1
-    assert len(hblockchain.secondary_blockchain) == 2
-    block4["height"] = block3["height"] + 1
-    block4["prevblockhash"] = hblockchain.blockheader_hash(block3)
-    hmining.received_blocks.append(block4)
-    assert len(hmining.received_blocks) == 1
+    block1, block2 = make_tree_blockchain()
+    block3 = make_child_block(block2)
+    block4 = make_child_block(block3)
+    hblockchain.insert_header(hblockchain.block_header(block3))
 
-    hmining.process_received_blocks()
-    assert len(hblockchain.blockchain) == 3
-    assert len(hblockchain.secondary_blockchain) == 1
+    assert hmining.receive_block(block4) == True
+    assert hblockchain.best_header == hblockchain.blockheader_hash(block4)
+    assert hblockchain.header_index[hblockchain.best_header]["block"] is block4
+    assert hblockchain.blockchain == [block1, block2]
+
+    assert hmining.receive_block(block3) == True
+    assert hblockchain.blockchain == [block1, block2, block3, block4]
+    assert hblockchain.header_index[hblockchain.best_header]["block"] == None
 
     hblockchain.blockchain.clear()
-    hblockchain.secondary_blockchain.clear()
+    hblockchain.block_tree.clear()
+    hblockchain.header_index.clear()
+    hblockchain.best_header = None
+    hmining.received_blocks.clear()
+    hmining.seen_blocks.clear()
+
+
+def test_invalid_body_rejected(monkeypatch):
+    """
+    test that a block with a valid header and an invalid body is rejected
+    and does not remain the best header, so that a valid block with equal
+    work is connected and the descendants of the invalid block are rejected
+    """
+    invalid = []
+    monkeypatch.setattr(hmining, "proof_of_work", lambda x: True)
+    monkeypatch.setattr(hblockchain, "validate_block",
+                        lambda x: x not in invalid and extends_tip(x))
+    monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
+    monkeypatch.setattr(hchaindb, "transaction_update", lambda x: True)
+    monkeypatch.setattr(blk_index, "put_index", lambda x,y: True)
+    monkeypatch.setattr(hmining, "propagate_mined_block", lambda x: True)
     hmining.received_blocks.clear()
+    hmining.rejected_blocks.clear()
+
+    block1, block2 = make_tree_blockchain()
+    bad_block = make_child_block(block2)
+    bad_child = make_child_block(bad_block)
+    invalid.append(bad_block)
+    block3 = make_child_block(block2)
+
+    assert hmining.receive_block(bad_block) == True
+    bad_hash = hblockchain.blockheader_hash(bad_block)
+    assert bad_hash in hmining.rejected_blocks
+    assert hblockchain.header_index[bad_hash]["invalid"] == True
+    assert hblockchain.best_header == hblockchain.blockheader_hash(block2)
+
+    assert hmining.receive_block(bad_child) == False
+    assert hblockchain.blockheader_hash(bad_child) in hmining.rejected_blocks
 
+    assert hmining.receive_block(block3) == True
+    assert hblockchain.best_header == hblockchain.blockheader_hash(block3)
+    assert hblockchain.blockchain == [block1, block2, block3]
 
+    hblockchain.blockchain.clear()
+    hblockchain.block_tree.clear()
+    hblockchain.header_index.clear()
+    hblockchain.best_header = None
+    hmining.received_blocks.clear()
+    hmining.seen_blocks.clear()
+    hmining.rejected_blocks.clear()
+
+
+def test_invalidate_header():
+    """
+    test that invalidating a header invalidates its descendants and moves
+    the best header to the valid header with the most work
+    """
+    block1, block2 = make_tree_blockchain()
+    fork1 = make_child_block(block1)
+    fork2 = make_child_block(fork1)
+    fork3 = make_child_block(fork2)
+    for block in [fork1, fork2, fork3]:
+        hblockchain.insert_header(hblockchain.block_header(block))
+    assert hblockchain.best_header == hblockchain.blockheader_hash(fork3)
+
+    assert hblockchain.invalidate_header(hblockchain.blockheader_hash(fork2)) == True
+    assert hblockchain.header_index[hblockchain.blockheader_hash(fork3)]["invalid"] == True
+    assert hblockchain.header_index[hblockchain.blockheader_hash(fork1)]["invalid"] == False
+    assert hblockchain.best_header in [hblockchain.blockheader_hash(fork1),
+                                       hblockchain.blockheader_hash(block2)]
+    assert hblockchain.invalidate_header("unknown") == False
+
+    hblockchain.blockchain.clear()
+    hblockchain.block_tree.clear()
+    hblockchain.header_index.clear()
+    hblockchain.best_header = None
+
+
+def test_remember_block():
+    """
+    test that the oldest block hashes are forgotten
+    """
+    blocks = {}
+    for blkhash in ["a", "b", "c"]:
+        hmining.remember_block(blocks, blkhash, 2)
+    assert list(blocks) == ["b", "c"]
+
+
+def test_miner_key_per_session(monkeypatch):
+    """
+    test that one miner key pair is made for a mining session
+    """
+    calls = []
+    monkeypatch.setattr(hmining, "make_miner_keys", lambda: calls.append(1) or "pubkey")
+    monkeypatch.setattr(hmining, "miner_pubkey", None)
+
+    assert hmining.get_miner_pubkey() == "pubkey"
+    assert hmining.get_miner_pubkey() == "pubkey"
+    assert len(calls) == 1
+
+
+def test_incremental_template(monkeypatch):
+    """
+    test that the block template is updated from the mempool changes
+    without being rebuilt, and rebuilt when the tip changes
+    """
+    monkeypatch.setattr(hblockchain, "blockchain", [])
+    monkeypatch.setattr(hblockchain, "validate_block", lambda x: True)
+    monkeypatch.setattr(hchaindb, "get_transaction", lambda x: False)
+    monkeypatch.setattr(hmining, "miner_pubkey", "pubkey")
+    monkeypatch.setattr(hmining, "template", {"block": None, "prevblockhash": None,
+                        "sizes": {}, "space": 0})
+    hmempool.clear()
+
+    trxs = [make_synthetic_transaction() for __ctr in range(3)]
+    hmempool.add_transaction(trxs[0])
+    hmempool.add_transaction(trxs[1])
+
+    block = asyncio.run(hmining.update_template())
+    assert [trx["transactionid"] for trx in block["tx"][1:]] == \
+           [trxs[0]["transactionid"], trxs[1]["transactionid"]]
+
+    async def no_rebuild():
+        raise(AssertionError("template rebuilt"))
+    make_candidate_block = hmining.make_candidate_block
+    monkeypatch.setattr(hmining, "make_candidate_block", no_rebuild)
+
+    assert asyncio.run(hmining.update_template()) is block
+
+    hmempool.add_transaction(trxs[2])
+    hmempool.remove_transaction(trxs[0]["transactionid"])
+    block = asyncio.run(hmining.update_template())
+    assert [trx["transactionid"] for trx in block["tx"][1:]] == \
+           [trxs[1]["transactionid"], trxs[2]["transactionid"]]
+    assert block["merkle_root"] == hblockchain.merkle_root(block["tx"], True)
+
+    header = hmining.current_header()
+    assert "tx" not in header
+    assert header["merkle_root"] == block["merkle_root"]
+
+    # a new tip rebuilds the template
+    monkeypatch.setattr(hmining, "make_candidate_block", make_candidate_block)
+    monkeypatch.setattr(hblockchain, "blockchain", [make_synthetic_block()])
+    block = asyncio.run(hmining.update_template())
+    assert block["height"] == 1025
+    assert hmining.template["prevblockhash"] == \
+           hblockchain.blockheader_hash(hblockchain.blockchain[-1])
+    hmempool.clear()
+
+
+def test_mined_block_round_trip(monkeypatch):
+    """
+    test that the miner stores the solved block that it propagates and
+    that a receiving node accepts the solved block
+    """
+    propagated = []
+    monkeypatch.setitem(hconfig.conf, "DIFFICULTY_TARGET", 2**250)
+    monkeypatch.setattr(hpow, "number_of_workers", lambda: 1)
+    monkeypatch.setattr(hmining, "propagate_mined_block", lambda x: propagated.append(x))
+    monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
+    monkeypatch.setattr(hchaindb, "transaction_update", lambda x: True)
+    monkeypatch.setattr(blk_index, "put_index", lambda x,y: True)
+    hblockchain.blockchain.clear()
+    hblockchain.block_tree.clear()
+    hblockchain.header_index.clear()
+    hblockchain.best_header = None
+
+    # a genesis candidate block whose solution nonce is not zero
+    while True:
+        block = make_synthetic_block()
+        block["height"] = 0
+        block["prevblockhash"] = ""
+        for trx in block["tx"]: trx["vin"] = []
+        block["merkle_root"] = hblockchain.merkle_root(block["tx"], True)
+        if hmining.proof_of_work(block) == False: break
+
+    nonce = asyncio.run(hmining.mine_block(block))
+    assert nonce != False and int(nonce, 16) != hconfig.conf["NONCE"]
+    assert hblockchain.blockchain == propagated
+    assert hmining.proof_of_work(propagated[0]) == True
+
+    # the propagated block is valid on a node which does not have it
+    hblockchain.blockchain.clear()
+    assert hblockchain.validate_block(propagated[0]) == True
+
+    hblockchain.block_tree.clear()
+    hblockchain.header_index.clear()
+    hblockchain.best_header = None
+
+
+def test_save_mempool_under_semaphore(monkeypatch, tmp_path):
+    """
+    test that the mempool snapshot is taken while the semaphore is held
+    """
+    filepath = str(tmp_path / "mempool.dat")
+    monkeypatch.setitem(hconfig.conf, "MEMPOOL_FILE", filepath)
+    hmempool.clear()
+    hmempool.add_transaction(make_synthetic_transaction())
+
+    hmining.semaphore.acquire()
+    saver = threading.Thread(target=hmining.save_mempool)
+    saver.start()
+    saver.join(0.2)
+    assert saver.is_alive() == True
+    assert os.path.isfile(filepath) == False
+    hmining.semaphore.release()
+
+    saver.join()
+    with open(filepath, "rb") as f:
+        assert [record["tx"] for record in pickle.load(f)] == hmempool.transactions()
+    hmempool.clear()
+
+
+def test_update_template_under_semaphore(monkeypatch):
+    """
+    test that the mining thread updates the block template from the mempool
+    only while the semaphore is held
+    """
+    monkeypatch.setattr(hblockchain, "blockchain", [])
+    monkeypatch.setattr(hblockchain, "validate_block", lambda x: True)
+    monkeypatch.setattr(hmining, "miner_pubkey", "pubkey")
+    monkeypatch.setattr(hmining, "template", {"block": None, "prevblockhash": None,
+                        "sizes": {}, "space": 0})
+    hmempool.clear()
+    hmempool.add_transaction(make_synthetic_transaction())
+
+    blocks = []
+    hmining.semaphore.acquire()
+    updater = threading.Thread(target=lambda: blocks.append(asyncio.run(hmining.update_template())))
+    updater.start()
+    updater.join(0.2)
+    assert updater.is_alive() == True
+    assert hmining.template["block"] == None
+    hmining.semaphore.release()
+
+    updater.join()
+    assert blocks[0] != False and blocks[0] is hmining.template["block"]
+    hmempool.clear()
+
+
+def make_chainstate_transaction(spends):
+    """
+    makes a transaction which spends a list of fragment keys and has one
+    p2pkh output
+    """
+    trx = {"transactionid": rcrypt.make_uuid(), "version": hconfig.conf["VERSION_NO"],
+           "locktime": 0, "vin": [], 
+           "vout": [{"value": 10, "ScriptPubKey": ['<DUP>', '<HASH-160>', rcrypt.make_uuid(),
+                                                   '<EQ-VERIFY>', '<CHECK-SIG>']}]}
+    for key in spends:
+        txid, index = key.split("_")
+        trx["vin"].append({"txid": txid, "vout_index": int(index), "ScriptSig": []})
+    return trx
+
+
+def make_chainstate_block(parent, spends=[]):
+    """
+    makes a block which extends parent. It has a coinbase transaction and
+    a transaction for each list of fragment keys in spends
+    """
+    block = make_child_block(parent)
+    block["tx"] = [make_chainstate_transaction([])]
+    block["tx"].extend(make_chainstate_transaction(keys) for keys in spends)
+    block["merkle_root"] = hblockchain.merkle_root(block["tx"], True)
+    return block
+
+
+def test_reorganize_rewinds_chainstate(monkeypatch, tmp_path):
+    """
+    test that a reorganization rewinds the chainstate of the disconnected
+    blocks so that a branch which contains the same transaction is
+    connected, and that a failed reorganization restores the chainstate
+    """
+    monkeypatch.setattr(hblockchain, "validate_block", extends_tip)
+    monkeypatch.setattr(tx, "validate_transaction", lambda x,y: True)
+    monkeypatch.setattr(blk_index, "put_index", lambda x,y: True)
+    monkeypatch.setattr(blk_index, "delete_index", lambda x: True)
+    monkeypatch.setattr(hchaindb, "hDB", None)
+    assert hchaindb.open_hchainstate(str(tmp_path / "heliumdb")) != False
+
+    funding = rcrypt.make_uuid() + "_0"
+    hchaindb.put_transaction(funding, {"pkhash": "pkhash", "value": 100, "spent": False,
+                                       "tx_chain": ""})
+
+    block1, block2 = make_tree_blockchain()
+    block3 = make_chainstate_block(block2, [[funding]])
+    assert hmining.connect_block(block3) == [block3]
+
+    # the fork carries the same transaction as block3
+    fork3 = make_chainstate_block(block2)
+    fork3["tx"].append(block3["tx"][1])
+    fork4 = make_chainstate_block(fork3)
+    assert hmining.connect_block(fork3) == []
+    assert hmining.connect_block(fork4) == [fork3, fork4]
+    assert hblockchain.blockchain == [block1, block2, fork3, fork4]
+    assert hchaindb.get_transaction(funding)["spent"] == True
+    assert hchaindb.get_transaction(block3["tx"][0]["transactionid"] + "_0") == False
+    assert hchaindb.get_transaction(fork3["tx"][0]["transactionid"] + "_0") != False
+
+    # a heavier branch with an invalid block is not connected
+    other3 = make_chainstate_block(block2)
+    other4 = make_chainstate_block(other3)
+    other5 = make_chainstate_block(other4, [[rcrypt.make_uuid() + "_0"]])
+    assert hmining.connect_block(other3) == []
+    assert hmining.connect_block(other4) == []
+    assert hmining.connect_block(other5) == []
+    assert hblockchain.blockchain == [block1, block2, fork3, fork4]
+    assert hchaindb.get_transaction(funding)["tx_chain"] == block3["tx"][1]["transactionid"] + "_0"
+    assert hchaindb.get_transaction(fork4["tx"][0]["transactionid"] + "_0") != False
+    assert hchaindb.get_transaction(other3["tx"][0]["transactionid"] + "_0") == False
+
+    hchaindb.close_hchainstate()
+    hblockchain.blockchain.clear()
+    hblockchain.block_tree.clear()
+    hblockchain.header_index.clear()
+    hblockchain.best_header = None
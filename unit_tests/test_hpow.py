@@ -0,0 +1,206 @@
+"""
+pytest unit tests for the hpow module
+"""
+import hpow
+import hblockchain
+import hconfig
+import rcrypt
+import threading
+import time
+import pytest
+import pdb
+
+
+def make_candidate_block():
+    """
+    makes a synthetic candidate block header
+    """
+    block = {}
+    block["version"] = hconfig.conf["VERSION_NO"]
+    block["prevblockhash"] = rcrypt.make_uuid()
+    block["merkle_root"] = rcrypt.make_uuid()
+    block["timestamp"] = int(time.time())
+    block["difficulty_bits"] = hconfig.conf["DIFFICULTY_BITS"]
+    block["nonce"] = hconfig.conf["NONCE"]
+    return block
+
+
+def is_solution(block, nonce):
+    """
+    tests whether nonce solves the proof of work for block
+    """
+    solved = dict(block)
+    solved["nonce"] = nonce
+    return int(hblockchain.blockheader_hash(solved), 16) < hconfig.conf["DIFFICULTY_TARGET"]
+
+
+def test_header_prefix():
+    """
+    test that the header prefix followed by the nonce is the block header
+    """
+    block = make_candidate_block()
+    block["nonce"] = 1234
+    assert rcrypt.make_SHA256_hash(hpow.header_prefix(block) + "1234") == \
+           hblockchain.blockheader_hash(block)
+
+
+@pytest.mark.parametrize("workers", [1, 2, 3])
+def test_mine_finds_solution(monkeypatch, workers):
+    """
+    test that the workers find a solution nonce
+    """
+    monkeypatch.setitem(hconfig.conf, "DIFFICULTY_TARGET", 2**252)
+    block = make_candidate_block()
+
+    nonce = hpow.mine(block, workers)
+    assert nonce is not False
+    assert is_solution(block, nonce) == True
+    assert block["nonce"] == hconfig.conf["NONCE"]
+    assert hpow.mining_stats["workers"] == workers
+    assert hpow.mining_stats["hashes"] > 0
+
+
+def test_mine_at_target(monkeypatch):
+    """
+    test that the workers mine at the target passed with the block and not
+    at the initial target
+    """
+    monkeypatch.setitem(hconfig.conf, "DIFFICULTY_TARGET", 1)
+    block = make_candidate_block()
+
+    nonce = hpow.mine(block, 2, 2**252)
+    assert nonce is not False
+    solved = dict(block)
+    solved["nonce"] = nonce
+    assert int(hblockchain.blockheader_hash(solved), 16) < 2**252
+
+
+def test_mine_cancelled_by_new_tip(monkeypatch):
+    """
+    test that all of the workers stop when a new tip arrives
+    """
+    monkeypatch.setitem(hconfig.conf, "DIFFICULTY_TARGET", 1)
+    block = make_candidate_block()
+
+    timer = threading.Timer(0.5, hpow.new_tip)
+    timer.start()
+    assert hpow.mine(block, 2) == False
+    assert hpow.mining_stats["cancelled"] == True
+    timer.join()
+
+
+def test_single_worker_cancelled_by_new_tip(monkeypatch):
+    """
+    test that the proof of work computed in the calling process stops when
+    a new tip arrives
+    """
+    monkeypatch.setitem(hconfig.conf, "DIFFICULTY_TARGET", 1)
+    block = make_candidate_block()
+
+    timer = threading.Timer(0.5, hpow.new_tip)
+    timer.start()
+    assert hpow.mine(block, 1) == False
+    assert hpow.mining_stats["cancelled"] == True
+    timer.join()
+
+
+def test_mine_nonce_space_exhausted(monkeypatch):
+    """
+    test that the search fails when the nonce space is exhausted
+    """
+    monkeypatch.setitem(hconfig.conf, "DIFFICULTY_TARGET", 1)
+    monkeypatch.setattr(hpow, "MAX_NONCE", 5000)
+    block = make_candidate_block()
+
+    assert hpow.mine(block, 2) == False
+    assert hpow.mining_stats["hashes"] == 5000
+    assert hpow.mining_stats["cancelled"] == False
+
+
+def test_difficulty_target():
+    """
+    test that the target for n difficulty bits admits hashes with at
+    least n leading zero bits
+    """
+    limit = hpow.target_limit(hpow.difficulty_target(20))
+    assert hpow.meets_target(bytes.fromhex("00000" + "f" * 59), limit) == True
+    assert hpow.meets_target(bytes.fromhex("00001" + "0" * 59), limit) == False
+    assert hpow.target_limit(0) == None
+    assert hpow.meets_target(bytes(32), None) == False
+
+
+def test_header_digest():
+    """
+    test that the raw header digest is the block header hash
+    """
+    block = make_candidate_block()
+    assert hpow.header_digest(block).hex() == hblockchain.blockheader_hash(block)
+
+
+def test_benchmark():
+    """
+    test that the benchmark reports the hashrate of both inner loops
+    """
+    rates = hpow.benchmark(make_candidate_block(), 1000)
+    assert rates["before"] > 0
+    assert rates["after"] > 0
+
+
+def test_retarget():
+    """
+    test that the target is adjusted by at most 20% towards the target
+    which mines a block every 600 seconds
+    """
+    target = 2**236
+    assert hpow.retarget(target, 10 * 600, 10) == target
+    assert hpow.retarget(target, 0, 10) == target * 4 // 5
+    assert hpow.retarget(target, 10**9, 10) < target * 6 // 5
+    assert hpow.retarget(target, 10**9, 10) > target
+    assert hpow.retarget(1, 0, 10) == 1
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_chain_targets(monkeypatch, use_numpy):
+    """
+    test that the expected targets of a header chain are the targets found
+    by retargeting block by block
+    """
+    if use_numpy == False: monkeypatch.setattr(hpow, "numpy", None)
+    elif hpow.numpy == None: pytest.skip("numpy is not installed")
+
+    interval   = 4
+    timestamps = [0]
+    for height in range(1, 23):
+        timestamps.append(timestamps[-1] + 100 * height)
+
+    expected = []
+    target   = 2**236
+    for height in range(len(timestamps)):
+        expected.append(target)
+        if height > 0 and height % interval == 0:
+            target = hpow.retarget(target, timestamps[height] - timestamps[height - interval],
+                                   interval)
+
+    assert hpow.chain_targets(timestamps, 2**236, interval) == expected
+    assert hpow.chain_targets([], 2**236, interval) == []
+
+
+def test_verify_chain(monkeypatch):
+    """
+    test that a header chain is verified against its expected targets
+    """
+    monkeypatch.setitem(hconfig.conf, "DIFFICULTY_BITS", 4)
+    headers = []
+    for height in range(10):
+        header = make_candidate_block()
+        header["height"] = height
+        limit = hpow.target_limit(hpow.difficulty_target(4))
+        while not hpow.meets_target(hpow.header_digest(header), limit):
+            header["nonce"] += 1
+        headers.append(header)
+
+    assert hpow.verify_chain(headers) == True
+
+    while hpow.meets_target(hpow.header_digest(headers[5]), limit):
+        headers[5]["merkle_root"] = rcrypt.make_uuid()
+    assert hpow.verify_chain(headers) == False
@@ -0,0 +1,123 @@
+"""
+pytest unit tests for the hrpc module
+"""
+import hrpc
+import hconfig
+import networknode
+import http.server
+import json
+import threading
+import time
+import pytest
+import pdb
+
+
+class RPCHandler(http.server.BaseHTTPRequestHandler):
+    """
+    a keep-alive JSON-RPC server which echoes the method of a request after
+    a delay. Counts the connections that it accepts.
+    """
+    protocol_version = "HTTP/1.1"
+    delay = 0
+    connections = 0
+
+    def setup(self):
+        RPCHandler.connections += 1
+        super().setup()
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(RPCHandler.delay)
+        if request["method"] == "fail":
+            response = {"jsonrpc": "2.0", "error": {"code": -32601}, "id": request["id"]}
+        else:
+            response = {"jsonrpc": "2.0", "result": request["method"], "id": request["id"]}
+
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RPCServer(http.server.ThreadingHTTPServer):
+    request_queue_size = 128
+
+
+@pytest.fixture
+def server():
+    RPCHandler.delay = 0
+    RPCHandler.connections = 0
+    httpd = RPCServer(("127.0.0.1", 0), RPCHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:" + str(httpd.server_address[1])
+    hrpc.close_connections()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def rpc(method):
+    return json.dumps({"jsonrpc": "2.0", "method": method, "params": {}, "id": 1})
+
+
+def test_peer_address():
+    """
+    test that peer urls and host:port addresses are parsed
+    """
+    assert hrpc.peer_address("http://127.0.0.51:8081") == ("127.0.0.51", 8081, False)
+    assert hrpc.peer_address("127.0.0.19:8081") == ("127.0.0.19", 8081, False)
+    assert hrpc.peer_address("https://127.0.0.51") == ("127.0.0.51", 443, True)
+
+
+def test_connection_reused(server):
+    """
+    test that successive requests to a peer use one keep-alive connection
+    """
+    for ctr in range(5):
+        assert json.loads(hrpc.call(server, rpc("ping")))["result"] == "ping"
+    assert RPCHandler.connections == 1
+
+
+def test_broadcast_is_concurrent(server, monkeypatch):
+    """
+    test that a broadcast to many peers takes about one round trip
+    """
+    monkeypatch.setitem(hconfig.conf, "RPC_PEER_CONNECTIONS", 20)
+    RPCHandler.delay = 0.2
+
+    start = time.time()
+    responses = hrpc.broadcast([server] * 20, rpc("ping"))
+    assert time.time() - start < 1.0
+    assert [json.loads(response)["result"] for response in responses] == ["ping"] * 20
+
+
+def test_timeout_and_retries(server, monkeypatch):
+    """
+    test that a request which times out is retried and then fails
+    """
+    monkeypatch.setitem(hconfig.conf, "RPC_TIMEOUT", 0.1)
+    monkeypatch.setitem(hconfig.conf, "RPC_RETRIES", 2)
+    RPCHandler.delay = 0.3
+
+    retries  = hrpc.rpc_stats["retries"]
+    failures = hrpc.rpc_stats["failures"]
+    assert hrpc.call(server, rpc("ping")) == False
+    assert hrpc.rpc_stats["retries"] == retries + 2
+    assert hrpc.rpc_stats["failures"] == failures + 1
+
+
+def test_hclient_errors(server, monkeypatch):
+    """
+    test that the node client returns an error response if the request
+    fails or the server returns an error
+    """
+    monkeypatch.setitem(hconfig.conf, "RPC_RETRIES", 0)
+    assert json.loads(networknode.hclient(server, rpc("ping")))["result"] == "ping"
+    assert json.loads(networknode.hclient(server, rpc("fail")))["result"] == "error"
+    assert json.loads(networknode.hclient("http://127.0.0.1:1", rpc("ping")))["result"] == "error"
+    assert networknode.hbroadcast([], rpc("ping")) == []
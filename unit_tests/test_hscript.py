@@ -0,0 +1,118 @@
+"""
+pytest unit tests for the hscript module
+"""
+import hscript
+import rcrypt
+import pytest
+import pdb
+
+keys = rcrypt.make_ecc_keys()
+pkhash = rcrypt.make_RIPEMD160_hash(rcrypt.make_SHA256_hash(keys[1]))
+
+
+def make_p2pkh_script():
+    """
+    makes a p2pkhash ScriptPubKey for the test key pair
+    """
+    return ['<DUP>', '<HASH-160>', pkhash, '<EQ-VERIFY>', '<CHECK-SIG>']
+
+
+def make_script_sig(private_key=None):
+    """
+    makes a ScriptSig for the test key pair
+    """
+    if private_key == None: private_key = keys[0]
+    return [rcrypt.sign_message(private_key, keys[1]), keys[1]]
+
+
+def test_compile_p2pkh():
+    """
+    test that a p2pkhash script compiles to its public key hash
+    """
+    assert hscript.compile_script(make_p2pkh_script()) == (hscript.P2PKH, pkhash)
+
+
+@pytest.mark.parametrize("index, value", [
+    (0, 'DUP'),
+    (1, '<HASH160>'),
+    (2, ''),
+    (2, '<DUP>'),
+    (3, '<VERIFY>'),
+    (4, '<CHECKSIG>'),
+])
+def test_compile_nonstandard(index, value):
+    """
+    test that scripts which do not match the p2pkhash template
+    are compiled as non-standard scripts
+    """
+    script = make_p2pkh_script()
+    script[index] = value
+    compiled = hscript.compile_script(script)
+    assert compiled[0] == hscript.NONSTANDARD
+    assert compiled[1] == tuple(script)
+
+
+@pytest.mark.parametrize("script", [
+    [],
+    "<DUP>",
+    ['<DUP>', 5],
+])
+def test_compile_invalid(script):
+    """
+    test that a malformed script does not compile
+    """
+    assert hscript.compile_script(script) == False
+
+
+def test_compile_fragment():
+    """
+    test that a chainstate fragment compiles to a p2pkhash script
+    """
+    fragment = {"pkhash": pkhash, "value": 10, "spent": False, "tx_chain": ""}
+    assert hscript.compile_fragment(fragment) == (hscript.P2PKH, pkhash)
+
+
+def test_p2pkh_good():
+    """
+    test that a compiled p2pkhash script is unlocked
+    """
+    compiled = hscript.compile_script(make_p2pkh_script())
+    assert hscript.verify_script(make_script_sig(), compiled) == True
+
+
+def test_p2pkh_bad_signature():
+    """
+    test that a p2pkhash script is not unlocked by the wrong private key
+    """
+    other_keys = rcrypt.make_ecc_keys()
+    compiled = hscript.compile_script(make_p2pkh_script())
+    assert hscript.verify_script(make_script_sig(other_keys[0]), compiled) == False
+
+
+def test_p2pkh_bad_pubkey_hash():
+    """
+    test that a p2pkhash script is not unlocked by a public key with the
+    wrong hash
+    """
+    compiled = (hscript.P2PKH, rcrypt.make_RIPEMD160_hash("wrong key"))
+    assert hscript.verify_script(make_script_sig(), compiled) == False
+
+
+def test_interpreter_agrees_with_fast_path():
+    """
+    test that the general interpreter gives the same results as the
+    p2pkhash fast path
+    """
+    script = make_p2pkh_script()
+    other_keys = rcrypt.make_ecc_keys()
+
+    assert hscript.execute_script(make_script_sig(), script) == True
+    assert hscript.execute_script(make_script_sig(other_keys[0]), script) == False
+
+
+def test_interpreter_unknown_opcode():
+    """
+    test that a script with an unknown opcode fails
+    """
+    script = make_p2pkh_script() + ['<NOP>']
+    assert hscript.execute_script(make_script_sig(), script) == False
@@ -0,0 +1,63 @@
+"""
+pytest unit tests for the hsubsidy module
+"""
+import hsubsidy
+import hconfig
+import pytest
+import pdb
+
+
+def float_reward(block_height):
+    """
+    the mining reward computed by halving a float, as the subsidy was 
+    computed before the subsidy schedule
+    """
+    reward = hconfig.conf["MINING_REWARD"]
+    for __ctr in range(block_height // hconfig.conf["REWARD_INTERVAL"]):
+        reward = reward / 2
+    return int(round(reward))
+
+
+@pytest.mark.parametrize("reward, interval", [
+    (5_000_000, 210000),
+    (50, 11),
+    (5_000_000_000, 1000),
+])
+def test_subsidy_matches_float_halving(monkeypatch, reward, interval):
+    """
+    test that the integer subsidy is the rounded float reward
+    """
+    monkeypatch.setitem(hconfig.conf, "MINING_REWARD", reward)
+    monkeypatch.setitem(hconfig.conf, "REWARD_INTERVAL", interval)
+
+    for era in range(40):
+        height = era * interval + interval // 2
+        assert hsubsidy.block_subsidy(height) == float_reward(height)
+
+
+def test_total_supply(monkeypatch):
+    """
+    test that the total supply is the sum of the block subsidies
+    """
+    monkeypatch.setitem(hconfig.conf, "MINING_REWARD", 50)
+    monkeypatch.setitem(hconfig.conf, "REWARD_INTERVAL", 11)
+
+    total = 0
+    for height in range(150):
+        total += hsubsidy.block_subsidy(height)
+        assert hsubsidy.total_supply(height) == total
+
+    assert hsubsidy.block_subsidy(10**9) == 0
+    assert hsubsidy.total_supply(10**9) == total
+
+
+def test_audit_supply(monkeypatch):
+    """
+    test that a schedule which issues more than MAX_HELIUM_COINS fails the
+    supply audit
+    """
+    assert hsubsidy.audit_supply(10**9) == True
+
+    monkeypatch.setitem(hconfig.conf, "MINING_REWARD", hsubsidy.max_supply())
+    assert hsubsidy.audit_supply(0) == True
+    assert hsubsidy.audit_supply(1) == False
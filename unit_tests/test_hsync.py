@@ -0,0 +1,198 @@
+"""
+pytest unit tests for the hsync module
+"""
+import hsync
+import hmining
+import hblockchain
+import hconfig
+import rcrypt
+import random
+import time
+import pytest
+import pdb
+
+
+def make_chain(length):
+    """
+    makes a synthetic chain of linked blocks starting at the genesis block
+    """
+    chain = []
+    for height in range(length):
+        block = {"version": hconfig.conf["VERSION_NO"], "prevblockhash": "",
+                 "merkle_root": rcrypt.make_uuid(), "timestamp": int(time.time()),
+                 "difficulty_bits": hconfig.conf["DIFFICULTY_BITS"],
+                 "nonce": hconfig.conf["NONCE"], "height": height, "tx": []}
+        if height > 0: block["prevblockhash"] = hblockchain.blockheader_hash(chain[-1])
+        chain.append(block)
+    return chain
+
+
+def clear():
+    """
+    clears the blockchain, the block tree and the header index
+    """
+    hblockchain.blockchain.clear()
+    hblockchain.block_tree.clear()
+    hblockchain.best_tip = None
+    hblockchain.header_index.clear()
+    hblockchain.best_header = None
+
+
+def add_block(block):
+    """
+    mock add_block: the block must extend the blockchain
+    """
+    if len(hblockchain.blockchain) > 0:
+        if block["prevblockhash"] != hblockchain.blockheader_hash(hblockchain.blockchain[-1]):
+            return False
+    hblockchain.blockchain.append(block)
+    hblockchain.best_tip = hblockchain.blockheader_hash(block)
+    hblockchain.insert_node(block, hblockchain.best_tip)
+    return True
+
+
+def make_peers(chain, failing=(), short=()):
+    """
+    returns a mock request function which serves the chain. The failing 
+    peers return errors and the short peers return one item per request.
+    Responses are delayed at random so that they arrive out of order.
+    """
+    def request(peer, method, params):
+        time.sleep(random.random() / 100)
+        if peer in failing: return False
+        if method == "get_blockchain_height": return len(chain) - 1
+
+        count = min(params["count"], hconfig.conf["SYNC_BATCH_SIZE"])
+        if peer in short: count = 1
+        blocks = chain[params["height"]:params["height"] + count]
+        if method == "get_headers":
+            return [hblockchain.block_header(block) for block in blocks]
+        return blocks
+
+    return request
+
+
+@pytest.fixture
+def sync(monkeypatch):
+    """
+    mocks the proof of work and add_block and sets a small window
+    """
+    monkeypatch.setattr(hmining, "proof_of_work", lambda x: True)
+    monkeypatch.setattr(hblockchain, "add_block", add_block)
+    monkeypatch.setitem(hconfig.conf, "SYNC_BATCH_SIZE", 4)
+    monkeypatch.setitem(hconfig.conf, "SYNC_WINDOW", 12)
+    clear()
+    yield
+    clear()
+
+
+def test_download_in_order(sync, monkeypatch):
+    """
+    test that blocks fetched concurrently from several peers are connected
+    in height order
+    """
+    chain = make_chain(50)
+    monkeypatch.setattr(hsync, "request", make_peers(chain))
+
+    assert hsync.initial_block_download(["peer0", "peer1", "peer2"]) == 50
+    assert hblockchain.blockchain == chain
+    assert hblockchain.best_header == hblockchain.blockheader_hash(chain[-1])
+    assert hsync.sync_stats["headers"] == 50
+    assert hsync.sync_stats["blocks"] == 50
+    assert hsync.sync_stats["blocks_per_second"] > 0
+
+
+def test_download_after_tip(sync, monkeypatch):
+    """
+    test that only the blocks after the tip of the blockchain are fetched
+    """
+    chain = make_chain(20)
+    for block in chain[:8]: add_block(block)
+    monkeypatch.setattr(hsync, "request", make_peers(chain))
+
+    assert hsync.initial_block_download(["peer0", "peer1"]) == 12
+    assert hblockchain.blockchain == chain
+    assert hsync.initial_block_download(["peer0", "peer1"]) == 0
+
+
+def test_retry_failing_peer(sync, monkeypatch):
+    """
+    test that ranges which fail or are returned in part are fetched from
+    the other peers
+    """
+    chain = make_chain(30)
+    monkeypatch.setattr(hsync, "request", make_peers(chain, failing=("peer1",), short=("peer2",)))
+
+    assert hsync.initial_block_download(["peer0", "peer1", "peer2"]) == 30
+    assert hblockchain.blockchain == chain
+
+
+def test_all_peers_failing(sync, monkeypatch):
+    """
+    test that the download fails if a range cannot be fetched from any peer
+    """
+    chain = make_chain(10)
+    monkeypatch.setattr(hsync, "request", make_peers(chain, failing=("peer0", "peer1")))
+
+    assert hsync.fetch_ranges(["peer0", "peer1"], "get_blocks", 0, 10, lambda x, y: True) == False
+    assert hsync.initial_block_download(["peer0", "peer1"]) == 0
+
+
+def test_reject_body_with_wrong_header(sync, monkeypatch):
+    """
+    test that a block body which does not match its validated header is
+    not added to the blockchain
+    """
+    chain = make_chain(10)
+    bodies = [dict(block) for block in chain]
+    bodies[5]["merkle_root"] = rcrypt.make_uuid()
+    headers = make_peers(chain)
+    monkeypatch.setattr(hsync, "request", lambda peer, method, params: 
+        make_peers(bodies)(peer, method, params) if method == "get_blocks" 
+        else headers(peer, method, params))
+
+    assert hsync.initial_block_download(["peer0"]) == False
+    assert len(hblockchain.blockchain) == 5
+
+
+def test_peers_on_different_forks(sync, monkeypatch):
+    """
+    test that the ranges of peers on different forks are not mixed. A range
+    which does not link to the previous header is fetched from the next peer
+    """
+    chain = make_chain(20)
+    fork  = [dict(block) for block in chain]
+    for block in fork[10:]:
+        block["merkle_root"] = rcrypt.make_uuid()
+        block["prevblockhash"] = hblockchain.blockheader_hash(fork[block["height"] - 1])
+
+    peer0 = make_peers(chain)
+    peer1 = make_peers(fork)
+    monkeypatch.setattr(hsync, "request", lambda peer, method, params:
+        peer0(peer, method, params) if peer == "peer0" else peer1(peer, method, params))
+
+    assert hsync.initial_block_download(["peer0", "peer1"]) == 20
+    assert hblockchain.blockchain == chain
+
+
+def test_window_bounds_buffer(sync):
+    """
+    test that no more than SYNC_WINDOW heights are requested ahead of the 
+    next height to be connected
+    """
+    requested = []
+    connected = []
+
+    def request(peer, method, params):
+        requested.append(params["height"] + params["count"] - 1 - len(connected))
+        return list(range(params["height"], params["height"] + params["count"]))
+
+    hsync.request, saved = request, hsync.request
+    try:
+        assert hsync.fetch_ranges(["peer0", "peer1"], "get_blocks", 0, 100,
+                                  lambda height, item: connected.append(item) == None) == 100
+    finally:
+        hsync.request = saved
+
+    assert connected == list(range(100))
+    assert max(requested) < hconfig.conf["SYNC_WINDOW"]
@@ -651,3 +651,118 @@ def test_unlock_good():
 
 
 
+
+
+def test_duplicate_vin_rejected_by_syntax_stage(monkeypatch):
+    """
+    test that a transaction which spends the same fragment twice is
+    rejected before the chainstate is accessed
+    """
+    def no_lookup(txkey):
+        raise(AssertionError("chainstate accessed"))
+
+    monkeypatch.setattr(tx, "prevtx_value", no_lookup)
+    txn = make_synthetic_transaction(1)
+    txn['version'] = hconfig.conf["VERSION_NO"]
+    txn['vin'].append(dict(txn['vin'][0]))
+
+    syntax_rejections = tx.rejection_counters["syntax"]
+    assert tx.validate_transaction(txn) == False
+    assert tx.rejection_counters["syntax"] == syntax_rejections + 1
+
+
+def test_missing_input_rejected_before_scripts(monkeypatch):
+    """
+    test that a transaction with an unspendable input is rejected
+    without verifying any signatures
+    """
+    def no_unlock(vin, fragment):
+        raise(AssertionError("signature verified"))
+
+    monkeypatch.setattr(tx, "prevtx_value", lambda x: False)
+    monkeypatch.setattr(tx, "unlock_transaction_fragment", no_unlock)
+    txn = make_synthetic_transaction(1)
+    txn['version'] = hconfig.conf["VERSION_NO"]
+
+    input_rejections = tx.rejection_counters["inputs"]
+    assert tx.validate_transaction(txn) == False
+    assert tx.rejection_counters["inputs"] == input_rejections + 1
+
+
+def test_overspend_rejected_before_scripts(monkeypatch):
+    """
+    test that a transaction which spends more than its inputs is
+    rejected without verifying any signatures
+    """
+    def no_unlock(vin, fragment):
+        raise(AssertionError("signature verified"))
+
+    monkeypatch.setattr(tx, "prevtx_value", lambda x: {"value": 1, "pkhash": "",
+                        "spent": False, "tx_chain": ""})
+    monkeypatch.setattr(tx, "unlock_transaction_fragment", no_unlock)
+    txn = make_synthetic_transaction(1)
+    txn['version'] = hconfig.conf["VERSION_NO"]
+    txn['vout'][0]['value'] = 1000
+
+    value_rejections = tx.rejection_counters["values"]
+    assert tx.validate_transaction(txn) == False
+    assert tx.rejection_counters["values"] == value_rejections + 1
+
+
+def test_pending_fragments_used_before_chainstate(monkeypatch):
+    """
+    test that the outputs of unconfirmed transactions are used in place
+    of the chainstate
+    """
+    def no_lookup(txkey):
+        raise(AssertionError("chainstate accessed"))
+
+    monkeypatch.setattr(tx, "prevtx_value", no_lookup)
+    txn = make_synthetic_transaction(1)
+    txn['vin'] = txn['vin'][:1]
+    vin = txn['vin'][0]
+    fragment = {"value": 5, "pkhash": "", "spent": False, "tx_chain": ""}
+    pending = {vin['txid'] + '_' + str(vin['vout_index']): fragment}
+
+    assert tx.spendable_inputs(txn, pending) == [fragment]
+
+
+def test_scripts_skipped_below_checkpoint(monkeypatch):
+    """
+    test that no signature is verified if verify_scripts is False and
+    that the other stages are still executed
+    """
+    def no_unlock(vin, fragment):
+        raise(AssertionError("signature verified"))
+
+    monkeypatch.setattr(tx, "prevtx_value", lambda x: {"value": 10**12, "pkhash": "",
+                        "spent": False, "tx_chain": ""})
+    monkeypatch.setattr(tx, "unlock_transaction_fragment", no_unlock)
+    txn = make_synthetic_transaction(1)
+    txn['version'] = hconfig.conf["VERSION_NO"]
+
+    assert tx.validate_transaction(txn, verify_scripts=False) == True
+    assert tx.validate_transaction(txn) == False
+
+    txn['vout'][0]['value'] = 10**13
+    assert tx.validate_transaction(txn, verify_scripts=False) == False
+
+
+def test_immature_coinbase_not_spendable(monkeypatch):
+    """
+    test that a coinbase output cannot be spent until COINBASE_INTERVAL
+    blocks have been mined on top of its block
+    """
+    fragment = {"value": 5, "pkhash": "", "spent": False, "tx_chain": "",
+                "height": 10, "coinbase": True}
+    monkeypatch.setattr(tx, "prevtx_value", lambda x: fragment)
+    txn = make_synthetic_transaction(1)
+    txn['vin'] = txn['vin'][:1]
+    interval = hconfig.conf["COINBASE_INTERVAL"]
+
+    assert tx.spendable_inputs(txn, height=10 + interval - 1) == False
+    assert tx.spendable_inputs(txn, height=10 + interval) == [fragment]
+
+    fragment["coinbase"] = False
+    assert tx.spendable_inputs(txn, height=11) == [fragment]
+    assert tx.fragment_mature({"value": 5, "spent": False}, 0) == True
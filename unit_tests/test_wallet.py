@@ -96,7 +96,11 @@ def make_random_transaction(blockno, is_coinbase):
             index = secrets.randbelow(len(unspent_fragments))
             frag_dict = unspent_fragments[index]
 
-            if frag_dict["blockno"] == blockno or frag_dict["value"] < 10:
+            # coinbase outputs are immature for COINBASE_INTERVAL blocks
+            immature = (frag_dict["coinbase"] == True and
+                blockno - frag_dict["blockno"] < hconfig.conf["COINBASE_INTERVAL"])
+
+            if frag_dict["blockno"] == blockno or frag_dict["value"] < 10 or immature:
                 ctr += 1
                 if ctr == 10000:
                     print("failed to get random unspent fragment")
@@ -184,7 +188,8 @@ def make_random_transaction(blockno, is_coinbase):
                         "value":value, 
                         "privkey":transaction_keys[0], 
                         "pubkey":transaction_keys[1],
-                        "blockno": blockno 
+                        "blockno": blockno,
+                        "coinbase": is_coinbase
                     }
         unspent_fragments.append(fragment)   
         print("added to unspent fragments: " + fragment["key"])